@@ -1,5 +1,13 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, g, has_app_context, Response, stream_with_context
 import sqlite3
+import csv
+import tempfile
+import uuid
+import itertools
+import secrets
+import queue
+import heapq
+import threading
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 import json
@@ -7,14 +15,22 @@ import requests
 import time
 import os
 import io
+import numpy as np
 import pandas as pd
 import jwt
 import pyotp
 import qrcode
 import io
 import base64
-from cryptography.fernet import Fernet
-from functools import wraps
+import click
+import hmac
+import re
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from functools import lru_cache, partial, wraps
 from flasgger import Swagger, swag_from
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -23,6 +39,8 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib import colors
 from groq import Groq
+from markupsafe import escape
+from openpyxl import Workbook
 from xhtml2pdf import pisa
 
 # --- CONFIGURATION ---
@@ -32,29 +50,176 @@ app.secret_key = 'your-secret-key-here'  # Change to random key
 # --- ENCRYPTION CONFIGURATION ---
 # Generates a key file if it doesn't exist. 
 # IN PRODUCTION: Keep 'secret.key' safe and separate from the code!
+# The file is a key ring: one key per line, newest first. New data is encrypted with
+# the first key; older keys stay available for decryption until rotation completes.
 KEY_FILE = 'secret.key'
 
-def load_key():
+def load_keys():
     if not os.path.exists(KEY_FILE):
         key = Fernet.generate_key()
         with open(KEY_FILE, 'wb') as key_file:
             key_file.write(key)
-    return open(KEY_FILE, 'rb').read()
-
-cipher_suite = Fernet(load_key())
+    with open(KEY_FILE, 'rb') as key_file:
+        return [line.strip() for line in key_file.read().splitlines() if line.strip()]
+
+def _write_keys(keys):
+    tmp_path = KEY_FILE + '.tmp'
+    with open(tmp_path, 'wb') as key_file:
+        key_file.write(b'\n'.join(keys) + b'\n')
+    os.replace(tmp_path, KEY_FILE)  # Atomic, so other workers never read a partial ring
+
+def _load_cipher():
+    global cipher_suite, primary_cipher, _keyring_mtime
+    keys = load_keys()
+    cipher_suite = MultiFernet([Fernet(key) for key in keys])
+    primary_cipher = Fernet(keys[0])
+    _keyring_mtime = os.stat(KEY_FILE).st_mtime_ns
+
+_load_cipher()
+
+def reload_keyring_if_changed():
+    """Reloads the key ring if another process rotated it. Returns True if it changed."""
+    if os.stat(KEY_FILE).st_mtime_ns == _keyring_mtime:
+        return False
+    _load_cipher()
+    return True
+
+def rotate_encryption_key():
+    """Makes a new key the primary (encrypting) key, keeping older keys for decryption."""
+    _write_keys([Fernet.generate_key()] + load_keys())
+    _load_cipher()
+
+def retire_old_keys():
+    """Drops every key but the primary. Only safe once all data is re-encrypted."""
+    _write_keys(load_keys()[:1])
+    _load_cipher()
+
+# Separate key for the blind search index (HMAC tokens of description trigrams),
+# so search tokens stay stable when the encryption key changes.
+SEARCH_KEY_FILE = 'search.key'
+
+def load_search_key():
+    if not os.path.exists(SEARCH_KEY_FILE):
+        with open(SEARCH_KEY_FILE, 'wb') as key_file:
+            key_file.write(os.urandom(32))
+    return open(SEARCH_KEY_FILE, 'rb').read()
+
+search_key = load_search_key()
 
 def encrypt_data(data):
-    """Encrypts a string."""
+    """Encrypts a string with the primary key, first picking up a ring rotated by another process."""
     if not data: return ""
+    reload_keyring_if_changed()
     return cipher_suite.encrypt(data.encode()).decode()
 
+# --- DECRYPTION (single, batch and cached) ---
+app.config['DECRYPT_CACHE_SIZE'] = 20000           # Ciphertexts kept in the process-wide LRU cache
+# Threads used for large batches (0 disables). Fernet decrypts of short descriptions are
+# GIL-bound, so threads only pay off with long descriptions; see `benchmarks.py decrypt`.
+app.config['DECRYPT_WORKERS'] = 0
+app.config['DECRYPT_PARALLEL_THRESHOLD'] = 2000    # Minimum distinct tokens before using threads
+
+# A Fernet token is URL-safe base64 of: version byte 0x80, 8-byte timestamp, 16-byte IV,
+# AES-CBC ciphertext (16+ bytes) and a 32-byte HMAC. So it always starts with "gAAAAA",
+# is padded to a multiple of 4 and is at least 100 characters long. Anything else is
+# legacy plaintext and can be returned without attempting (and failing) a decrypt.
+FERNET_TOKEN_RE = re.compile(r'gAAAAA[A-Za-z0-9_-]+={0,2}')
+FERNET_MIN_TOKEN_LENGTH = 100
+
+def looks_encrypted(data):
+    return (
+        len(data) >= FERNET_MIN_TOKEN_LENGTH
+        and len(data) % 4 == 0
+        and FERNET_TOKEN_RE.fullmatch(data) is not None
+    )
+
+def _decrypt_token(token):
+    """Decrypts one token with the key ring. Raises InvalidToken if no key matches."""
+    return cipher_suite.decrypt(token.encode()).decode()
+
+# Failures raise, so only successful decrypts are ever cached
+_cached_decrypt_token = lru_cache(maxsize=app.config['DECRYPT_CACHE_SIZE'])(_decrypt_token)
+
+def _decrypt_or_passthrough(decrypt, token):
+    try:
+        return decrypt(token)
+    except InvalidToken:
+        # Another worker may have rotated the key since this process loaded the ring
+        if reload_keyring_if_changed():
+            try:
+                return decrypt(token)
+            except InvalidToken:
+                pass
+        return token  # Token-shaped legacy text
+_decrypt_executor = None
+_decrypt_stats_lock = threading.Lock()
+_decrypt_stats = {'rows': 0, 'legacy': 0, 'decrypted': 0, 'seconds': 0.0}
+
+def _get_decrypt_executor():
+    global _decrypt_executor
+    with _decrypt_stats_lock:
+        if _decrypt_executor is None:
+            _decrypt_executor = ThreadPoolExecutor(
+                max_workers=app.config['DECRYPT_WORKERS'], thread_name_prefix='decrypt'
+            )
+        return _decrypt_executor
+
+def decrypt_many(values, use_cache=True, parallel=None):
+    """
+    Decrypts a batch of stored descriptions, preserving order.
+    Empty values become "", legacy plaintext is passed through without a decrypt attempt
+    and repeated ciphertexts are decrypted once. When DECRYPT_WORKERS is set, large
+    batches are spread over that many threads unless parallel=False.
+    """
+    started = time.perf_counter()
+    values = list(values)
+    results = [''] * len(values)
+    pending = {}  # token -> positions
+    legacy = 0
+    for i, value in enumerate(values):
+        if not value:
+            continue
+        if looks_encrypted(value):
+            pending.setdefault(value, []).append(i)
+        else:
+            results[i] = value
+            legacy += 1
+
+    decrypt = partial(_decrypt_or_passthrough, _cached_decrypt_token if use_cache else _decrypt_token)
+    tokens = list(pending)
+    if parallel is None:
+        parallel = len(tokens) >= app.config['DECRYPT_PARALLEL_THRESHOLD']
+    if parallel and tokens and app.config['DECRYPT_WORKERS'] > 0:
+        chunk_size = max(1, len(tokens) // (app.config['DECRYPT_WORKERS'] * 4) or 1)
+        plaintexts = list(_get_decrypt_executor().map(decrypt, tokens, chunksize=chunk_size))
+    else:
+        plaintexts = [decrypt(token) for token in tokens]
+
+    for token, plaintext in zip(tokens, plaintexts):
+        for i in pending[token]:
+            results[i] = plaintext
+
+    with _decrypt_stats_lock:
+        _decrypt_stats['rows'] += len(values)
+        _decrypt_stats['legacy'] += legacy
+        _decrypt_stats['decrypted'] += len(tokens)
+        _decrypt_stats['seconds'] += time.perf_counter() - started
+    return results
+
 def decrypt_data(data):
-    """Decrypts a string. Returns original data if decryption fails (Backward Compatibility)."""
+    """Decrypts a string. Returns original data if it isn't encrypted (Backward Compatibility)."""
     if not data: return ""
-    try:
-        return cipher_suite.decrypt(data.encode()).decode()
-    except Exception:
-        return data  # Return raw text if it wasn't encrypted (Legacy Data)
+    return decrypt_many([data])[0]
+
+def get_decrypt_stats():
+    """Process-wide decrypt counters, throughput in rows/sec and LRU cache statistics."""
+    cache = _cached_decrypt_token.cache_info()
+    with _decrypt_stats_lock:
+        stats = dict(_decrypt_stats)
+    stats['rows_per_sec'] = round(stats['rows'] / stats['seconds'], 1) if stats['seconds'] else 0.0
+    stats['seconds'] = round(stats['seconds'], 4)
+    stats['cache'] = {'hits': cache.hits, 'misses': cache.misses, 'size': cache.currsize, 'max_size': cache.maxsize}
+    return stats
 
 # Swagger Configuration
 app.config['SWAGGER'] = {
@@ -88,12 +253,6 @@ limiter = Limiter(
     storage_uri="memory://"
 )
 
-_RATES_CACHE = {
-    "timestamp": 0,
-    "rates": {}
-}
-CACHE_TTL = 60 * 60  # 1 hour
-
 # Initialize Groq Client (Ensure API Key is set)
 # Ideally, use os.environ.get("GROQ_API_KEY")
 groq_client = Groq(
@@ -101,11 +260,257 @@ groq_client = Groq(
 )
 
 # --- DATABASE HELPERS ---
+app.config['DATABASE'] = 'expenses.db'
+app.config['DB_POOL_SIZE'] = 10
+app.config['DB_POOL_TIMEOUT'] = 10  # Seconds to wait for a free connection
+
+# Storage configuration applied to every pooled connection.
+# WAL lets dashboard readers run while imports/recurring jobs write, and
+# busy_timeout makes a blocked writer wait instead of failing with "database is locked".
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',          # Durable at checkpoints; safe with WAL
+    'busy_timeout': 5000,             # Milliseconds
+    'cache_size': -16000,             # Negative = KiB, i.e. ~16 MB page cache per connection
+    'mmap_size': 128 * 1024 * 1024,   # Bytes
+    'temp_store': 'MEMORY',
+    'wal_autocheckpoint': 1000,       # Pages
+}
+# Write transactions start with BEGIN IMMEDIATE so they take the write lock up front
+# (and wait busy_timeout for it) instead of failing when upgrading a read lock.
+app.config['SQLITE_ISOLATION_LEVEL'] = 'IMMEDIATE'
+# Seconds between PASSIVE WAL checkpoints run when a connection is returned to the pool
+app.config['WAL_CHECKPOINT_INTERVAL'] = 300
+
+SQLITE_PRAGMA_NAMES = {
+    'journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size',
+    'temp_store', 'wal_autocheckpoint', 'foreign_keys'
+}
+
+def apply_sqlite_pragmas(conn, pragmas):
+    """Applies PRAGMA settings to a connection. Only known PRAGMA names are accepted."""
+    for name, value in pragmas.items():
+        if name not in SQLITE_PRAGMA_NAMES:
+            raise ValueError(f'Unsupported SQLite PRAGMA: {name}')
+        if not isinstance(value, int) and not str(value).isalnum():
+            raise ValueError(f'Invalid value for PRAGMA {name}: {value!r}')
+        conn.execute(f'PRAGMA {name} = {value}').fetchall()
+
+def checkpoint_wal(conn, mode='PASSIVE'):
+    """Runs a WAL checkpoint and returns (busy, wal_pages, checkpointed_pages)."""
+    if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+        raise ValueError(f'Invalid checkpoint mode: {mode}')
+    return tuple(conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone())
+
+def insert_rows(conn, sql, rows):
+    """
+    Runs an INSERT once per row on one cursor and returns each row's new id, read from
+    cursor.lastrowid after its own statement, so nothing assumes the ids are contiguous.
+    (executemany discards RETURNING rows and only exposes the last rowid.)
+    """
+    cursor = conn.cursor()
+    ids = []
+    for row in rows:
+        cursor.execute(sql, row)
+        ids.append(cursor.lastrowid)
+    return ids
+
+class PooledConnection(sqlite3.Connection):
+    """
+    SQLite connection owned by a ConnectionPool.
+    close() hands the connection back to the pool instead of closing it. While the
+    connection is bound to an app context, close() is a no-op and the connection is
+    returned when the context tears down.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.context_bound = False
+
+    def close(self):
+        if self.context_bound:
+            return
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+    def discard(self):
+        """Closes the underlying SQLite connection for good."""
+        self.pool = None
+        self.context_bound = False
+        super().close()
+
+class ConnectionPool:
+    """Thread-safe pool of SQLite connections with health checks and usage metrics."""
+
+    def __init__(self, database, size=10, timeout=10, pragmas=None, isolation_level='',
+                 checkpoint_interval=None):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(pragmas or {})
+        self.isolation_level = isolation_level
+        self.checkpoint_interval = checkpoint_interval
+        self._last_checkpoint = time.time()
+        self._checkpoint_result = None
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._counters = {
+            'created': 0, 'reused': 0, 'checkouts': 0, 'discarded': 0, 'timeouts': 0, 'checkpoints': 0
+        }
+        self._wait_seconds = 0.0
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _connect(self):
+        busy_timeout_ms = self.pragmas.get('busy_timeout', 5000)
+        conn = sqlite3.connect(
+            self.database,
+            timeout=busy_timeout_ms / 1000,
+            isolation_level=self.isolation_level,
+            check_same_thread=False,
+            factory=PooledConnection
+        )
+        conn.row_factory = sqlite3.Row
+        apply_sqlite_pragmas(conn, self.pragmas)
+        self._count('created')
+        return conn
+
+    def _maybe_checkpoint(self, conn):
+        """Runs a PASSIVE checkpoint at most once per checkpoint_interval seconds."""
+        if not self.checkpoint_interval:
+            return
+        with self._lock:
+            if time.time() - self._last_checkpoint < self.checkpoint_interval:
+                return
+            self._last_checkpoint = time.time()
+        try:
+            self._checkpoint_result = checkpoint_wal(conn, 'PASSIVE')
+            self._count('checkpoints')
+        except sqlite3.Error as e:
+            print(f"WAL checkpoint error: {e}")
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            self._count('timeouts')
+            raise RuntimeError(f'No database connection available within {self.timeout}s (pool size {self.size})')
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = self._connect()
+                    break
+                if self._is_healthy(conn):
+                    self._count('reused')
+                    break
+                self._count('discarded')
+                conn.discard()
+        except Exception:
+            self._slots.release()
+            raise
+
+        conn.pool = self
+        with self._lock:
+            self._in_use += 1
+            self._counters['checkouts'] += 1
+            self._wait_seconds += time.perf_counter() - started
+        return conn
+
+    def release(self, conn):
+        if conn.pool is not self:
+            return  # Already released
+        conn.pool = None
+        conn.context_bound = False
+        try:
+            # Never hand out a connection with someone else's uncommitted work
+            if conn.in_transaction:
+                conn.rollback()
+            self._maybe_checkpoint(conn)
+            self._idle.put(conn)
+        except sqlite3.Error:
+            self._count('discarded')
+            conn.discard()
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().discard()
+            except queue.Empty:
+                break
+
+    def metrics(self):
+        with self._lock:
+            checkouts = self._counters['checkouts']
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                **self._counters,
+                'avg_wait_ms': round(self._wait_seconds / checkouts * 1000, 3) if checkouts else 0.0,
+                'last_checkpoint': self._checkpoint_result,
+            }
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Returns the process-wide pool, rebuilding it if the DATABASE setting changed."""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool.database != app.config['DATABASE']:
+            if _db_pool is not None:
+                _db_pool.close_all()
+            _db_pool = ConnectionPool(
+                app.config['DATABASE'],
+                size=app.config['DB_POOL_SIZE'],
+                timeout=app.config['DB_POOL_TIMEOUT'],
+                pragmas=app.config['SQLITE_PRAGMAS'],
+                isolation_level=app.config['SQLITE_ISOLATION_LEVEL'],
+                checkpoint_interval=app.config['WAL_CHECKPOINT_INTERVAL']
+            )
+        return _db_pool
+
 def get_db_connection():
-    conn = sqlite3.connect('expenses.db')
-    conn.row_factory = sqlite3.Row
+    """
+    Returns the connection for the current app context, checking one out of the pool
+    on first use. Every helper called during a request shares that one connection.
+    Outside an app context (background threads) a pooled connection is returned
+    and close() gives it back.
+    """
+    if not has_app_context():
+        return get_db_pool().acquire()
+    conn = g.get('_db_conn')
+    if conn is None:
+        conn = get_db_pool().acquire()
+        conn.context_bound = True
+        g._db_conn = conn
     return conn
 
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    conn = g.pop('_db_conn', None)
+    if conn is not None and conn.pool is not None:
+        conn.pool.release(conn)
+
 # --- API HELPERS & DECORATORS ---
 def token_required(f):
     @wraps(f)
@@ -129,10 +534,26 @@ def token_required(f):
     
     return decorated
 
-def api_response(success=True, data=None, message=None, code=200):
+# Per-process metrics endpoints are for operators only: list the user ids allowed to read them.
+# Empty (the default) turns the endpoints off.
+app.config['METRICS_API_USERS'] = set()
+
+def metrics_access_required(f):
+    """Wraps a token_required view; users not in METRICS_API_USERS get a 404, as if it did not exist."""
+    @wraps(f)
+    def decorated(current_user_id, *args, **kwargs):
+        if current_user_id not in app.config['METRICS_API_USERS']:
+            return api_response(success=False, message='Not found', code=404)
+        return f(current_user_id, *args, **kwargs)
+
+    return decorated
+
+def api_response(success=True, data=None, message=None, code=200, meta=None):
     response = {'success': success}
     if data is not None:
         response['data'] = data
+    if meta is not None:
+        response['meta'] = meta
     if message is not None:
         response['message'] = message
     return jsonify(response), code
@@ -175,6 +596,10 @@ def init_db():
             is_recurring BOOLEAN DEFAULT 0,
             frequency TEXT DEFAULT 'monthly',
             next_due_date TEXT,
+            duplicate_of INTEGER,
+            recurring_parent_id INTEGER,
+            recurrence_interval INTEGER DEFAULT 1,
+            recurrence_end_date TEXT,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
@@ -190,6 +615,19 @@ def init_db():
         conn.execute('ALTER TABLE expenses ADD COLUMN frequency TEXT DEFAULT "monthly"')
         conn.execute('ALTER TABLE expenses ADD COLUMN next_due_date TEXT')
     
+    if 'duplicate_of' not in columns:
+        print("Migrating DB: Adding duplicate_of to expenses...")
+        conn.execute('ALTER TABLE expenses ADD COLUMN duplicate_of INTEGER')
+    
+    if 'recurring_parent_id' not in columns:
+        print("Migrating DB: Adding recurring_parent_id to expenses...")
+        conn.execute('ALTER TABLE expenses ADD COLUMN recurring_parent_id INTEGER')
+    
+    if 'recurrence_interval' not in columns:
+        print("Migrating DB: Adding recurrence interval and end date to expenses...")
+        conn.execute('ALTER TABLE expenses ADD COLUMN recurrence_interval INTEGER DEFAULT 1')
+        conn.execute('ALTER TABLE expenses ADD COLUMN recurrence_end_date TEXT')
+    
     # Budgets Table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS budgets (
@@ -226,7 +664,172 @@ def init_db():
     # Analytics-specific indexes
     conn.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_date_category ON expenses(user_id, date, category)')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_expenses_date_amount ON expenses(date, amount_usd)')
-    
+
+    # Daily spend rollup (read by dashboard, budgets, analytics and chatbot)
+    init_daily_spend_rollup(conn)
+    init_user_data_versions(conn)
+    # Blind keyword index over encrypted descriptions
+    init_search_index(conn)
+
+    # Uploaded import files staged on disk until the column mapping is confirmed
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_staging (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            filename TEXT,
+            created_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_import_staging_expires ON import_staging(expires_at)')
+
+    # Background import jobs, checkpointed per chunk, and their per-row rejection reports
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            filename TEXT,
+            mapping TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            total_rows INTEGER NOT NULL DEFAULT 0,
+            imported INTEGER NOT NULL DEFAULT 0,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            duplicate_policy TEXT NOT NULL DEFAULT 'skip',
+            baseline_id INTEGER NOT NULL DEFAULT 0,
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            finished_at TEXT,
+            claimed_by TEXT,
+            heartbeat_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # [MIGRATION] Worker lease on import jobs (owner and last heartbeat, epoch seconds)
+    columns = [info[1] for info in conn.execute("PRAGMA table_info(import_jobs)").fetchall()]
+    if 'claimed_by' not in columns:
+        print("Migrating DB: Adding claimed_by/heartbeat_at to import_jobs...")
+        conn.execute('ALTER TABLE import_jobs ADD COLUMN claimed_by TEXT')
+        conn.execute('ALTER TABLE import_jobs ADD COLUMN heartbeat_at REAL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_import_jobs_user ON import_jobs(user_id, created_at)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_rejections (
+            job_id TEXT NOT NULL,
+            line INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            raw TEXT,
+            PRIMARY KEY (job_id, line)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_duplicates (
+            job_id TEXT NOT NULL,
+            line INTEGER NOT NULL,
+            expense_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            previous_category TEXT,
+            previous_description TEXT,
+            PRIMARY KEY (job_id, line)
+        ) WITHOUT ROWID
+    ''')
+    # [MIGRATION] Merged duplicates keep the values the import overwrote (description encrypted)
+    columns = [info[1] for info in conn.execute("PRAGMA table_info(import_duplicates)").fetchall()]
+    if 'previous_category' not in columns:
+        print("Migrating DB: Adding previous_category/previous_description to import_duplicates...")
+        conn.execute('ALTER TABLE import_duplicates ADD COLUMN previous_category TEXT')
+        conn.execute('ALTER TABLE import_duplicates ADD COLUMN previous_description TEXT')
+
+    # Asynchronous export jobs and their on-disk artifacts
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            data_type TEXT NOT NULL,
+            format TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            total_rows INTEGER NOT NULL DEFAULT 0,
+            file_path TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT,
+            finished_at TEXT,
+            expires_at TEXT,
+            claimed_by TEXT,
+            heartbeat_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # [MIGRATION] Last progress time, so jobs orphaned by a restart can be detected
+    columns = [info[1] for info in conn.execute("PRAGMA table_info(export_jobs)").fetchall()]
+    if 'updated_at' not in columns:
+        print("Migrating DB: Adding updated_at to export_jobs...")
+        conn.execute('ALTER TABLE export_jobs ADD COLUMN updated_at TEXT')
+    # [MIGRATION] Owning process and its heartbeat, so only jobs of dead processes are failed
+    if 'claimed_by' not in columns:
+        print("Migrating DB: Adding claimed_by/heartbeat_at to export_jobs...")
+        conn.execute('ALTER TABLE export_jobs ADD COLUMN claimed_by TEXT')
+        conn.execute('ALTER TABLE export_jobs ADD COLUMN heartbeat_at REAL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_export_jobs_expires ON export_jobs(expires_at)')
+
+    # Recurring scheduler: one occurrence per master and date, and a lease so only one worker sweeps
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_expenses_recurring_occurrence
+        ON expenses(recurring_parent_id, date) WHERE recurring_parent_id IS NOT NULL
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_expenses_recurring_due ON expenses(next_due_date) WHERE is_recurring = 1')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    # Daily rate history (units per USD) for date-accurate conversions (see FxRateIndex)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS fx_rates (
+            date TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            rate REAL NOT NULL,
+            PRIMARY KEY (currency, date)
+        ) WITHOUT ROWID
+    ''')
+    # Single-row counter bumped by store_fx_rates, so workers spot new rates with one lookup
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS fx_rates_version (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Latest USD exchange rates, shared by all workers (see ExchangeRateCache)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS exchange_rates (
+            currency TEXT PRIMARY KEY,
+            rate REAL NOT NULL,
+            fetched_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+    # Checkpoints for resumable background maintenance (e.g. re-encryption)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_jobs (
+            name TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',
+            last_id INTEGER NOT NULL DEFAULT 0,
+            target_id INTEGER NOT NULL DEFAULT 0,
+            processed INTEGER NOT NULL DEFAULT 0,
+            updated INTEGER NOT NULL DEFAULT 0,
+            started_at TEXT,
+            updated_at TEXT
+        )
+    ''')
+
     # --- NEW SPLITWISE TABLES ---
     conn.execute('''
         CREATE TABLE IF NOT EXISTS groups (
@@ -271,224 +874,2634 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_group_expenses_group ON group_expenses(group_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_expense_splits_expense ON expense_splits(expense_id)')
+    init_group_ledger(conn)
     
     conn.commit()
+
+    # Start from an empty WAL after migrations
+    if app.config['SQLITE_PRAGMAS'].get('journal_mode', '').upper() == 'WAL':
+        checkpoint_wal(conn, 'TRUNCATE')
+    conn.close()
+
+def init_daily_spend_rollup(conn):
+    """
+    Creates the daily_spend_native rollup and the triggers that keep it in sync with expenses.
+    Rows are keyed by (user, day, category, currency) and hold both the native and the USD sum,
+    so readers aggregate per day instead of per transaction and can show amounts already in
+    the display currency without a USD round trip. Triggers cover every write path (single
+    edits, bulk updates, imports, recurring generation).
+    """
+    rollup_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='daily_spend_native'"
+    ).fetchone()
+
+    # [MIGRATION] The USD-only daily_spend rollup is superseded by daily_spend_native
+    for trigger in ('trg_daily_spend_insert', 'trg_daily_spend_delete', 'trg_daily_spend_update'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    conn.execute('DROP TABLE IF EXISTS daily_spend')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_spend_native (
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            category TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            total_native REAL NOT NULL DEFAULT 0,
+            total_usd REAL NOT NULL DEFAULT 0,
+            txn_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, date, category, currency)
+        ) WITHOUT ROWID
+    ''')
+
+    add = '''
+            INSERT INTO daily_spend_native (user_id, date, category, currency, total_native, total_usd, txn_count)
+            VALUES (NEW.user_id, NEW.date, NEW.category, COALESCE(NEW.currency, 'USD'), NEW.amount, NEW.amount_usd, 1)
+            ON CONFLICT(user_id, date, category, currency) DO UPDATE SET
+                total_native = total_native + excluded.total_native,
+                total_usd = total_usd + excluded.total_usd,
+                txn_count = txn_count + 1;
+    '''
+    remove = '''
+            UPDATE daily_spend_native
+            SET total_native = total_native - OLD.amount, total_usd = total_usd - OLD.amount_usd, txn_count = txn_count - 1
+            WHERE user_id = OLD.user_id AND date = OLD.date AND category = OLD.category
+              AND currency = COALESCE(OLD.currency, 'USD');
+            DELETE FROM daily_spend_native
+            WHERE user_id = OLD.user_id AND date = OLD.date AND category = OLD.category
+              AND currency = COALESCE(OLD.currency, 'USD') AND txn_count <= 0;
+    '''
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_spend_native_insert AFTER INSERT ON expenses
+        BEGIN {add} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_spend_native_delete AFTER DELETE ON expenses
+        BEGIN {remove} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_spend_native_update
+        AFTER UPDATE OF user_id, date, category, currency, amount, amount_usd ON expenses
+        WHEN OLD.user_id IS NOT NEW.user_id OR OLD.date IS NOT NEW.date OR OLD.category IS NOT NEW.category
+          OR OLD.currency IS NOT NEW.currency OR OLD.amount IS NOT NEW.amount OR OLD.amount_usd IS NOT NEW.amount_usd
+        BEGIN {remove} {add} END
+    ''')
+
+    if not rollup_exists:
+        print("Migrating DB: Building daily_spend_native rollup...")
+        rebuild_daily_spend(conn)
+
+def init_user_data_versions(conn):
+    """
+    Creates user_data_versions, a per-user counter bumped by triggers on every expense and
+    budget write, so cached per-user summaries can be checked with one primary-key lookup.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_data_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table in ('expenses', 'budgets'):
+        for event, rows in (('INSERT', ('NEW',)), ('DELETE', ('OLD',)), ('UPDATE', ('OLD', 'NEW'))):
+            bumps = ' '.join(
+                f'''INSERT INTO user_data_versions (user_id, version) VALUES ({row}.user_id, 1)
+                   ON CONFLICT(user_id) DO UPDATE SET version = version + 1;'''
+                for row in rows
+            )
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} AFTER {event} ON {table}
+                BEGIN {bumps} END
+            ''')
+
+def init_search_index(conn):
+    """Creates the blind keyword index for encrypted descriptions and backfills it once."""
+    index_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='expense_search_tokens'"
+    ).fetchone()
+    fingerprints_exist = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='expense_fingerprints'"
+    ).fetchone()
+
+    # Content fingerprints for duplicate detection (see expense_fingerprint)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS expense_fingerprints (
+            user_id INTEGER NOT NULL,
+            fingerprint INTEGER NOT NULL,
+            expense_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, fingerprint, expense_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_fingerprints_expense ON expense_fingerprints(expense_id)')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_fingerprints_delete AFTER DELETE ON expenses
+        BEGIN
+            DELETE FROM expense_fingerprints WHERE expense_id = OLD.id;
+        END
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS expense_search_tokens (
+            user_id INTEGER NOT NULL,
+            token INTEGER NOT NULL,
+            expense_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, token, expense_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_search_tokens_expense ON expense_search_tokens(expense_id)')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_search_tokens_delete AFTER DELETE ON expenses
+        BEGIN
+            DELETE FROM expense_search_tokens WHERE expense_id = OLD.id;
+        END
+    ''')
+
+    if not index_exists or not fingerprints_exist:
+        print("Migrating DB: Building description search index...")
+        rebuild_search_index(conn)
+
+def rebuild_daily_spend(conn, user_id=None):
+    """Recomputes the daily_spend_native rollup from the raw expenses table."""
+    if user_id is None:
+        conn.execute('DELETE FROM daily_spend_native')
+        where, params = '', ()
+    else:
+        conn.execute('DELETE FROM daily_spend_native WHERE user_id = ?', (user_id,))
+        where, params = 'WHERE user_id = ?', (user_id,)
+    conn.execute(f'''
+        INSERT INTO daily_spend_native (user_id, date, category, currency, total_native, total_usd, txn_count)
+        SELECT user_id, date, category, COALESCE(currency, 'USD'), SUM(amount), SUM(amount_usd), COUNT(*)
+        FROM expenses {where}
+        GROUP BY user_id, date, category, COALESCE(currency, 'USD')
+    ''', params)
+
+# --- CURRENCY HELPERS ---
+app.config['FX_RATE_SOURCE'] = None  # Callable returning {currency: units per USD}; None uses exchangerate-api.com
+app.config['FX_REFRESH_AFTER'] = 45 * 60  # Seconds before cached rates are refreshed in the background
+app.config['FX_RETRY_AFTER'] = 5 * 60  # Seconds to wait after a failed fetch (also the refresh lease)
+app.config['FX_DB_POLL_INTERVAL'] = 60  # Seconds between checks for rates fetched by other workers
+FX_REFRESH_LEASE = 'fx_refresh'
+
+
+def fetch_exchangerate_api_rates():
+    """Default rate source: latest USD rates from exchangerate-api.com. Raises on failure."""
+    response = requests.get("https://api.exchangerate-api.com/v4/latest/USD", timeout=5)
+    data = response.json()
+    if "rates" not in data:
+        raise ValueError(f"Invalid API response: {data}")
+    return data["rates"]
+
+
+def get_rate_source():
+    return app.config['FX_RATE_SOURCE'] or fetch_exchangerate_api_rates
+
+
+class ExchangeRateUnavailable(ValueError):
+    """No rate is known for a currency (e.g. rates were never fetched); converting would store wrong amounts."""
+
+    def __init__(self, currency):
+        super().__init__(f"No exchange rate available for {currency}. Try again later.")
+        self.currency = currency
+
+
+class ExchangeRateCache:
+    """
+    USD exchange rates shared by all workers through the exchange_rates table.
+
+    Readers only ever see memory: the table is re-read at most every FX_DB_POLL_INTERVAL,
+    and once the rates are older than FX_REFRESH_AFTER a background thread fetches new ones
+    (stale-while-revalidate). A scheduler lease makes one worker do the fetch, and a failed
+    fetch keeps the last good rates.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._lock = threading.Lock()
+        self._rates = {}
+        self._fetched_at = 0.0
+        self._loaded_at = 0.0
+        self._refreshing = False
+        self._retry_at = 0.0
+
+    def rates(self):
+        """
+        Returns the current {currency: rate} snapshot, scheduling a refresh if it is missing or
+        getting old. Never fetches on the caller's thread: on a cold start the snapshot stays
+        empty (conversions raise ExchangeRateUnavailable) until the background fetch lands.
+        """
+        now = time.time()
+        if now - self._loaded_at > app.config['FX_DB_POLL_INTERVAL']:
+            self.load()
+        if not self._rates or now - self._fetched_at > app.config['FX_REFRESH_AFTER']:
+            self.refresh_async()
+        return self._rates
+
+    def age(self):
+        return time.time() - self._fetched_at
+
+    def load(self):
+        """Picks up the newest rates persisted by any worker (on the request's connection, if any)."""
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('SELECT currency, rate, fetched_at FROM exchange_rates').fetchall()
+        except sqlite3.OperationalError:
+            rows = []  # Table not created yet
+        finally:
+            conn.close()
+        with self._lock:
+            self._loaded_at = time.time()
+            fetched_at = max((row['fetched_at'] for row in rows), default=0.0)
+            if rows and fetched_at >= self._fetched_at:
+                self._rates = {row['currency']: row['rate'] for row in rows}
+                self._fetched_at = fetched_at
+
+    def refresh(self, force=False):
+        """
+        Fetches rates from FX_RATE_SOURCE into the table unless another worker holds the
+        refresh lease or (without force) has just done it. Returns True if rates were stored.
+        Background threads check out their own pooled connection; a request reuses its own.
+        """
+        conn = get_db_connection()
+        try:
+            if not acquire_lease(conn, FX_REFRESH_LEASE, app.config['FX_RETRY_AFTER']):
+                return False
+            latest = conn.execute('SELECT MAX(fetched_at) FROM exchange_rates').fetchone()[0] or 0.0
+            if not force and time.time() - latest < app.config['FX_REFRESH_AFTER']:
+                release_lease(conn, FX_REFRESH_LEASE)
+                stored = False
+            else:
+                try:
+                    rates = {
+                        str(code).upper(): float(rate)
+                        for code, rate in get_rate_source()().items() if float(rate) > 0
+                    }
+                    if not rates:
+                        raise ValueError("Rate source returned no rates")
+                except Exception as e:
+                    # Keep the lease until FX_RETRY_AFTER so no worker hammers a failing source
+                    print(f"Rate fetch error: {e}")
+                    with self._lock:
+                        self._retry_at = time.time() + app.config['FX_RETRY_AFTER']
+                    return False
+                fetched_at = time.time()
+                conn.executemany(
+                    '''INSERT INTO exchange_rates (currency, rate, fetched_at) VALUES (?, ?, ?)
+                       ON CONFLICT(currency) DO UPDATE SET rate = excluded.rate, fetched_at = excluded.fetched_at''',
+                    [(code, rate, fetched_at) for code, rate in rates.items()]
+                )
+                # Each fetch also becomes that day's entry in the rate history
+                today = datetime.fromtimestamp(fetched_at).strftime('%Y-%m-%d')
+                store_fx_rates(conn, [(today, code, rate) for code, rate in rates.items()])
+                conn.commit()
+                invalidate_fx_index()
+                release_lease(conn, FX_REFRESH_LEASE)
+                stored = True
+        finally:
+            conn.close()
+        self.load()
+        return stored
+
+    def refresh_async(self):
+        """Starts a background refresh unless one is running or backing off. Returns the thread."""
+        with self._lock:
+            if self._refreshing or time.time() < self._retry_at:
+                return None
+            self._refreshing = True
+            # Re-check the table before trying again if this attempt loses the lease
+            self._retry_at = time.time() + app.config['FX_DB_POLL_INTERVAL']
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Rate refresh failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        thread = threading.Thread(target=run, name='fx-refresh', daemon=True)
+        thread.start()
+        return thread
+
+
+_rate_cache = None
+_rate_cache_lock = threading.Lock()
+
+def get_rate_cache():
+    """Returns the process-wide rate cache, rebuilding it if the DATABASE setting changed."""
+    global _rate_cache
+    with _rate_cache_lock:
+        if _rate_cache is None or _rate_cache.database != app.config['DATABASE']:
+            _rate_cache = ExchangeRateCache(app.config['DATABASE'])
+        return _rate_cache
+
+
+def start_rate_refresher(interval=None):
+    """Keeps the shared rates fresh from a daemon thread so requests never wait on a fetch."""
+    stop_event = threading.Event()
+
+    def loop():
+        while not stop_event.is_set():
+            cache = get_rate_cache()
+            try:
+                cache.load()
+                if cache.age() > app.config['FX_REFRESH_AFTER']:
+                    cache.refresh()
+            except Exception as e:
+                print(f"Rate refresh failed: {e}")
+            stop_event.wait(interval or app.config['FX_DB_POLL_INTERVAL'])
+
+    thread = threading.Thread(target=loop, name='fx-refresher', daemon=True)
+    thread.start()
+    return thread, stop_event
+
+
+def get_usd_rate(currency, date=None):
+    """
+    Units of `currency` per USD: the latest rate, or the rate in effect on `date`.
+    Raises ExchangeRateUnavailable when no rate is known for the currency.
+    """
+    if currency == "USD":
+        return 1.0
+    if date is not None:
+        return float(usd_rates([currency], [date])[0])
+    rate = get_rate_cache().rates().get(currency)
+    if rate is None:
+        raise ExchangeRateUnavailable(currency)
+    return float(rate)
+
+def has_usd_rate(currencies):
+    """Boolean array: True where a latest rate is known for the currency (USD always)."""
+    known = set(get_rate_cache().rates()) | {'USD'}
+    return np.array([code in known for code in currencies], dtype=bool)
+
+@app.errorhandler(ExchangeRateUnavailable)
+def exchange_rate_unavailable(error):
+    """Refuses the write instead of storing amount_usd at a made-up rate."""
+    if request.path.startswith('/api/'):
+        return api_response(success=False, message=str(error), code=503)
+    flash(str(error))
+    return redirect(request.path if request.method == 'POST' else url_for('index'))
+
+def convert_to_usd(amount, currency, date=None):
+    rate = get_usd_rate(currency, date)
+    return round(amount / rate, 2)
+
+def convert_from_usd(amount_usd, currency, date=None):
+    rate = get_usd_rate(currency, date)
+    return round(amount_usd * rate, 2)
+
+# --- HISTORICAL EXCHANGE RATES ---
+app.config['FX_LOAD_CHUNK_SIZE'] = 50000  # Rows per transaction when bulk-loading rate files
+_DAY_OFFSET = 1 << 31  # Keeps pre-1970 day numbers positive inside the packed keys
+
+
+def _day_numbers(dates):
+    """
+    Days since the epoch for dates given as strings, datetimes or datetime64. Returns (days, valid):
+    missing or unparseable dates are False in `valid` (their day number is meaningless).
+    """
+    parsed = pd.to_datetime(pd.Series(np.asarray(dates, dtype=object)), errors='coerce', format='mixed')
+    days = parsed.values.astype('datetime64[D]')
+    valid = ~np.isnat(days)
+    return np.where(valid, days.astype(np.int64), 0), valid
+
+
+class FxRateIndex:
+    """
+    The fx_rates table in memory as one sorted array of packed (currency, day) keys, so a
+    whole batch of (currency, date) pairs finds its nearest prior rate with one searchsorted.
+    """
+
+    def __init__(self, currencies, dates, rates):
+        days, valid = _day_numbers(dates)
+        currencies = np.asarray(currencies, dtype=object)[valid]  # Undated history rows are skipped
+        self.currencies = pd.Index(sorted(set(currencies)))
+        codes = self.currencies.get_indexer(currencies).astype(np.int64)
+        keys = (codes << 32) | (days[valid] + _DAY_OFFSET)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.codes = codes[order]
+        self.rates = np.asarray(rates, dtype=np.float64)[valid][order]
+
+    @classmethod
+    def from_db(cls, conn):
+        rows = pd.read_sql_query('SELECT currency, date, rate FROM fx_rates', conn)
+        return cls(rows['currency'].tolist(), rows['date'].to_numpy(), rows['rate'].to_numpy())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, currencies, dates):
+        """Rates in effect on each date (the latest on or before it); NaN where none is known or the date is invalid."""
+        days, valid = _day_numbers(dates)
+        rates = self.lookup_days(currencies, days)
+        rates[~valid] = np.nan
+        return rates
+
+    def lookup_days(self, currencies, days):
+        """lookup() for dates already turned into day numbers by _day_numbers."""
+        codes = self.currencies.get_indexer(np.asarray(currencies, dtype=object)).astype(np.int64)
+        queries = (codes << 32) | (days + _DAY_OFFSET)
+        positions = np.searchsorted(self.keys, queries, side='right') - 1
+        clipped = np.clip(positions, 0, None)
+        known = (codes >= 0) & (positions >= 0)
+        if len(self.keys):
+            known &= self.codes[clipped] == codes
+            return np.where(known, self.rates[clipped], np.nan)
+        return np.full(len(codes), np.nan)
+
+
+class _FxIndexCache:
+    """
+    Process-wide FxRateIndex, rebuilt when fx_rates_version moves (checked every FX_DB_POLL_INTERVAL).
+    The check and rebuild run outside the lock, on the caller's connection; the lock only guards the swap.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._lock = threading.Lock()
+        self._index = None
+        self._signature = None
+        self._checked_at = 0.0
+        self._generation = 0
+
+    def get(self):
+        with self._lock:
+            index, signature, generation = self._index, self._signature, self._generation
+            if index is not None and time.time() - self._checked_at <= app.config['FX_DB_POLL_INTERVAL']:
+                return index
+        rebuilt = None
+        conn = get_db_connection()
+        try:
+            row = conn.execute('SELECT version FROM fx_rates_version WHERE id = 0').fetchone()
+            version = row[0] if row else 0
+            if index is None or version != signature:
+                rebuilt = FxRateIndex.from_db(conn)
+        except sqlite3.OperationalError:
+            version, rebuilt = None, FxRateIndex([], [], [])  # Tables not created yet
+        finally:
+            conn.close()
+        with self._lock:
+            if rebuilt is not None:
+                self._index, self._signature = rebuilt, version
+            # An invalidate() during the check means the version read may already be stale
+            if self._generation == generation:
+                self._checked_at = time.time()
+            return self._index
+
+    def invalidate(self):
+        with self._lock:
+            self._checked_at = 0.0
+            self._generation += 1
+
+
+_fx_index_cache = None
+_fx_index_cache_lock = threading.Lock()
+
+def get_fx_index():
+    """Returns the process-wide historical rate index, rebuilding it if the DATABASE setting changed."""
+    global _fx_index_cache
+    with _fx_index_cache_lock:
+        if _fx_index_cache is None or _fx_index_cache.database != app.config['DATABASE']:
+            _fx_index_cache = _FxIndexCache(app.config['DATABASE'])
+        cache = _fx_index_cache
+    return cache.get()
+
+
+def invalidate_fx_index():
+    if _fx_index_cache is not None:
+        _fx_index_cache.invalidate()
+
+
+def store_fx_rates(conn, rows):
+    """Upserts [(date, currency, rate)] into fx_rates and bumps fx_rates_version; the caller commits."""
+    conn.executemany(
+        '''INSERT INTO fx_rates (date, currency, rate) VALUES (?, ?, ?)
+           ON CONFLICT(currency, date) DO UPDATE SET rate = excluded.rate''',
+        rows
+    )
+    conn.execute(
+        '''INSERT INTO fx_rates_version (id, version) VALUES (0, 1)
+           ON CONFLICT(id) DO UPDATE SET version = version + 1'''
+    )
+
+
+def load_fx_rates(conn, source, chunk_size=None):
+    """
+    Bulk-loads a CSV of historical rates (units per USD) into fx_rates, one transaction per chunk.
+    Accepts long format (date, currency, rate) or wide format (date, then one column per
+    currency). Rows without a valid date or a positive rate are skipped. Returns rows stored.
+    """
+    chunk_size = chunk_size or app.config['FX_LOAD_CHUNK_SIZE']
+    stored = 0
+    for chunk in pd.read_csv(source, chunksize=chunk_size, dtype=str):
+        chunk.columns = [column.strip().lower() for column in chunk.columns]
+        if 'date' not in chunk.columns:
+            raise ValueError("Rate file needs a 'date' column")
+        if 'currency' not in chunk.columns:
+            chunk = chunk.melt(id_vars='date', var_name='currency', value_name='rate')
+        dates = pd.to_datetime(chunk['date'], errors='coerce', format='mixed').dt.strftime('%Y-%m-%d')
+        rates = pd.to_numeric(chunk['rate'], errors='coerce')
+        currencies = chunk['currency'].astype(str).str.strip().str.upper()
+        valid = dates.notna() & (rates > 0)
+        rows = list(zip(dates[valid].tolist(), currencies[valid].tolist(), rates[valid].tolist()))
+        store_fx_rates(conn, rows)
+        conn.commit()
+        stored += len(rows)
+    invalidate_fx_index()
+    return stored
+
+
+def usd_rates(currencies, dates):
+    """
+    Units per USD for each (currency, date) pair, as one array operation over the history.
+    Pairs with no earlier history fall back to the latest rate; USD is always 1.
+    Raises ValueError for a missing or unparseable date rather than guessing one.
+    """
+    currencies = np.asarray(currencies, dtype=object)
+    days, valid = _day_numbers(dates)
+    if not valid.all():
+        raise ValueError(f"Invalid date: {np.asarray(dates, dtype=object)[~valid][0]!r}")
+    rates = get_fx_index().lookup_days(currencies, days)
+    missing = np.isnan(rates)
+    if missing.any():
+        fallback = {code: get_usd_rate(code) for code in pd.unique(currencies[missing])}
+        rates[missing] = pd.Series(currencies[missing]).map(fallback).to_numpy(dtype=np.float64)
+    rates[currencies == 'USD'] = 1.0
+    return rates
+
+
+def convert_series(amounts, currencies, dates, from_usd=False):
+    """
+    Converts amounts to USD (or, with from_usd, USD amounts into `currencies`) at the rate in
+    effect on each date. `currencies` may be a single code. Returns a float array rounded to cents.
+    """
+    amounts = np.asarray(amounts, dtype=np.float64)
+    if isinstance(currencies, str):
+        currencies = np.full(len(amounts), currencies, dtype=object)
+    rates = usd_rates(currencies, dates)
+    converted = amounts * rates if from_usd else amounts / rates
+    return np.round(converted, 2)
+
+
+# --- DISPLAY CURRENCY ---
+class CurrencyContext:
+    """
+    Display-currency conversion for one request, with one rate policy for every figure:
+    amounts already in the display currency keep their native value, everything else is
+    converted from USD at the display rate in effect on its date.
+    """
+
+    def __init__(self, currency):
+        self.requested = currency
+        try:
+            self.rate = get_usd_rate(currency)
+        except ExchangeRateUnavailable:
+            currency, self.rate = 'USD', 1.0  # Show USD, labelled as such, until rates arrive
+        self.currency = currency
+
+    def dated_rates(self, dates):
+        """
+        Display units per USD in effect on each date; the current rate where no history is known,
+        and NaN where the date cannot be parsed (such amounts cannot be converted and are skipped).
+        """
+        if self.currency == 'USD' or not len(dates):
+            return np.ones(len(dates))
+        days, valid = _day_numbers(dates)
+        rates = get_fx_index().lookup_days(np.full(len(dates), self.currency, dtype=object), days)
+        return np.where(valid, np.where(np.isnan(rates), self.rate, rates), np.nan)
+
+    def query_rollup(self, conn, user_id, select, since=None, until=None, group_by=None, **params):
+        """
+        Runs SELECT `select` over the user's daily_spend_native rows (aliased `s`) between since
+        and until, where {amount} in `select` is each row's value in the display currency. The
+        rates for the rows' days are passed in as one JSON table that drives a primary-key
+        join into the rollup, so the conversion stays in SQL. A day whose stored date cannot be
+        parsed gets a NULL rate, so its converted amounts drop out rather than use a guessed rate.
+        """
+        where = 's.user_id = :user_id'
+        where += ' AND s.date >= :since' if since else ''
+        where += ' AND s.date <= :until' if until else ''
+        params.update(user_id=user_id, since=since, until=until, currency=self.currency)
+        if self.currency == 'USD':
+            source, amount = 'daily_spend_native s', 's.total_usd'
+        else:
+            dates = [row[0] for row in conn.execute(f'SELECT DISTINCT s.date FROM daily_spend_native s WHERE {where}', params)]
+            rates = [None if np.isnan(rate) else rate for rate in self.dated_rates(dates).tolist()]
+            params['rates'] = json.dumps(dict(zip(dates, rates)))
+            # The rates hold exactly the days in range, so each one is a primary-key probe
+            source = ('json_each(:rates) r CROSS JOIN daily_spend_native s '
+                      'ON s.user_id = :user_id AND s.date = r.key')
+            amount = '(CASE WHEN s.currency = :currency THEN s.total_native ELSE s.total_usd * r.value END)'
+            where = 'TRUE'
+        query = f'SELECT {select.format(amount=amount)} FROM {source} WHERE {where}'
+        if group_by:
+            query += f' GROUP BY {group_by}'
+        return conn.execute(query, params).fetchall()
+
+    def display(self, amount, currency, amount_usd, date=None):
+        """
+        One amount: as entered if already in the display currency, else via USD (at `date`'s rate
+        if given; a row whose stored date cannot be parsed is shown at the current rate).
+        """
+        if currency == self.currency:
+            return round(amount, 2)
+        rate = float(self.dated_rates([date])[0]) if date is not None else self.rate
+        return round(amount_usd * (self.rate if np.isnan(rate) else rate), 2)
+
+
+def get_currency_context():
+    """Returns the request's CurrencyContext for the session currency, creating it on first use."""
+    currency = session.get('currency', 'INR')
+    ctx = g.get('_currency_ctx')
+    if ctx is None or ctx.requested != currency:
+        ctx = g._currency_ctx = CurrencyContext(currency)
+    return ctx
+
+
+# --- SETTLEMENT SOLVER ---
+app.config['SETTLEMENT_EXACT_MAX_MEMBERS'] = 20  # Non-zero balances solved exactly (2^n subset table)
+app.config['SETTLEMENT_TIME_BUDGET'] = 0.2  # Seconds before the exact solver falls back to the heuristic
+
+
+def balances_to_cents(balances):
+    """
+    Converts {user_id: float balance} to integer minor units that sum to exactly zero.
+    The rounding residual goes to the member with the largest balance.
+    """
+    cents = {uid: int(round(balance * 100)) for uid, balance in balances.items()}
+    residual = sum(cents.values())
+    if residual and cents:
+        largest = max(cents, key=lambda uid: (abs(cents[uid]), -uid))
+        cents[largest] -= residual
+    return cents
+
+
+def _settle_subset(members):
+    """Greedy largest-debtor/largest-creditor matching; at most len(members) - 1 transfers."""
+    debtors = [(amount, uid) for uid, amount in members if amount < 0]
+    creditors = [(-amount, uid) for uid, amount in members if amount > 0]
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+    transfers = []
+    while debtors and creditors:
+        debt, debtor = heapq.heappop(debtors)
+        credit, creditor = heapq.heappop(creditors)
+        amount = min(-debt, -credit)
+        transfers.append((debtor, creditor, amount))
+        if debt + amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+        if credit + amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+    return transfers
+
+
+def _zero_sum_partition(members, deadline):
+    """
+    Splits members into the most zero-sum subsets (each settles in size - 1 transfers, so this
+    minimises the total). dp[mask] is the best count of zero-sum prefixes over orderings of
+    mask, built one popcount layer at a time. Returns None if the deadline passes.
+    """
+    n = len(members)
+    values = np.array([amount for _, amount in members], dtype=np.int64)
+    sums = np.zeros(1, dtype=np.int64)
+    for value in values:
+        sums = np.concatenate([sums, sums + value])
+    masks = np.arange(1 << n, dtype=np.int64)
+    popcount = np.zeros(1 << n, dtype=np.int8)
+    for i in range(n):
+        popcount += ((masks >> i) & 1).astype(np.int8)
+    is_zero = (sums == 0).astype(np.int8)
+
+    dp = np.zeros(1 << n, dtype=np.int8)
+    for size in range(1, n + 1):
+        if time.perf_counter() > deadline:
+            return None
+        layer = masks[popcount == size]
+        best = np.full(len(layer), -1, dtype=np.int8)
+        for i in range(n):
+            rows = np.nonzero(layer & (1 << i))[0]
+            best[rows] = np.maximum(best[rows], dp[layer[rows] ^ (1 << i)])
+        dp[layer] = best + is_zero[layer]
+
+    # Walk back from the full set; each zero-sum prefix closes a subset
+    subsets, current = [], []
+    mask = (1 << n) - 1
+    while mask:
+        for i in range(n):
+            bit = 1 << i
+            if mask & bit and dp[mask ^ bit] == dp[mask] - is_zero[mask]:
+                if is_zero[mask] and current:
+                    subsets.append(current)
+                    current = []
+                current.append(members[i])
+                mask ^= bit
+                break
+    # Removal order is the reverse of the prefix order, so the last subset closes at the empty set
+    if current:
+        subsets.append(current)
+    return subsets
+
+
+def _split_off_small_zero_sums(members, deadline):
+    """
+    Pulls out members whose balances cancel in pairs or triples (one or two transfers each),
+    leaving the rest for greedy matching. The triple search is O(n^2) and stops at the deadline.
+    """
+    subsets = []
+    by_amount = {}
+    for member in sorted(members):
+        partners = by_amount.get(-member[1])
+        if partners:
+            subsets.append([partners.pop(), member])
+        else:
+            by_amount.setdefault(member[1], []).append(member)
+    rest = [member for bucket in by_amount.values() for member in bucket]
+
+    by_amount = {}
+    for member in rest:
+        by_amount.setdefault(member[1], []).append(member)
+    used = set()
+    for i, first in enumerate(rest):
+        if time.perf_counter() > deadline:
+            break
+        if first in used:
+            continue
+        for second in rest[i + 1:]:
+            if second in used:
+                continue
+            candidates = by_amount.get(-first[1] - second[1], [])
+            third = next((m for m in candidates if m not in used and m not in (first, second)), None)
+            if third is not None:
+                used.update((first, second, third))
+                subsets.append([first, second, third])
+                break
+    return subsets, [member for member in rest if member not in used]
+
+
+def settle_balances(cents, exact_max_members=None, time_budget=None):
+    """
+    Returns [(from_id, to_id, cents)] settling {user_id: balance in cents} (must sum to zero).
+    Small groups get the minimum number of transfers; larger ones, or a blown time budget,
+    settle cancelling pairs and triples first and greedily match the rest.
+    """
+    if exact_max_members is None:
+        exact_max_members = app.config['SETTLEMENT_EXACT_MAX_MEMBERS']
+    if time_budget is None:
+        time_budget = app.config['SETTLEMENT_TIME_BUDGET']
+    if sum(cents.values()):
+        raise ValueError("Balances must sum to zero")
+
+    members = sorted((uid, amount) for uid, amount in cents.items() if amount)
+    if not members:
+        return []
+    deadline = time.perf_counter() + time_budget
+    if len(members) <= exact_max_members:
+        subsets = _zero_sum_partition(members, deadline)
+        if subsets is not None:
+            return [transfer for subset in subsets for transfer in _settle_subset(subset)]
+        deadline = time.perf_counter() + time_budget
+
+    subsets, rest = _split_off_small_zero_sums(members, deadline)
+    return [transfer for subset in subsets + [rest] for transfer in _settle_subset(subset)]
+
+
+# --- NEW HELPER: SPLITWISE DEBT ALGORITHM ---
+GROUP_BALANCES_SQL = '''
+    -- Settlements: the debtor is the payer and the first split names who was paid back
+    WITH paid AS (
+        SELECT e.payer_id AS user_id, SUM(e.amount) AS total
+        FROM group_expenses e
+        WHERE e.group_id = ?
+          AND (e.description != 'Settlement'
+               OR EXISTS (SELECT 1 FROM expense_splits s WHERE s.expense_id = e.id))
+        GROUP BY e.payer_id
+    ),
+    owed AS (
+        SELECT s.user_id, SUM(CASE WHEN e.description = 'Settlement' THEN e.amount ELSE s.amount_owed END) AS total
+        FROM group_expenses e
+        JOIN expense_splits s ON s.expense_id = e.id
+        WHERE e.group_id = ?
+          AND (e.description != 'Settlement'
+               OR s.rowid = (SELECT MIN(rowid) FROM expense_splits WHERE expense_id = e.id))
+        GROUP BY s.user_id
+    )
+    SELECT gm.user_id, u.username,
+           COALESCE(paid.total, 0.0) - COALESCE(owed.total, 0.0) AS balance
+    FROM group_members gm
+    JOIN users u ON u.id = gm.user_id
+    LEFT JOIN paid ON paid.user_id = gm.user_id
+    LEFT JOIN owed ON owed.user_id = gm.user_id
+    WHERE gm.group_id = ?
+    ORDER BY gm.user_id
+'''
+
+
+def compute_group_balances(conn, group_id):
+    """Returns {user_id: (username, paid minus owed)} for every group member in one query."""
+    rows = conn.execute(GROUP_BALANCES_SQL, (group_id,) * 3).fetchall()
+    return {row['user_id']: (row['username'], row['balance']) for row in rows}
+
+
+def init_group_ledger(conn):
+    """Creates the per-member group_balances ledger and backfills it once from the raw tables."""
+    ledger_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='group_balances'"
+    ).fetchone()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS group_balances (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            net REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (group_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    if not ledger_exists:
+        print("Migrating DB: Building group balances ledger...")
+        rebuild_group_balances(conn)
+
+
+def group_expense_deltas(payer_id, amount, description, splits):
+    """
+    Returns {user_id: balance change} for one group expense, with the same rules as
+    GROUP_BALANCES_SQL. `splits` is [(user_id, amount_owed)] in insertion order.
+    """
+    deltas = {}
+    if description == 'Settlement':
+        if splits:
+            deltas[payer_id] = amount
+            receiver_id = splits[0][0]
+            deltas[receiver_id] = deltas.get(receiver_id, 0.0) - amount
+        return deltas
+    deltas[payer_id] = amount
+    for user_id, amount_owed in splits:
+        deltas[user_id] = deltas.get(user_id, 0.0) - amount_owed
+    return deltas
+
+
+def apply_group_deltas(conn, group_id, deltas, sign=1):
+    """Adds (or with sign=-1, reverts) balance changes in the ledger; runs in the caller's transaction."""
+    conn.executemany(
+        '''INSERT INTO group_balances (group_id, user_id, net) VALUES (?, ?, ?)
+           ON CONFLICT (group_id, user_id) DO UPDATE SET net = net + excluded.net''',
+        [(group_id, user_id, sign * delta) for user_id, delta in deltas.items()]
+    )
+
+
+def revert_group_expense(conn, group_id, expense_id):
+    """Takes an expense's effect out of the ledger; call before deleting its rows."""
+    expense = conn.execute(
+        'SELECT payer_id, amount, description FROM group_expenses WHERE id = ?', (expense_id,)
+    ).fetchone()
+    if expense is None:
+        return
+    splits = conn.execute(
+        'SELECT user_id, amount_owed FROM expense_splits WHERE expense_id = ? ORDER BY rowid', (expense_id,)
+    ).fetchall()
+    deltas = group_expense_deltas(expense['payer_id'], expense['amount'], expense['description'],
+                                  [tuple(split) for split in splits])
+    apply_group_deltas(conn, group_id, deltas, sign=-1)
+
+
+def read_group_balances(conn, group_id):
+    """Returns {user_id: (username, net)} for every group member from the ledger."""
+    rows = conn.execute('''
+        SELECT gm.user_id, u.username, COALESCE(gb.net, 0.0) AS balance
+        FROM group_members gm
+        JOIN users u ON u.id = gm.user_id
+        LEFT JOIN group_balances gb ON gb.group_id = gm.group_id AND gb.user_id = gm.user_id
+        WHERE gm.group_id = ?
+        ORDER BY gm.user_id
+    ''', (group_id,)).fetchall()
+    return {row['user_id']: (row['username'], row['balance']) for row in rows}
+
+
+def _ledger_groups(conn, group_id=None):
+    if group_id is not None:
+        return [group_id]
+    return [row[0] for row in conn.execute(
+        'SELECT id FROM groups UNION SELECT group_id FROM group_balances ORDER BY 1'
+    )]
+
+
+def rebuild_group_balances(conn, group_id=None):
+    """Recomputes the ledger (all groups, or one) from group_expenses and expense_splits."""
+    for gid in _ledger_groups(conn, group_id):
+        conn.execute('DELETE FROM group_balances WHERE group_id = ?', (gid,))
+        balances = compute_group_balances(conn, gid)
+        conn.executemany(
+            'INSERT INTO group_balances (group_id, user_id, net) VALUES (?, ?, ?)',
+            [(gid, user_id, balance) for user_id, (_, balance) in balances.items() if balance]
+        )
+
+
+def verify_group_balances(conn, group_id=None, tolerance=0.005):
+    """Returns [(group_id, user_id, ledger, recomputed)] for every member whose ledger has drifted."""
+    mismatches = []
+    for gid in _ledger_groups(conn, group_id):
+        ledger = read_group_balances(conn, gid)
+        for user_id, (_, expected) in compute_group_balances(conn, gid).items():
+            actual = ledger[user_id][1]
+            if abs(actual - expected) > tolerance:
+                mismatches.append((gid, user_id, actual, expected))
+    return mismatches
+
+
+def calculate_group_debts(group_id):
+    """Calculates who owes whom, handling settlements/partial payments."""
+    conn = get_db_connection()
+    
+    # 1 & 2. Members and their balances (maintained in the group_balances ledger)
+    member_balances = read_group_balances(conn, group_id)
+    user_map = {uid: name for uid, (name, _) in member_balances.items()}
+    balances = {uid: balance for uid, (_, balance) in member_balances.items()}
+    
+    # 3. Minimize Transactions (in cents, so amounts always add up)
+    transactions = [
+        {
+            'from_id': from_id,
+            'to_id': to_id,
+            'from': user_map.get(from_id, 'Unknown'),
+            'to': user_map.get(to_id, 'Unknown'),
+            'amount': amount / 100
+        }
+        for from_id, to_id, amount in settle_balances(balances_to_cents(balances))
+    ]
+    
     conn.close()
+    return transactions
+
+# --- GROUP EXPENSE SPLITS ---
+SPLIT_MODES = ('equal', 'exact', 'percent', 'shares')
+app.config['GROUP_BULK_MAX_EXPENSES'] = 1000  # Expenses per bulk request
+
+
+def to_cents(amount):
+    """Converts a money amount (number or numeric string) to integer minor units; ValueError if not numeric."""
+    try:
+        return round(Fraction(str(amount).strip()) * 100)
+    except ZeroDivisionError:
+        raise ValueError(f"Invalid amount: {amount}")
+
+
+def _allocate_cents(total, weights):
+    """
+    Largest-remainder apportionment of `total` cents over [(user_id, weight)]; the parts
+    always sum to `total`, and leftover cents go to the largest remainders (earliest on ties).
+    """
+    weight_sum = sum(weight for _, weight in weights)
+    parts, remainders = [], []
+    for i, (user_id, weight) in enumerate(weights):
+        whole, remainder = divmod(total * weight, weight_sum)
+        parts.append([user_id, int(whole)])
+        remainders.append((-remainder, i))
+    for _, i in sorted(remainders)[:total - sum(part for _, part in parts)]:
+        parts[i][1] += 1
+    return [(user_id, cents) for user_id, cents in parts]
+
+
+def compute_splits(total_cents, member_ids, mode='equal', values=None):
+    """
+    Returns [(user_id, cents owed)] summing exactly to `total_cents`.
+
+    equal:   every member; leftover cents go to the lowest user ids
+    exact:   values = {user_id: amount}; must add up to the total
+    percent: values = {user_id: percent}; must add up to 100
+    shares:  values = {user_id: weight}; split in proportion to the weights
+    Raises ValueError for an unknown mode, non-members or inconsistent values.
+    """
+    if total_cents <= 0:
+        raise ValueError("Amount must be positive")
+    if mode == 'equal':
+        if not member_ids:
+            raise ValueError("Group has no members")
+        share, remainder = divmod(total_cents, len(member_ids))
+        return [
+            (user_id, share + 1 if i < remainder else share)
+            for i, user_id in enumerate(sorted(member_ids)) if share or i < remainder
+        ]
+    if mode not in SPLIT_MODES:
+        raise ValueError(f"Unknown split mode: {mode}")
+    if not values:
+        raise ValueError(f"Split mode '{mode}' needs a value per member")
+
+    members = set(member_ids)
+    try:
+        values = sorted((int(user_id), Fraction(str(value))) for user_id, value in values.items())
+    except (TypeError, ValueError, ZeroDivisionError):
+        raise ValueError("Split values must be numbers")
+    outsiders = [user_id for user_id, _ in values if user_id not in members]
+    if outsiders:
+        raise ValueError(f"Not group members: {', '.join(map(str, outsiders))}")
+    if any(value < 0 for _, value in values):
+        raise ValueError("Split values cannot be negative")
+
+    if mode == 'exact':
+        splits = [(user_id, int(value * 100)) for user_id, value in values]
+        if any(value * 100 != cents for (_, value), (_, cents) in zip(values, splits)):
+            raise ValueError("Exact splits must be whole cents")
+        if sum(cents for _, cents in splits) != total_cents:
+            raise ValueError("Exact splits must add up to the expense amount")
+        return [split for split in splits if split[1]]
+    if mode == 'percent' and sum(value for _, value in values) != 100:
+        raise ValueError("Percentages must add up to 100")
+    if not any(value for _, value in values):
+        raise ValueError("At least one share must be positive")
+    return [split for split in _allocate_cents(total_cents, values) if split[1]]
+
+
+def insert_group_expenses(conn, group_id, expenses):
+    """
+    Inserts [(payer_id, amount_cents, description, date, splits)], writing all splits with one
+    executemany, and updates the balances ledger. Runs in the caller's transaction and returns
+    the new expense ids.
+    """
+    if not expenses:
+        return []
+    ids = insert_rows(
+        conn,
+        'INSERT INTO group_expenses (group_id, payer_id, amount, description, date) VALUES (?, ?, ?, ?, ?)',
+        [(group_id, payer_id, cents / 100, description, date) for payer_id, cents, description, date, _ in expenses]
+    )
+    conn.executemany(
+        'INSERT INTO expense_splits (expense_id, user_id, amount_owed) VALUES (?, ?, ?)',
+        [
+            (expense_id, user_id, cents / 100)
+            for expense_id, (_, _, _, _, splits) in zip(ids, expenses)
+            for user_id, cents in splits
+        ]
+    )
+    # Sum the batch's ledger changes in cents, then write one row per member
+    deltas = {}
+    for payer_id, cents, description, _, splits in expenses:
+        for user_id, delta in group_expense_deltas(payer_id, cents, description, splits).items():
+            deltas[user_id] = deltas.get(user_id, 0) + delta
+    apply_group_deltas(conn, group_id, {user_id: delta / 100 for user_id, delta in deltas.items()})
+    return ids
+
+
+def group_member_ids(conn, group_id):
+    return [row[0] for row in conn.execute('SELECT user_id FROM group_members WHERE group_id = ?', (group_id,))]
+
+
+# --- CATEGORY HELPERS ---
+def get_user_categories(user_id):
+    """Get all categories for a user, including default categories if none exist"""
+    conn = get_db_connection()
+    custom_categories = conn.execute(
+        'SELECT * FROM categories WHERE user_id = ? ORDER BY name',
+        (user_id,)
+    ).fetchall()
+    conn.close()
+    
+    # Convert to list of dicts
+    categories = [dict(row) for row in custom_categories]
+    
+    # If no custom categories, return default ones
+    if not categories:
+        default_categories = ['Food', 'Transportation', 'Entertainment', 'Shopping', 'Bills', 'Healthcare', 'Other']
+        return [{'name': cat, 'icon': '💰', 'color': '#6c757d'} for cat in default_categories]
+    
+    return categories
+
+def get_category_by_id(category_id, user_id):
+    """Get a specific category by ID for the given user"""
+    conn = get_db_connection()
+    category = conn.execute(
+        'SELECT * FROM categories WHERE id = ? AND user_id = ?',
+        (category_id, user_id)
+    ).fetchone()
+    conn.close()
+    return category
+
+# --- RECURRENCE CALCULATOR ---
+# Occurrence k of a series is anchor + k * interval steps, computed for many series at
+# once with numpy. Month-based steps keep the anchor's day and clamp it to the month's
+# length (Jan 31 -> Feb 29 -> Mar 31, a Feb 29 yearly anchor falls on Feb 28 in common
+# years), so the day never drifts the way repeated month-adds do.
+RECURRENCE_STEPS = {
+    'daily': ('D', 1),
+    'weekly': ('D', 7),
+    'monthly': ('M', 1),
+    'quarterly': ('M', 3),
+    'yearly': ('M', 12),
+}
+
+def _as_days(values, n):
+    return np.broadcast_to(np.asarray(values, dtype='datetime64[D]'), (n,))
+
+def _clamped_month_dates(months, days):
+    """Dates in the given months (datetime64[M]) on `days`, clamped to each month's length."""
+    first = months.astype('datetime64[D]')
+    month_length = ((months + np.timedelta64(1, 'M')).astype('datetime64[D]') - first).astype(np.int64)
+    return first + (np.minimum(days, month_length) - 1).astype('timedelta64[D]')
+
+def _recurrence_steps(anchors, frequencies, intervals):
+    """Per series: (is_month_based, step size in days or months, anchor position in those units)."""
+    units = [RECURRENCE_STEPS.get(frequency, RECURRENCE_STEPS['monthly']) for frequency in frequencies]
+    monthly = np.array([unit == 'M' for unit, _ in units], dtype=bool)
+    step = np.array([size for _, size in units], dtype=np.int64) * np.maximum(np.asarray(intervals, dtype=np.int64), 1)
+    position = np.where(monthly, anchors.astype('datetime64[M]').astype(np.int64), anchors.astype(np.int64))
+    return monthly, step, position
+
+def recurrence_dates(anchors, frequencies, intervals, starts, ends, limit=None):
+    """
+    Generates every occurrence of many recurring series in one vectorized pass.
+    Series i yields anchors[i] + k * intervals[i] steps of frequencies[i] (k >= 1) falling
+    within [starts[i], ends[i]]; starts and ends may also be scalars. At most `limit`
+    occurrences are returned per series. Returns (series_index, dates) ordered by series, then date.
+    """
+    anchors = np.asarray(anchors, dtype='datetime64[D]')
+    n = len(anchors)
+    starts, ends = _as_days(starts, n), _as_days(ends, n)
+    monthly, step, anchor_pos = _recurrence_steps(anchors, frequencies, intervals)
+
+    # Candidate k range per series; month-based bounds may include one extra step at
+    # either end (day clamping), which the date filter below removes
+    start_pos = np.where(monthly, starts.astype('datetime64[M]').astype(np.int64), starts.astype(np.int64))
+    end_pos = np.where(monthly, ends.astype('datetime64[M]').astype(np.int64), ends.astype(np.int64))
+    k_low = np.maximum((start_pos - anchor_pos) // step, 1)
+    counts = np.clip((end_pos - anchor_pos) // step - k_low + 1, 0, None)
+
+    series = np.repeat(np.arange(n), counts)
+    k = k_low[series] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    offsets = k * step[series]
+    anchor_day = (anchors - anchors.astype('datetime64[M]').astype('datetime64[D]')).astype(np.int64) + 1
+    dates = np.where(
+        monthly[series],
+        _clamped_month_dates(anchors[series].astype('datetime64[M]') + offsets.astype('timedelta64[M]'), anchor_day[series]),
+        anchors[series] + offsets.astype('timedelta64[D]'),
+    )
+
+    keep = (dates >= starts[series]) & (dates <= ends[series])
+    series, dates = series[keep], dates[keep]
+    if limit:
+        rank = np.arange(len(series)) - np.searchsorted(series, series)
+        series, dates = series[rank < limit], dates[rank < limit]
+    return series, dates
+
+def next_recurrence_dates(anchors, frequencies, intervals, after):
+    """First occurrence strictly after `after` for each series (array of datetime64[D])."""
+    anchors = np.asarray(anchors, dtype='datetime64[D]')
+    n = len(anchors)
+    starts = _as_days(after, n) + np.timedelta64(1, 'D')
+    monthly, step, _ = _recurrence_steps(anchors, frequencies, intervals)
+    # One step always fits in this span (a month step is at most 31 days)
+    ends = starts + np.where(monthly, step * 31, step).astype('timedelta64[D]')
+    series, dates = recurrence_dates(anchors, frequencies, intervals, starts, ends, limit=1)
+    result = np.full(n, np.datetime64('NaT'), dtype='datetime64[D]')
+    result[series] = dates
+    return result
+
+def next_recurrence(anchor, frequency, interval=1, after=None):
+    """Scalar helper: the first occurrence after `after` (default: the anchor) as a date."""
+    next_date = next_recurrence_dates([anchor], [frequency], [interval], after or anchor)[0]
+    return next_date.astype(object)
+
+# --- RECURRING SCHEDULER ---
+# A background sweep materializes every due occurrence of every recurring master
+# (is_recurring = 1), for all users, in batches. A lease row keeps concurrent workers
+# from sweeping at the same time, and generated rows carry recurring_parent_id under a
+# unique (recurring_parent_id, date) index, so re-running a sweep never duplicates them.
+app.config['RECURRING_SWEEP_INTERVAL'] = 3600  # Seconds between sweeps
+app.config['RECURRING_BATCH_SIZE'] = 500  # Masters per transaction
+app.config['RECURRING_LEASE_SECONDS'] = 300
+app.config['RECURRING_MAX_BACKFILL'] = 1000  # Occurrences per master per sweep
+
+RECURRING_LEASE = 'recurring_sweep'
+_lease_owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+def acquire_lease(conn, name, ttl):
+    """Takes (or renews) a named lease for this process. Returns True if we hold it."""
+    now = time.time()
+    conn.execute('''
+        INSERT INTO scheduler_leases (name, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE scheduler_leases.owner = excluded.owner OR scheduler_leases.expires_at < ?
+    ''', (name, _lease_owner, now + ttl, now))
+    conn.commit()
+    row = conn.execute('SELECT owner FROM scheduler_leases WHERE name = ?', (name,)).fetchone()
+    return row['owner'] == _lease_owner
+
+def release_lease(conn, name):
+    conn.execute('DELETE FROM scheduler_leases WHERE name = ? AND owner = ?', (name, _lease_owner))
+    conn.commit()
+
+def generate_recurring_batch(conn, masters, today):
+    """
+    Creates all due occurrences for a batch of masters and advances their next_due_date,
+    in one transaction. Returns the number of expenses created. The caller commits.
+    """
+    limit = app.config['RECURRING_MAX_BACKFILL']
+    anchors = np.array([master['date'] for master in masters], dtype='datetime64[D]')
+    frequencies = [master['frequency'] for master in masters]
+    intervals = [master['recurrence_interval'] or 1 for master in masters]
+    end_dates = np.array([master['recurrence_end_date'] or 'NaT' for master in masters], dtype='datetime64[D]')
+    today = np.datetime64(today, 'D')
+    window_ends = np.where(np.isnat(end_dates), today, np.minimum(end_dates, today))
+    starts = np.array([master['next_due_date'] for master in masters], dtype='datetime64[D]')
+
+    series, dates = recurrence_dates(anchors, frequencies, intervals, starts, window_ends, limit=limit)
+
+    # Next due date: after today, or after the last occurrence if the backfill limit cut it short
+    counts = np.bincount(series, minlength=len(masters))
+    last = np.full(len(masters), np.datetime64('NaT'), dtype='datetime64[D]')
+    last[series] = dates  # Dates ascend within a series, so the last write wins
+    after = np.where(counts >= limit, last, today)
+    next_due = next_recurrence_dates(anchors, frequencies, intervals, after)
+    # A series past its end date stops (NULL next_due_date is never due)
+    next_due[~np.isnat(end_dates) & (next_due > end_dates)] = np.datetime64('NaT')
+    updates = [(None if np.isnat(d) else str(d), master['id']) for d, master in zip(next_due, masters)]
+
+    descriptions = decrypt_many(master['description'] for master in masters)
+    occurrences = [(masters[i], descriptions[i], str(date)) for i, date in zip(series.tolist(), dates)]
+
+    # Advancing the masters first opens the write transaction, so the check below is consistent
+    conn.executemany('UPDATE expenses SET next_due_date = ? WHERE id = ?', updates)
+    existing = {
+        (row['recurring_parent_id'], row['date'])
+        for row in conn.execute(
+            '''SELECT recurring_parent_id, date FROM expenses
+               WHERE recurring_parent_id IN (SELECT value FROM json_each(?))''',
+            (json.dumps([master['id'] for master in masters]),)
+        )
+    }
+    occurrences = [o for o in occurrences if (o[0]['id'], o[2]) not in existing]
+    if not occurrences:
+        return 0
+
+    plaintexts = [f"{description} (Auto-generated)" for _, description, _ in occurrences]
+    # Each occurrence is converted at the rate in effect on its own date
+    amounts_usd = convert_series(
+        [master['amount'] for master, _, _ in occurrences],
+        [master['currency'] for master, _, _ in occurrences],
+        [date for _, _, date in occurrences]
+    ).tolist()
+    ids = insert_rows(conn, '''
+        INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date,
+                              is_recurring, frequency, next_due_date, recurring_parent_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, NULL, ?)
+    ''', [
+        (master['user_id'], master['amount'], master['currency'], amount_usd, master['category'],
+         encrypt_data(plaintext), date, master['frequency'], master['id'])
+        for (master, _, date), plaintext, amount_usd in zip(occurrences, plaintexts, amounts_usd)
+    ])
+    index_expense_descriptions(conn, [
+        (master['user_id'], expense_id, plaintext)
+        for (master, _, _), expense_id, plaintext in zip(occurrences, ids, plaintexts)
+    ], new_rows=True)
+    return len(occurrences)
+
+def run_recurring_sweep(today=None, batch_size=None):
+    """
+    Materializes due recurring expenses for all users. Returns stats, or None if another
+    worker holds the lease.
+    """
+    today = today or datetime.now().date()
+    batch_size = batch_size or app.config['RECURRING_BATCH_SIZE']
+    ttl = app.config['RECURRING_LEASE_SECONDS']
+    stats = {'masters': 0, 'created': 0, 'batches': 0}
+    conn = get_db_pool().acquire()
+    try:
+        if not acquire_lease(conn, RECURRING_LEASE, ttl):
+            return None
+        last_id = 0
+        while True:
+            masters = conn.execute('''
+                SELECT * FROM expenses
+                WHERE is_recurring = 1 AND next_due_date <= ? AND id > ?
+                ORDER BY id LIMIT ?
+            ''', (today.strftime('%Y-%m-%d'), last_id, batch_size)).fetchall()
+            if not masters:
+                break
+            try:
+                stats['created'] += generate_recurring_batch(conn, masters, today)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            stats['masters'] += len(masters)
+            stats['batches'] += 1
+            last_id = masters[-1]['id']
+            if not acquire_lease(conn, RECURRING_LEASE, ttl):  # Renew; stop if it was lost
+                break
+        release_lease(conn, RECURRING_LEASE)
+        return stats
+    finally:
+        conn.close()
+
+def start_recurring_scheduler(interval=None):
+    """Runs run_recurring_sweep every RECURRING_SWEEP_INTERVAL seconds in a daemon thread."""
+    stop_event = threading.Event()
+
+    def loop():
+        while not stop_event.is_set():
+            try:
+                stats = run_recurring_sweep()
+                if stats and stats['created']:
+                    print(f"Recurring sweep: created {stats['created']} expense(s) from {stats['masters']} master(s).")
+            except Exception as e:
+                print(f"Recurring sweep failed: {e}")
+            stop_event.wait(interval or app.config['RECURRING_SWEEP_INTERVAL'])
+
+    thread = threading.Thread(target=loop, name='recurring-scheduler', daemon=True)
+    thread.start()
+    return thread, stop_event
+
+# --- ANALYTICS HELPERS ---
+def budget_period_starts(now=None):
+    """Returns the current period start date (YYYY-MM-DD) for each budget period."""
+    now = now or datetime.now()
+    return {
+        'weekly': (now - timedelta(days=now.weekday())).strftime('%Y-%m-%d'),
+        'monthly': now.replace(day=1).strftime('%Y-%m-%d'),
+        'yearly': now.replace(month=1, day=1).strftime('%Y-%m-%d'),
+    }
+
+def get_display_spending(conn, user_id, ctx, end_date=None, now=None):
+    """
+    Returns {period: {category: spent}} in ctx.currency for the current weekly, monthly and
+    yearly periods, from one grouped scan of the rollup since the earliest period start.
+    Unknown periods fall back to 'yearly' in the views.
+    """
+    starts = budget_period_starts(now)
+    columns = ', '.join(f'SUM(CASE WHEN s.date >= :{period} THEN {{amount}} ELSE 0 END)' for period in starts)
+    rows = ctx.query_rollup(conn, user_id, f's.category, {columns}', since=min(starts.values()),
+                            until=end_date, group_by='s.category', **starts)
+    return {
+        period: {row[0]: round(row[i + 1], 2) for row in rows}
+        for i, period in enumerate(starts)
+    }
+
+def get_display_totals(conn, user_id, ctx, month_start):
+    """Returns (all_time, this_month) spending in ctx.currency from the daily_spend_native rollup."""
+    total, this_month = ctx.query_rollup(
+        conn, user_id,
+        'COALESCE(SUM({amount}), 0), COALESCE(SUM(CASE WHEN s.date >= :month_start THEN {amount} END), 0)',
+        month_start=month_start
+    )[0]
+    return round(total, 2), round(this_month, 2)
+
+def aggregate_analytics(conn, user_id, start_date, end_date, days_count, ctx=None):
+    """
+    Computes the range-dependent analytics series from two grouped scans of the daily_spend_native
+    rollup: one per day (trend, heat map, patterns and the 30-day forecast window) and one per
+    category (this range and the previous period of the same length), so the query count does not
+    grow with the range. Both convert with the same dated rates into ctx.currency (USD without a
+    context), so every series adds up to the same total.
+    """
+    ctx = ctx or CurrencyContext('USD')
+    start = start_date.strftime('%Y-%m-%d')
+    end = end_date.strftime('%Y-%m-%d')
+    prev_start = (start_date - timedelta(days=days_count)).strftime('%Y-%m-%d')
+    prev_end = (start_date - timedelta(days=1)).strftime('%Y-%m-%d')
+    forecast_start = (end_date - timedelta(days=29)).strftime('%Y-%m-%d')
+
+    daily_rows = ctx.query_rollup(
+        conn, user_id,
+        '''s.date, CAST(strftime('%w', s.date) AS INTEGER) AS weekday,
+           SUM({amount}) AS amount, SUM(s.txn_count) AS txn_count''',
+        since=min(start, forecast_start), until=end, group_by='s.date'
+    )
+    category_rows = ctx.query_rollup(
+        conn, user_id,
+        '''s.category, SUM(CASE WHEN s.date >= :start THEN {amount} END) AS current,
+           SUM(CASE WHEN s.date <= :prev_end THEN {amount} END) AS previous''',
+        since=prev_start, until=end, group_by='s.category', start=start, prev_end=prev_end
+    )
+
+    daily_totals = {}
+    forecast_totals = {}
+    heatmap = [0.0] * 7  # Sun-Sat
+    weekend = 0.0
+    weekday = 0.0
+    total = 0.0
+    total_transactions = 0
+
+    for row in daily_rows:
+        date, amount = row['date'], row['amount']
+        if date >= forecast_start:
+            forecast_totals[date] = amount
+        if date >= start:
+            daily_totals[date] = amount
+            total += amount
+            total_transactions += row['txn_count']
+            # Unparseable dates have no weekday, so they count towards neither bucket
+            if row['weekday'] is not None:
+                heatmap[row['weekday']] += amount
+                if row['weekday'] in (0, 6):
+                    weekend += amount
+                else:
+                    weekday += amount
+
+    days = [start_date + timedelta(days=i) for i in range(days_count)]
+    return {
+        'days': days,
+        'daily_totals': [daily_totals.get(day.strftime('%Y-%m-%d'), 0) for day in days],
+        'category_totals': sorted((row['category'], row['current']) for row in category_rows if row['current'] is not None),
+        'prev_category_totals': {row['category']: row['previous'] for row in category_rows if row['previous'] is not None},
+        'heatmap': heatmap,
+        'weekend': weekend,
+        'weekday': weekday,
+        'total_transactions': total_transactions,
+        'avg_expense': total / total_transactions if total_transactions else 0,
+        'forecast_daily_totals': list(forecast_totals.values()),
+    }
+
+def get_period_comparison(conn, user_id, now=None, ctx=None):
+    """
+    Returns month-over-month and year-over-year totals in ctx.currency (USD without a
+    context) with one grouped scan of the rollup since the start of last year.
+    """
+    ctx = ctx or CurrencyContext('USD')
+    now = now or datetime.now()
+    current_month_start = now.replace(day=1)
+    last_month_end = current_month_start - timedelta(days=1)
+    last_month_start = last_month_end.replace(day=1)
+    bounds = {
+        'current_month': (current_month_start.strftime('%Y-%m-%d'), now.strftime('%Y-%m-%d')),
+        'last_month': (last_month_start.strftime('%Y-%m-%d'), last_month_end.strftime('%Y-%m-%d')),
+        'current_year': (f'{now.year}-01-01', f'{now.year}-12-31'),
+        'last_year': (f'{now.year - 1}-01-01', f'{now.year - 1}-12-31'),
+    }
+    params = {}
+    for name, (first, last) in bounds.items():
+        params[f'{name}_first'], params[f'{name}_last'] = first, last
+    columns = ', '.join(
+        f'COALESCE(SUM(CASE WHEN s.date BETWEEN :{name}_first AND :{name}_last THEN {{amount}} END), 0)'
+        for name in bounds
+    )
+    row = ctx.query_rollup(conn, user_id, columns, since=bounds['last_year'][0], **params)[0]
+    return dict(zip(bounds, row))
+
+# --- PAGINATION HELPERS ---
+app.config['EXPENSES_PAGE_SIZE'] = 50
+app.config['EXPENSES_MAX_PAGE_SIZE'] = 500
+
+def encode_cursor(date, expense_id):
+    """Encodes a (date, id) keyset position as an opaque URL-safe token."""
+    return base64.urlsafe_b64encode(json.dumps([date, expense_id]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decodes a cursor from encode_cursor(). Raises ValueError if it is malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        date, expense_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(date, str) or not isinstance(expense_id, int):
+        raise ValueError('Invalid cursor')
+    return date, expense_id
+
+def get_page_size(value):
+    """Parses a page-size parameter, clamped to 1..EXPENSES_MAX_PAGE_SIZE."""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return app.config['EXPENSES_PAGE_SIZE']
+    return max(1, min(size, app.config['EXPENSES_MAX_PAGE_SIZE']))
+
+def fetch_expense_page(conn, user_id, limit, after=None, before=None):
+    """
+    Returns (rows, next_cursor, prev_cursor) for one page of a user's expenses ordered
+    by (date DESC, id DESC). `after` continues past a next_cursor, `before` goes back
+    from a prev_cursor. Seeks on idx_expenses_user_date, so cost does not depend on
+    how deep the page is.
+    """
+    if before:
+        date, expense_id = decode_cursor(before)
+        rows = conn.execute(
+            '''SELECT * FROM expenses WHERE user_id = ? AND (date, id) > (?, ?)
+               ORDER BY date ASC, id ASC LIMIT ?''',
+            (user_id, date, expense_id, limit + 1)
+        ).fetchall()
+        has_prev = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        has_next = bool(rows)
+    else:
+        query = 'SELECT * FROM expenses WHERE user_id = ?'
+        params = [user_id]
+        if after:
+            date, expense_id = decode_cursor(after)
+            query += ' AND (date, id) < (?, ?)'
+            params += [date, expense_id]
+        query += ' ORDER BY date DESC, id DESC LIMIT ?'
+        params.append(limit + 1)
+        rows = conn.execute(query, params).fetchall()
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        has_prev = bool(after and rows)
+
+    next_cursor = encode_cursor(rows[-1]['date'], rows[-1]['id']) if has_next else None
+    prev_cursor = encode_cursor(rows[0]['date'], rows[0]['id']) if has_prev else None
+    return rows, next_cursor, prev_cursor
+
+# --- SEARCH INDEX HELPERS ---
+# Descriptions are encrypted, so keyword search uses a blind index: for every
+# character trigram of the lower-cased description we store a keyed HMAC token
+# (salted per user). A keyword matches only rows holding all of its trigram
+# tokens, so filtering happens in SQL and only candidate rows get decrypted.
+SEARCH_NGRAM = 3
+
+def description_trigrams(text):
+    """Returns the set of lower-cased character trigrams in text."""
+    text = (text or '').lower()
+    return {text[i:i + SEARCH_NGRAM] for i in range(len(text) - SEARCH_NGRAM + 1)}
+
+@lru_cache(maxsize=65536)  # A user's trigram vocabulary is small and repeats across rows
+def blind_token(user_id, trigram):
+    """Keyed HMAC of a trigram, truncated to a signed 64-bit integer for compact storage."""
+    digest = hmac.digest(search_key, f'{user_id}:{trigram}'.encode(), 'sha256')
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+def normalize_description(text):
+    return ' '.join((text or '').lower().split())
+
+def expense_fingerprint(user_id, date, amount, currency, description):
+    """
+    Keyed hash of an expense's content (date, amount, currency and normalized description),
+    so re-imported rows can be matched without decrypting anything.
+    """
+    content = f"{user_id}|{date}|{float(amount):.2f}|{(currency or 'USD').upper()}|{normalize_description(description)}"
+    digest = hmac.digest(search_key, content.encode(), 'sha256')
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+def refresh_expense_fingerprints(conn, entries, new_rows=False):
+    """Recomputes fingerprints for (expense_id, plaintext) entries from their stored columns. The caller commits."""
+    plaintexts = dict(entries)
+    rows = conn.execute(
+        'SELECT id, user_id, date, amount, currency FROM expenses WHERE id IN (SELECT value FROM json_each(?))',
+        (json.dumps(list(plaintexts)),)
+    ).fetchall()
+    if not new_rows:
+        conn.executemany('DELETE FROM expense_fingerprints WHERE expense_id = ?', [(expense_id,) for expense_id in plaintexts])
+    conn.executemany(
+        'INSERT OR IGNORE INTO expense_fingerprints (user_id, fingerprint, expense_id) VALUES (?, ?, ?)',
+        [
+            (row['user_id'], expense_fingerprint(row['user_id'], row['date'], row['amount'], row['currency'],
+                                                 plaintexts[row['id']]), row['id'])
+            for row in rows
+        ]
+    )
+
+def find_duplicate_expenses(conn, user_id, fingerprints, max_id):
+    """
+    Returns {fingerprint: [expense_id, ...]} for fingerprints already present among the
+    user's expenses with id <= max_id, in a single set-membership query.
+    """
+    rows = conn.execute(
+        '''SELECT fingerprint, expense_id FROM expense_fingerprints
+           WHERE user_id = ? AND expense_id <= ? AND fingerprint IN (SELECT value FROM json_each(?))
+           ORDER BY fingerprint, expense_id''',
+        (user_id, max_id, json.dumps(list(set(fingerprints))))
+    ).fetchall()
+    matches = {}
+    for fingerprint, expense_id in rows:
+        matches.setdefault(fingerprint, []).append(expense_id)
+    return matches
+
+def index_expense_descriptions(conn, entries, new_rows=False, fingerprints=True):
+    """
+    (Re)indexes descriptions (blind keyword tokens and content fingerprints).
+    `entries` is an iterable of (user_id, expense_id, plaintext). Pass new_rows=True for
+    freshly inserted expenses to skip clearing old entries. The caller commits.
+    """
+    entries = list(entries)
+    if fingerprints:
+        refresh_expense_fingerprints(conn, [(expense_id, plaintext) for _, expense_id, plaintext in entries], new_rows)
+    if not new_rows:
+        conn.executemany('DELETE FROM expense_search_tokens WHERE expense_id = ?',
+                         [(expense_id,) for _, expense_id, _ in entries])
+    # Inserting in primary-key order keeps B-tree writes sequential for large batches
+    conn.executemany(
+        'INSERT OR IGNORE INTO expense_search_tokens (user_id, token, expense_id) VALUES (?, ?, ?)',
+        sorted(
+            (user_id, blind_token(user_id, trigram), expense_id)
+            for user_id, expense_id, plaintext in entries
+            for trigram in description_trigrams(plaintext)
+        )
+    )
+
+def index_expense_description(conn, user_id, expense_id, plaintext):
+    index_expense_descriptions(conn, [(user_id, expense_id, plaintext)])
+
+def rebuild_search_index(conn, user_id=None, chunk_size=1000):
+    """Rebuilds the blind index and fingerprints from the expenses table, decrypting in id-ordered chunks."""
+    if user_id is None:
+        conn.execute('DELETE FROM expense_search_tokens')
+    else:
+        conn.execute('DELETE FROM expense_search_tokens WHERE user_id = ?', (user_id,))
+    last_id = 0
+    while True:
+        query = 'SELECT id, user_id, description FROM expenses WHERE id > ?'
+        params = [last_id]
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            params.append(user_id)
+        rows = conn.execute(query + ' ORDER BY id LIMIT ?', params + [chunk_size]).fetchall()
+        if not rows:
+            break
+        plaintexts = decrypt_many(row['description'] for row in rows)
+        index_expense_descriptions(conn, [
+            (row['user_id'], row['id'], plaintext) for row, plaintext in zip(rows, plaintexts)
+        ])
+        last_id = rows[-1]['id']
+
+def keyword_filter_clause(user_id, keyword):
+    """
+    Returns (sql, params) restricting expenses to rows whose description may contain
+    keyword, or None when the keyword is too short to use the index.
+    """
+    trigrams = description_trigrams(keyword)
+    if not trigrams:
+        return None
+    tokens = sorted({blind_token(user_id, trigram) for trigram in trigrams})
+    placeholders = ','.join(['?'] * len(tokens))
+    sql = f''' AND id IN (
+        SELECT expense_id FROM expense_search_tokens
+        WHERE user_id = ? AND token IN ({placeholders})
+        GROUP BY expense_id HAVING COUNT(*) = ?)'''
+    return sql, [user_id, *tokens, len(tokens)]
+
+def search_expense_page(conn, query, params, keyword, limit, offset=0):
+    """
+    Runs a search query and returns (matches, next_offset). Rows are decrypted in
+    fetch order only until the page is full; the keyword is re-checked on the
+    plaintext because the index may return (rare) false positives.
+    """
+    matches = []
+    consumed = 0
+    # The cursor steps through the result lazily; each batch asks only for the rows
+    # still missing from the page, so nothing past the page is read or decrypted
+    cursor = conn.execute(f'{query} LIMIT -1 OFFSET ?', [*params, offset])
+    while len(matches) < limit:
+        rows = cursor.fetchmany(limit - len(matches))
+        if not rows:
+            return matches, None
+        consumed += len(rows)
+        for row, plaintext in zip(rows, decrypt_many(row['description'] for row in rows)):
+            if not keyword or keyword in plaintext.lower():
+                exp = dict(row)
+                exp['description'] = plaintext
+                matches.append(exp)
+    has_more = cursor.fetchone() is not None
+    return matches, (offset + consumed if has_more else None)
+
+# --- KEY ROTATION / RE-ENCRYPTION ---
+# Walks expenses in id order, re-encrypting descriptions with the primary key and
+# encrypting legacy plaintext. Every chunk commits its updates together with the
+# job checkpoint, so the job can be stopped at any point and resumed.
+REENCRYPT_JOB = 'reencrypt_descriptions'
+app.config['REENCRYPT_CHUNK_SIZE'] = 500
+app.config['REENCRYPT_PAUSE'] = 0.05  # Minimum seconds between chunks
+
+def get_maintenance_job(conn, name):
+    row = conn.execute('SELECT * FROM maintenance_jobs WHERE name = ?', (name,)).fetchone()
+    return dict(row) if row else None
+
+def reset_reencryption_job(conn):
+    """Schedules a fresh pass over all expenses (e.g. after a key rotation). The caller commits."""
+    conn.execute('''
+        INSERT OR REPLACE INTO maintenance_jobs (name, status, last_id, target_id, processed, updated, updated_at)
+        VALUES (?, 'pending', 0, 0, 0, 0, ?)
+    ''', (REENCRYPT_JOB, datetime.now().isoformat()))
+
+def reencrypt_descriptions(rows):
+    """Returns (new_description, id, old_description) updates for rows not yet on the primary key."""
+    updates = []
+    for row in rows:
+        description = row['description']
+        if not description:
+            continue
+        if looks_encrypted(description):
+            try:
+                primary_cipher.decrypt(description.encode())
+                continue  # Already on the primary key
+            except InvalidToken:
+                pass
+            try:
+                new_description = cipher_suite.rotate(description.encode()).decode()
+            except InvalidToken:
+                new_description = encrypt_data(description)  # Token-shaped legacy text
+        else:
+            new_description = encrypt_data(description)
+        updates.append((new_description, row['id'], description))
+    return updates
+
+def run_reencryption_job(chunk_size=None, pause=None, max_chunks=None, progress=None, stop_event=None):
+    """
+    Runs (or resumes) the re-encryption job and returns its final state.
+    Connections are taken from the pool per chunk and every chunk is followed by a pause
+    at least as long as the chunk itself, so foreground requests keep most of the write lock.
+    The WHERE clause on the old description skips rows a user edited mid-chunk.
+    """
+    chunk_size = chunk_size or app.config['REENCRYPT_CHUNK_SIZE']
+    pause = app.config['REENCRYPT_PAUSE'] if pause is None else pause
+    pool = get_db_pool()
+
+    conn = pool.acquire()
+    try:
+        job = get_maintenance_job(conn, REENCRYPT_JOB)
+        if job is None or job['status'] == 'completed':
+            reset_reencryption_job(conn)
+            job = get_maintenance_job(conn, REENCRYPT_JOB)
+        if job['status'] == 'pending':
+            # Rows added later are re-scanned before the job completes (see below)
+            target_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM expenses').fetchone()[0]
+            conn.execute(
+                "UPDATE maintenance_jobs SET status = 'running', target_id = ?, started_at = ? WHERE name = ?",
+                (target_id, datetime.now().isoformat(), REENCRYPT_JOB)
+            )
+        conn.commit()
+        job = get_maintenance_job(conn, REENCRYPT_JOB)
+    finally:
+        conn.close()
+
+    chunks = 0
+    while not (stop_event and stop_event.is_set()):
+        started = time.perf_counter()
+        conn = pool.acquire()
+        try:
+            rows = conn.execute(
+                'SELECT id, description FROM expenses WHERE id > ? AND id <= ? ORDER BY id LIMIT ?',
+                (job['last_id'], job['target_id'], chunk_size)
+            ).fetchall()
+            if not rows:
+                # A worker that had not yet reloaded the ring may have inserted rows with an old
+                # key after target_id was fixed, so extend the range over them before finishing
+                max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM expenses').fetchone()[0]
+                if max_id > job['target_id']:
+                    conn.execute('UPDATE maintenance_jobs SET target_id = ?, updated_at = ? WHERE name = ?',
+                                 (max_id, datetime.now().isoformat(), REENCRYPT_JOB))
+                    conn.commit()
+                    job = get_maintenance_job(conn, REENCRYPT_JOB)
+                    continue
+                conn.execute(
+                    "UPDATE maintenance_jobs SET status = 'completed', updated_at = ? WHERE name = ?",
+                    (datetime.now().isoformat(), REENCRYPT_JOB)
+                )
+                conn.commit()
+                job = get_maintenance_job(conn, REENCRYPT_JOB)
+                break
+            reload_keyring_if_changed()
+            updates = reencrypt_descriptions(rows)
+            conn.executemany('UPDATE expenses SET description = ? WHERE id = ? AND description = ?', updates)
+            conn.execute(
+                '''UPDATE maintenance_jobs SET last_id = ?, processed = processed + ?, updated = updated + ?, updated_at = ?
+                   WHERE name = ?''',
+                (rows[-1]['id'], len(rows), len(updates), datetime.now().isoformat(), REENCRYPT_JOB)
+            )
+            conn.commit()
+            job = get_maintenance_job(conn, REENCRYPT_JOB)
+        finally:
+            conn.close()
+
+        if progress:
+            progress(job)
+        chunks += 1
+        if max_chunks and chunks >= max_chunks:
+            break
+        time.sleep(max(pause, time.perf_counter() - started))
+    return job
+
+def count_rows_on_old_keys(conn, chunk_size=None):
+    """Counts descriptions that only a non-primary key of the ring can decrypt."""
+    chunk_size = chunk_size or app.config['REENCRYPT_CHUNK_SIZE']
+    reload_keyring_if_changed()
+    count, last_id = 0, 0
+    while True:
+        rows = conn.execute('SELECT id, description FROM expenses WHERE id > ? ORDER BY id LIMIT ?',
+                            (last_id, chunk_size)).fetchall()
+        if not rows:
+            return count
+        for row in rows:
+            token = row['description']
+            if not token or not looks_encrypted(token):
+                continue
+            try:
+                primary_cipher.decrypt(token.encode())
+                continue
+            except InvalidToken:
+                pass
+            try:
+                cipher_suite.decrypt(token.encode())
+                count += 1
+            except InvalidToken:
+                pass  # Token-shaped legacy text, readable with any ring
+        last_id = rows[-1]['id']
+
+def start_reencryption_job(**kwargs):
+    """Runs the re-encryption job in a daemon thread. Returns (thread, stop_event)."""
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=run_reencryption_job, kwargs={**kwargs, 'stop_event': stop_event},
+        name='reencrypt', daemon=True
+    )
+    thread.start()
+    return thread, stop_event
+
+# --- EXPORT HELPERS ---
+# Exports iterate the cursor in chunks, so memory is bounded by EXPORT_CHUNK_SIZE rows
+# rather than the size of the user's history.
+app.config['EXPORT_CHUNK_SIZE'] = 1000
+
+EXPORT_QUERIES = {
+    'expenses': 'SELECT date, category, description, amount, currency, amount_usd FROM expenses WHERE user_id = ? ORDER BY date DESC, id DESC',
+    'budgets': 'SELECT category, amount, currency, amount_usd, period, start_date FROM budgets WHERE user_id = ? ORDER BY category',
+}
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def iter_export_rows(conn, data_type, user_id, chunk_size=None):
+    """
+    Returns (columns, chunks) for an export. chunks lazily yields lists of row tuples
+    with descriptions decrypted a chunk at a time.
+    """
+    chunk_size = chunk_size or app.config['EXPORT_CHUNK_SIZE']
+    cursor = conn.execute(EXPORT_QUERIES[data_type], (user_id,))
+    columns = [col[0] for col in cursor.description]
+    desc_idx = columns.index('description') if 'description' in columns else None
+
+    def chunks():
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            rows = [tuple(row) for row in rows]
+            if desc_idx is not None:
+                plain = decrypt_many([row[desc_idx] for row in rows])
+                rows = [row[:desc_idx] + (text,) + row[desc_idx + 1:] for row, text in zip(rows, plain)]
+            yield rows
+
+    return columns, chunks()
+
+def csv_chunks(columns, chunks):
+    """Yields CSV text one chunk of rows at a time (header first)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+def write_xlsx(fileobj, sheet_name, columns, chunks):
+    """Writes rows with openpyxl's write-only mode, which streams cells instead of keeping a sheet in memory."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(sheet_name)
+    sheet.append(columns)
+    for rows in chunks:
+        for row in rows:
+            sheet.append(row)
+    workbook.save(fileobj)
+
+def write_pdf(fileobj, title, columns, chunks):
+    """Renders rows as an HTML table through xhtml2pdf. Returns the pisa error count (0 on success)."""
+    body_rows = []
+    for rows in chunks:
+        body_rows.extend('<tr>' + ''.join(f'<td>{escape(val)}</td>' for val in row) + '</tr>' for row in rows)
+
+    # Simple HTML Template for PDF
+    html_content = f"""
+    <html>
+    <head>
+        <style>
+            body {{ font-family: Helvetica, sans-serif; }}
+            table {{ width: 100%; border-collapse: collapse; }}
+            th, td {{ padding: 8px; text-align: left; border-bottom: 1px solid #ddd; }}
+            th {{ background-color: #f2f2f2; }}
+            h2 {{ color: #333; }}
+        </style>
+    </head>
+    <body>
+        <h2>{title}</h2>
+        <p>Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+        <table>
+            <thead>
+                <tr>
+                    {''.join([f'<th>{col}</th>' for col in columns])}
+                </tr>
+            </thead>
+            <tbody>
+                {''.join(body_rows)}
+            </tbody>
+        </table>
+    </body>
+    </html>
+    """
+    return pisa.CreatePDF(src=html_content, dest=fileobj).err
+
+# --- EXPORT JOBS ---
+# Exports run on a small local worker pool so slow renders (PDF especially) never hold
+# a web worker. Finished files live in EXPORT_DIR and are removed after EXPORT_TTL.
+app.config['EXPORT_DIR'] = 'exports'
+app.config['EXPORT_WORKERS'] = 2
+app.config['EXPORT_TTL'] = 3600  # Seconds a finished artifact stays downloadable
+# Each job is owned by the process that queued it, which renews the job's heartbeat while it
+# lives. At startup, queued/running jobs of another process whose heartbeat is older than
+# EXPORT_LEASE_SECONDS were lost with it: they are marked failed and their partial files removed.
+app.config['EXPORT_LEASE_SECONDS'] = 120
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': XLSX_MIMETYPE,
+    'pdf': 'application/pdf',
+}
+
+_export_executor = None
+_export_executor_lock = threading.Lock()
+
+def _get_export_executor():
+    global _export_executor
+    with _export_executor_lock:
+        if _export_executor is None:
+            _export_executor = ThreadPoolExecutor(
+                max_workers=app.config['EXPORT_WORKERS'], thread_name_prefix='export'
+            )
+        return _export_executor
+
+def export_job_dict(job):
+    """Public view of an export job row (no file path)."""
+    progress = job['rows_done'] / job['total_rows'] * 100 if job['total_rows'] else (100.0 if job['status'] == 'completed' else 0.0)
+    return {
+        'id': job['id'],
+        'data_type': job['data_type'],
+        'format': job['format'],
+        'status': job['status'],
+        'progress': round(progress, 1),
+        'rows_done': job['rows_done'],
+        'total_rows': job['total_rows'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+        'expires_at': job['expires_at'],
+    }
+
+def submit_export_job(conn, user_id, data_type, format):
+    """Queues an export and returns its job id. Raises ValueError for unknown types/formats."""
+    if data_type not in EXPORT_QUERIES or format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export: {data_type}/{format}")
+    cleanup_expired_exports(conn)
+    job_id = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    conn.execute(
+        """INSERT INTO export_jobs (id, user_id, data_type, format, status, created_at, updated_at, claimed_by, heartbeat_at)
+           VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)""",
+        (job_id, user_id, data_type, format, now, now, _lease_owner, time.time())
+    )
+    conn.commit()
+    _get_export_executor().submit(run_export_job, job_id)
+    return job_id
+
+def run_export_job(job_id):
+    """Worker entry point: renders the artifact to disk, recording progress per chunk."""
+    pool = get_db_pool()
+    conn = pool.acquire()
+    path = None
+    try:
+        job = conn.execute('SELECT * FROM export_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None or job['status'] != 'queued':
+            return
+        count_sql = f"SELECT COUNT(*) FROM ({EXPORT_QUERIES[job['data_type']]})"
+        total = conn.execute(count_sql, (job['user_id'],)).fetchone()[0]
+        os.makedirs(app.config['EXPORT_DIR'], exist_ok=True)
+        path = os.path.join(app.config['EXPORT_DIR'], f"{job_id}.{job['format']}")
+        # The path is recorded up front so an orphaned job's partial file can be found and removed
+        started = conn.execute(
+            """UPDATE export_jobs SET status = 'running', total_rows = ?, file_path = ?, updated_at = ?, heartbeat_at = ?
+               WHERE id = ? AND status = 'queued' AND claimed_by = ?""",
+            (total, path, datetime.now().isoformat(), time.time(), job_id, _lease_owner)
+        ).rowcount
+        conn.commit()
+        if not started:
+            path = None
+            return
+
+        # Progress writes use a second pooled connection so the export's read cursor stays open
+        progress_conn = pool.acquire()
+        try:
+            def tracked(chunks):
+                done = 0
+                for rows in chunks:
+                    yield rows
+                    done += len(rows)
+                    progress_conn.execute(
+                        'UPDATE export_jobs SET rows_done = ?, updated_at = ?, heartbeat_at = ? WHERE id = ? AND claimed_by = ?',
+                        (done, datetime.now().isoformat(), time.time(), job_id, _lease_owner)
+                    )
+                    progress_conn.commit()
+
+            columns, chunks = iter_export_rows(conn, job['data_type'], job['user_id'])
+            with open(path, 'w' if job['format'] == 'csv' else 'wb', newline='' if job['format'] == 'csv' else None) as output:
+                if job['format'] == 'csv':
+                    for part in csv_chunks(columns, tracked(chunks)):
+                        output.write(part)
+                elif job['format'] == 'xlsx':
+                    write_xlsx(output, job['data_type'].capitalize(), columns, tracked(chunks))
+                else:
+                    err = write_pdf(output, f"{job['data_type'].capitalize()} Report", columns, tracked(chunks))
+                    if err:
+                        raise RuntimeError(f"PDF generation error: {err}")
+        finally:
+            progress_conn.close()
+
+        finished = datetime.now()
+        completed = conn.execute(
+            """UPDATE export_jobs SET status = 'completed', finished_at = ?, expires_at = ?, updated_at = ?
+               WHERE id = ? AND status = 'running' AND claimed_by = ?""",
+            (finished.isoformat(), (finished + timedelta(seconds=app.config['EXPORT_TTL'])).isoformat(),
+             finished.isoformat(), job_id, _lease_owner)
+        ).rowcount
+        conn.commit()
+        if not completed and os.path.exists(path):  # Declared orphaned while rendering; the job already reports failure
+            os.remove(path)
+    except Exception as e:
+        conn.rollback()
+        if path and os.path.exists(path):
+            os.remove(path)
+        conn.execute(
+            "UPDATE export_jobs SET status = 'failed', error = ?, finished_at = ?, updated_at = ? WHERE id = ?",
+            (str(e), datetime.now().isoformat(), datetime.now().isoformat(), job_id)
+        )
+        conn.commit()
+        print(f"Export job {job_id} failed: {e}")
+    finally:
+        conn.close()
 
-# --- CURRENCY HELPERS ---
-def _fetch_usd_rates():
+def fail_orphaned_exports(conn):
+    """
+    Marks queued/running jobs owned by another process whose heartbeat is older than
+    EXPORT_LEASE_SECONDS as failed and deletes their partial files: the executor queue died
+    with that process, so they never finish. Returns how many jobs were failed.
+    """
+    now = datetime.now()
+    params = {'owner': _lease_owner, 'cutoff': time.time() - app.config['EXPORT_LEASE_SECONDS']}
+    orphaned_sql = ("status IN ('queued', 'running') AND claimed_by IS NOT :owner "
+                    "AND (heartbeat_at IS NULL OR heartbeat_at < :cutoff)")
+    orphaned = conn.execute(f'SELECT id, file_path FROM export_jobs WHERE {orphaned_sql}', params).fetchall()
+    failed = []
+    for job in orphaned:
+        # Re-checked per job, so one whose owner heartbeated since the SELECT is left alone
+        if conn.execute(
+            f"""UPDATE export_jobs SET status = 'failed', error = 'Interrupted by a restart; please export again.',
+                file_path = NULL, finished_at = :now, updated_at = :now WHERE id = :id AND {orphaned_sql}""",
+            {**params, 'now': now.isoformat(), 'id': job['id']}
+        ).rowcount:
+            failed.append(job)
+    conn.commit()
+    for job in failed:
+        if job['file_path'] and os.path.exists(job['file_path']):
+            os.remove(job['file_path'])
+    return len(failed)
+
+def recover_export_jobs():
+    """Startup hook: fails export jobs orphaned by a server process that is gone."""
+    conn = get_db_pool().acquire()
     try:
-        url = "https://api.exchangerate-api.com/v4/latest/USD"
-        response = requests.get(url, timeout=5)
-        data = response.json()
-        if "rates" not in data:
-            raise ValueError(f"Invalid API response: {data}")
-        return data["rates"]
-    except Exception as e:
-        print(f"Rate fetch error: {e}")
-        return {}
-
-def get_usd_rate(currency):
-    if currency == "USD":
-        return 1.0
-    
-    now = time.time()
-    if not _RATES_CACHE["rates"] or now - _RATES_CACHE["timestamp"] > CACHE_TTL:
-        _RATES_CACHE["rates"] = _fetch_usd_rates()
-        _RATES_CACHE["timestamp"] = now
-    
-    rates = _RATES_CACHE["rates"]
-    return float(rates.get(currency, 1.0))
+        failed = fail_orphaned_exports(conn)
+        if failed:
+            print(f"Marked {failed} interrupted export job(s) as failed.")
+    except sqlite3.Error as e:
+        print(f"Export recovery failed: {e}")
+    finally:
+        conn.close()
 
-def convert_to_usd(amount, currency):
-    rate = get_usd_rate(currency)
-    return round(amount / rate, 2)
+def renew_export_heartbeats(conn):
+    """Renews the heartbeat of this process's queued and running jobs (a long PDF render makes no progress). Returns how many."""
+    renewed = conn.execute(
+        "UPDATE export_jobs SET heartbeat_at = ? WHERE claimed_by = ? AND status IN ('queued', 'running')",
+        (time.time(), _lease_owner)
+    ).rowcount
+    conn.commit()
+    return renewed
 
-def convert_from_usd(amount_usd, currency):
-    rate = get_usd_rate(currency)
-    return round(amount_usd * rate, 2)
+def start_export_heartbeat(interval=None):
+    """Calls renew_export_heartbeats three times per EXPORT_LEASE_SECONDS in a daemon thread. Returns (thread, stop_event)."""
+    stop_event = threading.Event()
 
-# --- NEW HELPER: SPLITWISE DEBT ALGORITHM ---
-def calculate_group_debts(group_id):
-    """Calculates who owes whom, handling settlements/partial payments."""
-    conn = get_db_connection()
-    
-    # 1. Get Members
-    members = conn.execute(
-        "SELECT user_id, username FROM group_members JOIN users ON users.id = group_members.user_id WHERE group_id = ?", 
-        (group_id,)
+    def loop():
+        while not stop_event.is_set():
+            conn = get_db_pool().acquire()
+            try:
+                renew_export_heartbeats(conn)
+            except Exception as e:
+                print(f"Export heartbeat failed: {e}")
+            finally:
+                conn.close()
+            stop_event.wait(interval or app.config['EXPORT_LEASE_SECONDS'] / 3)
+
+    thread = threading.Thread(target=loop, name='export-heartbeat', daemon=True)
+    thread.start()
+    return thread, stop_event
+
+def cleanup_expired_exports(conn):
+    """Deletes expired artifacts and their job rows. Returns how many jobs were removed."""
+    now = datetime.now().isoformat()
+    expired = conn.execute(
+        'SELECT id, file_path FROM export_jobs WHERE expires_at IS NOT NULL AND expires_at < ?', (now,)
     ).fetchall()
-    
-    user_map = {row['user_id']: row['username'] for row in members}
-    balances = {row['user_id']: 0.0 for row in members}
-    
-    # 2. Calculate Balances
-    expenses = conn.execute("SELECT * FROM group_expenses WHERE group_id = ?", (group_id,)).fetchall()
-    
-    for exp in expenses:
-        # HANDLE SETTLEMENTS (The "Done Box" payments)
-        if exp['description'] == 'Settlement':
-            # In a settlement, the Payer (Debtor) is paying the Split User (Creditor)
-            # We need to find who this payment was sent TO
-            splits = conn.execute("SELECT user_id FROM expense_splits WHERE expense_id = ?", (exp['id'],)).fetchall()
-            if splits:
-                receiver_id = splits[0]['user_id']
-                # Payer (Debtor) gave money, so their balance increases (becomes less negative)
-                if exp['payer_id'] in balances:
-                    balances[exp['payer_id']] += exp['amount']
-                # Receiver (Creditor) got money, so their balance decreases (becomes less positive/owed)
-                if receiver_id in balances:
-                    balances[receiver_id] -= exp['amount']
-        # HANDLE NORMAL EXPENSES
-        else:
-            # Payer gets credit (+)
-            if exp['payer_id'] in balances:
-                balances[exp['payer_id']] += exp['amount']
-            
-            # Splitters get debit (-)
-            splits = conn.execute("SELECT user_id, amount_owed FROM expense_splits WHERE expense_id = ?", (exp['id'],)).fetchall()
-            for split in splits:
-                if split['user_id'] in balances:
-                    balances[split['user_id']] -= split['amount_owed']
-    
-    # 3. Minimize Transactions
-    debtors = []
-    creditors = []
-    for uid, amount in balances.items():
-        if amount < -0.01: 
-            debtors.append({'id': uid, 'amount': amount})
-        if amount > 0.01: 
-            creditors.append({'id': uid, 'amount': amount})
-    
-    debtors.sort(key=lambda x: x['amount'])
-    creditors.sort(key=lambda x: x['amount'], reverse=True)
-    
-    transactions = []
-    d_idx = 0
-    c_idx = 0
-    
-    while d_idx < len(debtors) and c_idx < len(creditors):
-        debtor = debtors[d_idx]
-        creditor = creditors[c_idx]
-        amount = min(abs(debtor['amount']), creditor['amount'])
-        
-        transactions.append({
-            'from_id': debtor['id'],
-            'to_id': creditor['id'],
-            'from': user_map.get(debtor['id'], 'Unknown'),
-            'to': user_map.get(creditor['id'], 'Unknown'),
-            'amount': round(amount, 2)
-        })
-        
-        debtor['amount'] += amount
-        creditor['amount'] -= amount
-        
-        if abs(debtor['amount']) < 0.01: 
-            d_idx += 1
-        if creditor['amount'] < 0.01: 
-            c_idx += 1
-    
-    conn.close()
-    return transactions
+    # Failed jobs have no artifact; keep them for one TTL so the client can read the error
+    failed_cutoff = (datetime.now() - timedelta(seconds=app.config['EXPORT_TTL'])).isoformat()
+    expired += conn.execute(
+        "SELECT id, file_path FROM export_jobs WHERE status = 'failed' AND finished_at < ?", (failed_cutoff,)
+    ).fetchall()
+    for job in expired:
+        if job['file_path'] and os.path.exists(job['file_path']):
+            os.remove(job['file_path'])
+    conn.executemany('DELETE FROM export_jobs WHERE id = ?', [(job['id'],) for job in expired])
+    conn.commit()
+    return len(expired)
+
+# --- IMPORT PIPELINE ---
+# CSV imports are read in chunks; mapping, currency conversion and date normalization
+# are vectorized per chunk and each chunk is inserted with executemany in its own transaction.
+app.config['IMPORT_DIR'] = 'imports'
+app.config['IMPORT_CHUNK_SIZE'] = 5000
+
+# Duplicate policies: skip the row, insert it flagged with duplicate_of, merge it into
+# the existing expense, or allow it through unchecked
+DUPLICATE_ACTIONS = {
+    'skip': 'skipped',
+    'flag': 'flagged',
+    'merge': 'merged',
+    'allow': 'allowed',
+}
 
-# --- CATEGORY HELPERS ---
-def get_user_categories(user_id):
-    """Get all categories for a user, including default categories if none exist"""
-    conn = get_db_connection()
-    custom_categories = conn.execute(
-        'SELECT * FROM categories WHERE user_id = ? ORDER BY name',
-        (user_id,)
+IMPORT_DEFAULTS = {
+    'currency': 'USD',
+    'category': 'Miscellaneous',
+    'description': '',
+}
+
+def parse_import_dates(values):
+    """Parses a raw date column. Returns (YYYY-MM-DD strings, NaN where blank; mask of non-blank values that are not dates)."""
+    parsed = pd.to_datetime(values, errors='coerce', format='mixed')
+    blank = values.isna() | (values.astype(str).str.strip() == '')
+    return parsed.dt.strftime('%Y-%m-%d'), parsed.isna() & ~blank
+
+def prepare_import_chunk(df, mapping, today=None):
+    """
+    Maps a raw CSV chunk onto expense columns. Returns (prepared, rejected) where rejected
+    holds the raw rows whose amount is not a number, whose date cannot be parsed or whose
+    currency has no exchange rate. Blank dates default to today.
+    """
+    today = today or datetime.now().strftime('%Y-%m-%d')
+
+    def column(df, field):
+        source = mapping.get(field)
+        if source and source in df.columns:
+            return df[source]
+        return pd.Series(IMPORT_DEFAULTS.get(field), index=df.index, dtype=object)
+
+    amount = pd.to_numeric(df[mapping['amount']], errors='coerce')
+    currency = column(df, 'currency').fillna('USD').astype(str).str.strip().str.upper()
+    if mapping.get('date') and mapping['date'] in df.columns:
+        date, bad_date = parse_import_dates(df[mapping['date']])
+        date = date.fillna(today)
+    else:
+        date, bad_date = pd.Series(today, index=df.index, dtype=object), False
+    valid = amount.notna() & ~bad_date & has_usd_rate(currency)
+    rejected = df[~valid]
+    df, amount, currency, date = df[valid], amount[valid], currency[valid], date[valid]
+
+    prepared = pd.DataFrame({
+        'amount': amount,
+        'currency': currency,
+        'amount_usd': convert_series(amount, currency, date),
+        'category': column(df, 'category').fillna('Miscellaneous').astype(str),
+        'description': column(df, 'description').fillna('').astype(str),
+        'date': date,
+    })
+    return prepared, rejected
+
+def insert_import_chunk(conn, user_id, prepared):
+    """
+    Inserts a prepared chunk and indexes its descriptions. Returns the new ids. The caller commits.
+    """
+    if prepared.empty:
+        return []
+    descriptions = prepared['description'].tolist()
+    duplicate_of = prepared['duplicate_of'].tolist() if 'duplicate_of' in prepared else itertools.repeat(None)
+    ids = insert_rows(
+        conn,
+        '''INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date, duplicate_of)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        zip(
+            itertools.repeat(user_id),
+            prepared['amount'].tolist(),
+            prepared['currency'].tolist(),
+            prepared['amount_usd'].tolist(),
+            prepared['category'].tolist(),
+            [encrypt_data(text) for text in descriptions],
+            prepared['date'].tolist(),
+            duplicate_of,
+        )
+    )
+    index_expense_descriptions(conn, zip(itertools.repeat(user_id), ids, descriptions), new_rows=True, fingerprints=False)
+    conn.executemany(
+        'INSERT OR IGNORE INTO expense_fingerprints (user_id, fingerprint, expense_id) VALUES (?, ?, ?)',
+        zip(itertools.repeat(user_id), prepared['fingerprint'].tolist(), ids)
+    )
+    return ids
+
+def merge_import_duplicates(conn, user_id, merged):
+    """
+    Updates existing expenses in place with imported category/description (merge policy).
+    Returns {expense_id: (category, encrypted description)} as they were before. The caller commits.
+    """
+    if merged.empty:
+        return {}
+    previous = {
+        row['id']: (row['category'], row['description'])
+        for row in conn.execute(
+            'SELECT id, category, description FROM expenses WHERE id IN (SELECT value FROM json_each(?))',
+            (json.dumps(merged['duplicate_of'].tolist()),)
+        )
+    }
+    conn.executemany(
+        'UPDATE expenses SET category = ?, description = ? WHERE id = ? AND user_id = ?',
+        zip(merged['category'].tolist(), [encrypt_data(text) for text in merged['description']],
+            merged['duplicate_of'].tolist(), itertools.repeat(user_id))
+    )
+    index_expense_descriptions(conn, zip(itertools.repeat(user_id), merged['duplicate_of'].tolist(), merged['description'].tolist()))
+    return previous
+
+# Uploads are staged on disk under an opaque token until the user confirms the mapping;
+# requests in between only carry the token.
+app.config['IMPORT_STAGING_TTL'] = 3600  # Seconds an unconfirmed upload is kept
+app.config['IMPORT_PREVIEW_ROWS'] = 10
+
+def stage_upload(conn, user_id, file):
+    """Saves an uploaded file to IMPORT_DIR and returns its import token."""
+    cleanup_expired_uploads(conn)
+    os.makedirs(app.config['IMPORT_DIR'], exist_ok=True)
+    token = secrets.token_urlsafe(24)
+    path = os.path.join(app.config['IMPORT_DIR'], f"{uuid.uuid4().hex}.csv")
+    file.save(path)  # Werkzeug streams the upload, so it is never fully in memory
+    now = datetime.now()
+    conn.execute(
+        'INSERT INTO import_staging (token, user_id, path, filename, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)',
+        (token, user_id, path, file.filename, now.isoformat(),
+         (now + timedelta(seconds=app.config['IMPORT_STAGING_TTL'])).isoformat())
+    )
+    conn.commit()
+    return token
+
+def get_staged_upload(conn, token, user_id):
+    """Returns the staging row for a user's unexpired token, or None."""
+    return conn.execute(
+        'SELECT * FROM import_staging WHERE token = ? AND user_id = ? AND expires_at >= ?',
+        (token, user_id, datetime.now().isoformat())
+    ).fetchone()
+
+def discard_staged_upload(conn, token):
+    row = conn.execute('SELECT path FROM import_staging WHERE token = ?', (token,)).fetchone()
+    if row and os.path.exists(row['path']):
+        os.remove(row['path'])
+    conn.execute('DELETE FROM import_staging WHERE token = ?', (token,))
+    conn.commit()
+
+def cleanup_expired_uploads(conn):
+    """Deletes expired staged uploads. Returns how many were removed."""
+    expired = conn.execute(
+        'SELECT token, path FROM import_staging WHERE expires_at < ?', (datetime.now().isoformat(),)
     ).fetchall()
-    conn.close()
-    
-    # Convert to list of dicts
-    categories = [dict(row) for row in custom_categories]
-    
-    # If no custom categories, return default ones
-    if not categories:
-        default_categories = ['Food', 'Transportation', 'Entertainment', 'Shopping', 'Bills', 'Healthcare', 'Other']
-        return [{'name': cat, 'icon': '💰', 'color': '#6c757d'} for cat in default_categories]
-    
-    return categories
+    for row in expired:
+        if os.path.exists(row['path']):
+            os.remove(row['path'])
+    conn.executemany('DELETE FROM import_staging WHERE token = ?', [(row['token'],) for row in expired])
+    conn.commit()
+    cleanup_finished_imports(conn)
+    return len(expired)
+
+def preview_staged_upload(path, rows=None):
+    """Reads only the header and first rows of a staged CSV. Returns (columns, rows)."""
+    preview = pd.read_csv(path, nrows=rows or app.config['IMPORT_PREVIEW_ROWS'], dtype=str, keep_default_na=False)
+    return preview.columns.tolist(), preview.values.tolist()
 
-def process_recurring_expenses(user_id):
+def split_import_duplicates(conn, user_id, prepared, policy, baseline_id, used):
     """
-    Lazy checks for recurring expenses that are due.
-    If today >= next_due_date, it creates a new expense entry and updates the date.
+    Fingerprints a prepared chunk and looks its rows up against expenses that existed before
+    the import (id <= baseline_id). Returns (to_insert, to_merge, duplicates) where duplicates
+    has expense_id/action columns indexed by data row number. `used` holds the expense ids
+    already paired with an earlier row of the import and is updated with this chunk's pairs.
     """
-    conn = get_db_connection()
-    today = datetime.now().date()
-    
-    # Find active recurring expenses that are due
-    due_expenses = conn.execute('''
-        SELECT * FROM expenses 
-        WHERE user_id = ? 
-        AND is_recurring = 1 
-        AND next_due_date <= ?
-    ''', (user_id, today.strftime('%Y-%m-%d'))).fetchall()
-    
-    added_count = 0
-    
-    for exp in due_expenses:
-        # 1. Create the NEW transaction for this month
-        current_due_date = datetime.strptime(exp['next_due_date'], '%Y-%m-%d').date()
-        
-        conn.execute('''
-            INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date, is_recurring, frequency, next_due_date)
-            VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, NULL)
-        ''', (
-            user_id, 
-            exp['amount'], 
-            exp['currency'], 
-            exp['amount_usd'], 
-            exp['category'], 
-            f"{exp['description']} (Auto-generated)", 
-            current_due_date.strftime('%Y-%m-%d'),
-            # The new entry is NOT a master recurring trigger itself
-            exp['frequency']
-        ))
-        
-        # 2. Update the "Master" expense to the NEXT due date
-        next_date = current_due_date
-        if exp['frequency'] == 'monthly':
-            # Add 1 month (handle year rollover)
-            month = next_date.month + 1
-            year = next_date.year
-            if month > 12:
-                month = 1
-                year += 1
-            # Handle short months (e.g., Jan 31 -> Feb 28)
+    prepared = prepared.assign(fingerprint=[
+        expense_fingerprint(user_id, *values)
+        for values in zip(prepared['date'], prepared['amount'], prepared['currency'], prepared['description'])
+    ])
+    existing = {} if policy == 'allow' else find_duplicate_expenses(conn, user_id, prepared['fingerprint'], baseline_id)
+    # Each row pairs with the first existing match no earlier row took, so two genuine
+    # identical purchases only count as duplicates if both already exist
+    pairs = []
+    for fingerprint in prepared['fingerprint']:
+        match = next((expense_id for expense_id in existing.get(fingerprint, ()) if expense_id not in used), None)
+        if match is not None:
+            used.add(match)
+        pairs.append(match)
+    duplicate_of = pd.Series(pairs, index=prepared.index, dtype=object)
+    is_duplicate = duplicate_of.notna()
+    duplicates = pd.DataFrame({'expense_id': duplicate_of[is_duplicate].astype(int), 'action': DUPLICATE_ACTIONS[policy]})
+
+    if policy == 'flag':
+        prepared['duplicate_of'] = duplicate_of.tolist()
+        return prepared, prepared.iloc[0:0], duplicates
+    if policy == 'merge':
+        merged = prepared[is_duplicate].assign(duplicate_of=duplicates['expense_id'])
+        return prepared[~is_duplicate], merged, duplicates
+    return prepared[~is_duplicate], prepared.iloc[0:0], duplicates
+
+def import_csv(conn, source, mapping, user_id, chunk_size=None, progress=None, start_row=0, checkpoint=None,
+               duplicate_policy='skip', baseline_id=None, used_matches=None):
+    """
+    Streams a CSV file (path or file object) into expenses. Each chunk commits on its own,
+    so memory stays bounded by chunk_size. Returns stats including rows/sec.
+    start_row skips data records already committed by an earlier run (parsed records, so quoted
+    fields spanning several lines do not shift the offset). checkpoint(conn, rows_done,
+    prepared, rejected, duplicates) runs inside each chunk's transaction, so progress commits
+    atomically with the rows. Chunks hitting a locked database are retried IMPORT_RETRIES times.
+    Rows matching an expense that existed before the import (id <= baseline_id, default: the
+    current max id) are handled by duplicate_policy: skip, flag, merge or allow. Each existing
+    expense is matched at most once per import; used_matches carries the ids an earlier run of
+    the same import already matched. Merged duplicates gain previous_category/description columns.
+    """
+    chunk_size = chunk_size or app.config['IMPORT_CHUNK_SIZE']
+    if baseline_id is None:
+        baseline_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM expenses').fetchone()[0]
+    stats = {'imported': 0, 'rejected': 0, 'duplicates': 0, 'chunks': 0}
+    started = time.perf_counter()
+    today = datetime.now().strftime('%Y-%m-%d')
+    offset, skip = start_row, start_row
+    used_matches = set(used_matches or ())
+    for chunk in pd.read_csv(source, chunksize=chunk_size):
+        if skip:
+            if len(chunk) <= skip:
+                skip -= len(chunk)
+                continue
+            chunk, skip = chunk.iloc[skip:], 0
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))  # Data row numbers across runs
+        prepared, rejected = prepare_import_chunk(chunk, mapping, today)
+        prepared, merged, duplicates = split_import_duplicates(conn, user_id, prepared, duplicate_policy, baseline_id,
+                                                               used_matches)
+        for attempt in range(app.config['IMPORT_RETRIES'] + 1):
             try:
-                next_date = next_date.replace(year=year, month=month)
-            except ValueError:
-                # If day is out of range (e.g. 30th Feb), go to last day of month
-                import calendar
-                last_day = calendar.monthrange(year, month)[1]
-                next_date = next_date.replace(year=year, month=month, day=last_day)
-                
-        elif exp['frequency'] == 'yearly':
-            next_date = next_date.replace(year=next_date.year + 1)
-        elif exp['frequency'] == 'weekly':
-            next_date = next_date + timedelta(days=7)
-            
-        conn.execute('UPDATE expenses SET next_due_date = ? WHERE id = ?', 
-                     (next_date.strftime('%Y-%m-%d'), exp['id']))
-        
-        added_count += 1
-        
+                previous = merge_import_duplicates(conn, user_id, merged)
+                if previous:
+                    before = [previous.get(expense_id, (None, None)) for expense_id in duplicates['expense_id']]
+                    duplicates = duplicates.assign(previous_category=[category for category, _ in before],
+                                                   previous_description=[description for _, description in before])
+                insert_import_chunk(conn, user_id, prepared)
+                if checkpoint:
+                    checkpoint(conn, offset + len(chunk), prepared, rejected, duplicates)
+                conn.commit()
+                break
+            except sqlite3.OperationalError:
+                conn.rollback()
+                if attempt == app.config['IMPORT_RETRIES']:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+            except Exception:
+                conn.rollback()
+                raise
+        offset += len(chunk)
+        stats['imported'] += len(prepared)
+        stats['rejected'] += len(rejected)
+        stats['duplicates'] += len(duplicates)
+        stats['chunks'] += 1
+        if progress:
+            progress(stats)
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    stats['rows_per_sec'] = round(stats['imported'] / stats['seconds']) if stats['seconds'] else 0
+    return stats
+
+def count_csv_rows(path):
+    """Estimates data rows by counting newlines (quoted multi-line fields make it approximate)."""
+    lines = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+    return max(lines - 1, 0)
+
+# --- IMPORT JOBS ---
+# Confirmed imports run on a background worker. Each chunk commits together with the
+# job's row offset and its rejected rows, so a crashed or failed job resumes where it stopped.
+# A worker claims a job in the database and renews the claim with every chunk; a 'running'
+# job whose heartbeat is older than IMPORT_LEASE_SECONDS belongs to a dead worker and is resumed.
+app.config['IMPORT_WORKERS'] = 1
+app.config['IMPORT_LEASE_SECONDS'] = 120
+app.config['IMPORT_RETRIES'] = 3
+app.config['IMPORT_JOB_RETENTION'] = 7 * 86400  # Seconds finished jobs and reports are kept
+
+_import_executor = None
+_import_executor_lock = threading.Lock()
+_active_import_jobs = set()  # Jobs queued in this process; the DB claim covers other processes
+
+class ImportLeaseLost(Exception):
+    """Another worker took over the job (our heartbeat went stale)."""
+
+def _get_import_executor():
+    global _import_executor
+    with _import_executor_lock:
+        if _import_executor is None:
+            _import_executor = ThreadPoolExecutor(
+                max_workers=app.config['IMPORT_WORKERS'], thread_name_prefix='import'
+            )
+        return _import_executor
+
+def import_job_dict(job):
+    """Public view of an import job row."""
+    total = max(job['total_rows'], job['rows_done'])
+    return {
+        'id': job['id'],
+        'filename': job['filename'],
+        'status': job['status'],
+        'progress': round(job['rows_done'] / total * 100, 1) if total else (100.0 if job['status'] == 'completed' else 0.0),
+        'rows_done': job['rows_done'],
+        'total_rows': total,
+        'imported': job['imported'],
+        'rejected': job['rejected'],
+        'duplicates': job['duplicates'],
+        'duplicate_policy': job['duplicate_policy'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+    }
+
+def submit_import_job(conn, user_id, staged, mapping, duplicate_policy='skip'):
+    """Turns a staged upload into a queued import job and returns the job id (the worker counts its rows)."""
+    if duplicate_policy not in DUPLICATE_ACTIONS:
+        raise ValueError(f"Unknown duplicate policy: {duplicate_policy}")
+    job_id = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    # Only expenses that exist now count as duplicates, also when the job resumes later
+    baseline_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM expenses').fetchone()[0]
+    conn.execute(
+        '''INSERT INTO import_jobs (id, user_id, path, filename, mapping, status, total_rows, duplicate_policy,
+                                  baseline_id, created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)''',
+        (job_id, user_id, staged['path'], staged['filename'], json.dumps(mapping),
+         duplicate_policy, baseline_id, now, now)
+    )
+    # The job owns the file from here on
+    conn.execute('DELETE FROM import_staging WHERE token = ?', (staged['token'],))
     conn.commit()
-    conn.close()
-    return added_count
+    enqueue_import_job(job_id)
+    return job_id
+
+def enqueue_import_job(job_id):
+    with _import_executor_lock:
+        if job_id in _active_import_jobs:
+            return False
+        _active_import_jobs.add(job_id)
+    _get_import_executor().submit(run_import_job, job_id)
+    return True
+
+def rejected_import_rows(job_id, rejected, mapping):
+    """Rejection records (job_id, line, reason, raw_json) for a chunk's rejected rows."""
+    records = []
+    if mapping.get('date') in rejected.columns:
+        bad_dates = parse_import_dates(rejected[mapping['date']])[1].tolist()
+    else:
+        bad_dates = [False] * len(rejected)
+    for row_number, raw, bad_date in zip(rejected.index, rejected.to_dict('records'), bad_dates):
+        raw = {key: (None if pd.isna(value) else value) for key, value in raw.items()}
+        if pd.isna(pd.to_numeric(raw.get(mapping['amount']), errors='coerce')):
+            reason = f"Invalid amount: {raw.get(mapping['amount'])!r}"
+        elif bad_date:
+            reason = f"Invalid date: {raw.get(mapping['date'])!r}"
+        else:
+            reason = f"No exchange rate for currency: {raw.get(mapping.get('currency'))!r}"
+        records.append((job_id, row_number + 2, reason, json.dumps(raw, default=str)))  # +2: header, 1-based
+    return records
 
-def get_category_by_id(category_id, user_id):
-    """Get a specific category by ID for the given user"""
-    conn = get_db_connection()
-    category = conn.execute(
-        'SELECT * FROM categories WHERE id = ? AND user_id = ?',
-        (category_id, user_id)
-    ).fetchone()
-    conn.close()
-    return category
+def claim_import_job(conn, job_id):
+    """Claims an unfinished job for this process unless a live worker holds it. Returns True on success."""
+    now = time.time()
+    cursor = conn.execute(
+        '''UPDATE import_jobs SET status = 'running', error = NULL, claimed_by = ?, heartbeat_at = ?, updated_at = ?
+           WHERE id = ? AND status != 'completed'
+             AND (claimed_by IS NULL OR claimed_by = ? OR heartbeat_at IS NULL OR heartbeat_at < ?)''',
+        (_lease_owner, now, datetime.now().isoformat(), job_id, _lease_owner, now - app.config['IMPORT_LEASE_SECONDS'])
+    )
+    conn.commit()
+    return cursor.rowcount == 1
+
+def run_import_job(job_id):
+    """Worker entry point: runs (or resumes) an import job from its last checkpoint."""
+    pool = get_db_pool()
+    conn = pool.acquire()
+    try:
+        if not claim_import_job(conn, job_id):
+            return
+        job = conn.execute('SELECT * FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+        mapping = json.loads(job['mapping'])
+        if not job['total_rows']:
+            # Counted here rather than on submit: a large upload would hold the request for a full read
+            conn.execute('UPDATE import_jobs SET total_rows = ?, updated_at = ? WHERE id = ? AND claimed_by = ?',
+                         (count_csv_rows(job['path']), datetime.now().isoformat(), job_id, _lease_owner))
+            conn.commit()
+
+        def checkpoint(conn, rows_done, prepared, rejected, duplicates):
+            conn.executemany(
+                'INSERT OR REPLACE INTO import_rejections (job_id, line, reason, raw) VALUES (?, ?, ?, ?)',
+                rejected_import_rows(job_id, rejected, mapping)
+            )
+            previous = duplicates.reindex(columns=['previous_category', 'previous_description']).astype(object)
+            previous = previous.where(previous.notna(), None)
+            conn.executemany(
+                '''INSERT OR REPLACE INTO import_duplicates
+                   (job_id, line, expense_id, action, previous_category, previous_description) VALUES (?, ?, ?, ?, ?, ?)''',
+                [(job_id, row_number + 2, expense_id, action, category, description)
+                 for row_number, expense_id, action, (category, description) in zip(
+                     duplicates.index, duplicates['expense_id'].tolist(), duplicates['action'],
+                     previous.itertuples(index=False))]
+            )
+            renewed = conn.execute(
+                '''UPDATE import_jobs SET rows_done = ?, imported = imported + ?, rejected = rejected + ?,
+                   duplicates = duplicates + ?, heartbeat_at = ?, updated_at = ? WHERE id = ? AND claimed_by = ?''',
+                (rows_done, len(prepared), len(rejected), len(duplicates), time.time(), datetime.now().isoformat(),
+                 job_id, _lease_owner)
+            ).rowcount
+            if not renewed:
+                raise ImportLeaseLost(job_id)  # Rolls the chunk back; the new owner redoes it
+
+        # Expenses matched by chunks committed before a restart stay matched
+        used_matches = [row[0] for row in conn.execute('SELECT expense_id FROM import_duplicates WHERE job_id = ?', (job_id,))]
+        import_csv(conn, job['path'], mapping, job['user_id'], start_row=job['rows_done'], checkpoint=checkpoint,
+                   duplicate_policy=job['duplicate_policy'], baseline_id=job['baseline_id'], used_matches=used_matches)
+        conn.execute(
+            "UPDATE import_jobs SET status = 'completed', claimed_by = NULL, finished_at = ?, updated_at = ? WHERE id = ?",
+            (datetime.now().isoformat(), datetime.now().isoformat(), job_id)
+        )
+        conn.commit()
+        if os.path.exists(job['path']):
+            os.remove(job['path'])
+    except ImportLeaseLost:
+        conn.rollback()
+        print(f"Import job {job_id} was taken over by another worker.")
+    except Exception as e:
+        conn.rollback()
+        conn.execute(
+            "UPDATE import_jobs SET status = 'failed', claimed_by = NULL, error = ?, updated_at = ? WHERE id = ? AND claimed_by = ?",
+            (str(e), datetime.now().isoformat(), job_id, _lease_owner)
+        )
+        conn.commit()
+        print(f"Import job {job_id} failed: {e}")
+    finally:
+        conn.close()
+        with _import_executor_lock:
+            _active_import_jobs.discard(job_id)
+
+def import_job_resumable(job, include_failed=True):
+    """True for queued jobs, 'running' jobs whose worker stopped heartbeating and (optionally) failed ones."""
+    if job['status'] == 'queued' or (include_failed and job['status'] == 'failed'):
+        return True
+    stale = time.time() - app.config['IMPORT_LEASE_SECONDS']
+    return job['status'] == 'running' and (job['heartbeat_at'] is None or job['heartbeat_at'] < stale)
+
+def resume_import_jobs(include_failed=False):
+    """Re-queues jobs interrupted by a crash or restart (and optionally failed ones). Returns their ids."""
+    conn = get_db_pool().acquire()
+    try:
+        rows = conn.execute(
+            "SELECT id, status, heartbeat_at FROM import_jobs WHERE status IN ('queued', 'running', 'failed')"
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row['id'] for row in rows if import_job_resumable(row, include_failed) and enqueue_import_job(row['id'])]
+
+def start_import_recovery(interval=None):
+    """Calls resume_import_jobs every IMPORT_LEASE_SECONDS in a daemon thread. Returns (thread, stop_event)."""
+    stop_event = threading.Event()
+
+    def loop():
+        while not stop_event.is_set():
+            try:
+                resumed = resume_import_jobs()
+                if resumed:
+                    print(f"Resumed {len(resumed)} interrupted import job(s).")
+            except Exception as e:
+                print(f"Import recovery failed: {e}")
+            stop_event.wait(interval or app.config['IMPORT_LEASE_SECONDS'])
+
+    thread = threading.Thread(target=loop, name='import-recovery', daemon=True)
+    thread.start()
+    return thread, stop_event
+
+def cleanup_finished_imports(conn):
+    """Deletes finished import jobs (and their rejection reports) past IMPORT_JOB_RETENTION."""
+    cutoff = (datetime.now() - timedelta(seconds=app.config['IMPORT_JOB_RETENTION'])).isoformat()
+    old = conn.execute(
+        "SELECT id FROM import_jobs WHERE status = 'completed' AND finished_at < ?", (cutoff,)
+    ).fetchall()
+    conn.executemany('DELETE FROM import_rejections WHERE job_id = ?', [(row['id'],) for row in old])
+    conn.executemany('DELETE FROM import_duplicates WHERE job_id = ?', [(row['id'],) for row in old])
+    conn.executemany('DELETE FROM import_jobs WHERE id = ?', [(row['id'],) for row in old])
+    conn.commit()
+    return len(old)
 
 # --- API ROUTES ---
 
@@ -582,18 +3595,47 @@ def api_login():
 @token_required
 def api_get_expenses(current_user_id):
     """
-    Get all expenses for the current user
+    Get expenses for the current user, newest first, one page at a time
     ---
     security:
       - Bearer: []
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        description: Page size (default 50, max 500)
+      - name: after
+        in: query
+        type: string
+        description: next_cursor from a previous page
+      - name: before
+        in: query
+        type: string
+        description: prev_cursor from a previous page
     responses:
       200:
-        description: A list of expenses
+        description: A page of expenses; meta holds next_cursor/prev_cursor
+      400:
+        description: Invalid cursor
     """
+    limit = get_page_size(request.args.get('limit'))
     conn = get_db_connection()
-    expenses = conn.execute('SELECT * FROM expenses WHERE user_id = ? ORDER BY date DESC', (current_user_id,)).fetchall()
-    conn.close()
-    return api_response(data=[dict(exp) for exp in expenses])
+    try:
+        expenses, next_cursor, prev_cursor = fetch_expense_page(
+            conn, current_user_id, limit,
+            after=request.args.get('after'), before=request.args.get('before')
+        )
+    except ValueError as e:
+        return api_response(success=False, message=str(e), code=400)
+    finally:
+        conn.close()
+    expenses_list = [dict(row) for row in expenses]
+    for exp, plaintext in zip(expenses_list, decrypt_many(exp['description'] for exp in expenses_list)):
+        exp['description'] = plaintext
+    return api_response(
+        data=expenses_list,
+        meta={'limit': limit, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor}
+    )
 
 @app.route('/api/expenses', methods=['POST'])
 @token_required
@@ -630,18 +3672,23 @@ def api_add_expense(current_user_id):
     category = data.get('category', 'Other')
     description = data.get('description', '')
     date = data.get('date', datetime.now().strftime('%Y-%m-%d'))
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return api_response(success=False, message=f'Invalid date: {date!r}', code=400)
 
-    amount_usd = convert_to_usd(amount, currency)
+    amount_usd = convert_to_usd(amount, currency, date)
 
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute(
         '''INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date) 
            VALUES (?, ?, ?, ?, ?, ?, ?)''',
-        (current_user_id, amount, currency, amount_usd, category, description, date)
+        (current_user_id, amount, currency, amount_usd, category, encrypt_data(description), date)
     )
-    conn.commit()
     expense_id = cursor.lastrowid
+    index_expense_description(conn, current_user_id, expense_id, description)
+    conn.commit()
     conn.close()
 
     return api_response(data={'id': expense_id}, message='Expense created successfully', code=201)
@@ -691,15 +3738,21 @@ def api_update_expense(current_user_id, expense_id):
     amount = float(data.get('amount', expense['amount']))
     currency = data.get('currency', expense['currency'])
     category = data.get('category', expense['category'])
-    description = data.get('description', expense['description'])
+    description = data.get('description', decrypt_data(expense['description']))
     date = data.get('date', expense['date'])
-    amount_usd = convert_to_usd(amount, currency)
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        conn.close()
+        return api_response(success=False, message=f'Invalid date: {date!r}', code=400)
+    amount_usd = convert_to_usd(amount, currency, date)
 
     conn.execute(
         '''UPDATE expenses SET amount=?, currency=?, amount_usd=?, category=?, description=?, date=? 
            WHERE id=? AND user_id=?''',
-        (amount, currency, amount_usd, category, description, date, expense_id, current_user_id)
+        (amount, currency, amount_usd, category, encrypt_data(description), date, expense_id, current_user_id)
     )
+    index_expense_description(conn, current_user_id, expense_id, description)
     conn.commit()
     conn.close()
     return api_response(message='Expense updated successfully')
@@ -921,6 +3974,169 @@ def api_create_group(current_user_id):
     conn.close()
     return api_response(data={'id': group_id}, message='Group created successfully', code=201)
 
+@app.route('/api/groups/<int:group_id>/expenses/bulk', methods=['POST'])
+@token_required
+def api_bulk_add_group_expenses(current_user_id, group_id):
+    """
+    Add many group expenses in one transaction
+    ---
+    security:
+      - Bearer: []
+    parameters:
+      - name: group_id
+        in: path
+        type: integer
+        required: true
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            expenses:
+              type: array
+              items:
+                type: object
+                properties:
+                  amount:
+                    type: number
+                  description:
+                    type: string
+                  payer_id:
+                    type: integer
+                  split_mode:
+                    type: string
+                    enum: [equal, exact, percent, shares]
+                  splits:
+                    type: object
+                    description: Member id to amount, percent or share (not used for equal splits)
+                  date:
+                    type: string
+    responses:
+      201:
+        description: Expenses created successfully
+      400:
+        description: An expense is invalid; nothing was added
+      403:
+        description: Not a member of the group
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('expenses')
+    if not isinstance(items, list) or not items:
+        return api_response(success=False, message='expenses must be a non-empty list', code=400)
+    if len(items) > app.config['GROUP_BULK_MAX_EXPENSES']:
+        return api_response(success=False, message=f"At most {app.config['GROUP_BULK_MAX_EXPENSES']} expenses per request", code=400)
+
+    conn = get_db_connection()
+    try:
+        members = group_member_ids(conn, group_id)
+        if current_user_id not in members:
+            return api_response(success=False, message='Not a member of this group', code=403)
+
+        # Validate everything before writing, so a bad row adds nothing
+        expenses = []
+        now = datetime.now()
+        for i, item in enumerate(items):
+            try:
+                if not isinstance(item, dict):
+                    raise ValueError("Expense must be an object")
+                payer_id = int(item.get('payer_id', current_user_id))
+                if payer_id not in members:
+                    raise ValueError(f"Payer {payer_id} is not a group member")
+                description = str(item.get('description', '')).strip()
+                if not description or description == 'Settlement':
+                    raise ValueError("A description is required")
+                date = item.get('date') or now
+                if date is not now:
+                    try:
+                        datetime.strptime(date, '%Y-%m-%d')
+                    except (TypeError, ValueError):
+                        raise ValueError(f"Invalid date: {date!r} (expected YYYY-MM-DD)") from None
+                splits = compute_splits(to_cents(item.get('amount')), members,
+                                        item.get('split_mode', 'equal'), item.get('splits'))
+            except (TypeError, ValueError) as e:
+                return api_response(success=False, message=f'Expense {i}: {e}', code=400)
+            expenses.append((payer_id, sum(cents for _, cents in splits), description, date, splits))
+
+        ids = insert_group_expenses(conn, group_id, expenses)
+        conn.commit()
+    finally:
+        conn.close()
+    return api_response(data={'ids': ids}, message=f'{len(ids)} expense(s) created', code=201)
+
+@app.route('/api/metrics/db_pool', methods=['GET'])
+@token_required
+@metrics_access_required
+def api_db_pool_metrics(current_user_id):
+    """
+    Database connection pool metrics for this worker process (users in METRICS_API_USERS only)
+    ---
+    security:
+      - Bearer: []
+    responses:
+      200:
+        description: Pool size, connections in use/idle and checkout counters
+      404:
+        description: Metrics are disabled or the user may not read them
+    """
+    return api_response(data=get_db_pool().metrics())
+
+@app.route('/api/metrics/decrypt', methods=['GET'])
+@token_required
+@metrics_access_required
+def api_decrypt_metrics(current_user_id):
+    """
+    Description decryption metrics for this worker process (users in METRICS_API_USERS only)
+    ---
+    security:
+      - Bearer: []
+    responses:
+      200:
+        description: Rows decrypted, legacy rows skipped, throughput (rows/sec) and cache statistics
+      404:
+        description: Metrics are disabled or the user may not read them
+    """
+    return api_response(data=get_decrypt_stats())
+
+# --- BACKGROUND WORKERS ---
+# Every serving process (the dev server, `flask run`, each gunicorn worker) starts its own
+# background threads on its first request, so nothing depends on the dev reloader. Scheduler
+# leases keep two processes from sweeping at the same time.
+app.config['BACKGROUND_WORKERS'] = True
+
+_background_workers = {}
+_background_workers_pid = None
+_background_workers_lock = threading.Lock()
+
+def start_background_workers():
+    """Starts this process's background threads once (again in a forked child). Returns {name: (thread, stop_event)}."""
+    global _background_workers_pid
+    with _background_workers_lock:
+        if _background_workers_pid != os.getpid():
+            _background_workers.clear()  # Threads inherited through fork() do not run in the child
+            recover_export_jobs()
+            _background_workers['export-heartbeat'] = start_export_heartbeat()
+            _background_workers['recurring'] = start_recurring_scheduler()
+            _background_workers['import-recovery'] = start_import_recovery()
+            _background_workers['fx-refresher'] = start_rate_refresher()
+            _background_workers_pid = os.getpid()
+        return _background_workers
+
+def stop_background_workers(timeout=None):
+    global _background_workers_pid
+    with _background_workers_lock:
+        for _, stop_event in _background_workers.values():
+            stop_event.set()
+        for thread, _ in _background_workers.values():
+            thread.join(timeout)
+        _background_workers.clear()
+        _background_workers_pid = None
+
+@app.before_request
+def ensure_background_workers():
+    if app.config['BACKGROUND_WORKERS'] and _background_workers_pid != os.getpid():
+        start_background_workers()
+
 # --- ROUTES ---
 
 @app.route('/set_currency', methods=['POST'])
@@ -1060,15 +4276,8 @@ def verify_2fa():
 # Clean up the temp session ID
             session.pop('pre_2fa_id', None)
 
-            # --- START NEW CODE: Trigger Recurring Check ---
-            # Now that 2FA is passed, we run the check
-            count = process_recurring_expenses(user['id'])
-            
-            if count > 0:
-                flash(f'Logged in successfully! Auto-added {count} recurring expense(s).')
-            else:
-                flash('Logged in successfully!')
-            # --- END NEW CODE ---
+            # Recurring expenses are generated by the background scheduler, not at login
+            flash('Logged in successfully!')
             return redirect(url_for('dashboard'))
         else:
             flash('Invalid 2FA Token. Please try again.')
@@ -1202,23 +4411,12 @@ def dashboard():
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    display_currency = session.get('currency', 'INR')
+    ctx = get_currency_context()
     user_id = session['user_id']
 
-    # Total Expenses
-    total_expenses_usd = conn.execute(
-        'SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id = ?', 
-        (user_id,)
-    ).fetchone()[0]
-    total_expenses = convert_from_usd(total_expenses_usd, display_currency)
-
-    # Monthly Expenses
+    # Total and Monthly Expenses (from the per-currency daily rollup)
     current_month_start = datetime.now().replace(day=1).strftime('%Y-%m-%d')
-    monthly_expenses_usd = conn.execute(
-        'SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id = ? AND date >= ?',
-        (user_id, current_month_start)
-    ).fetchone()[0]
-    monthly_expenses = convert_from_usd(monthly_expenses_usd, display_currency)
+    total_expenses, monthly_expenses = get_display_totals(conn, user_id, ctx, current_month_start)
 
     # Recent Expenses
     rows = conn.execute(
@@ -1229,61 +4427,46 @@ def dashboard():
     recent_expenses = []
     for row in rows:
         exp = dict(row)
-        exp['amount_display'] = convert_from_usd(exp['amount_usd'], display_currency)
+        exp['amount_display'] = ctx.display(exp['amount'], exp['currency'], exp['amount_usd'], exp['date'])
         recent_expenses.append(exp)
 
     # Budgets
     budgets = conn.execute('SELECT * FROM budgets WHERE user_id = ?', (user_id,)).fetchall()
-    total_budget_usd = 0
-    total_budget_spent_usd = 0
+    budget_spending = get_display_spending(conn, user_id, ctx, end_date=datetime.now().strftime('%Y-%m-%d'))
+    total_budget = 0
+    total_budget_spent = 0
     budget_alerts = []
 
     for budget in budgets:
-        budget_amount_usd = float(budget['amount_usd'])
-        total_budget_usd += budget_amount_usd
-
-        # Determine start date based on period
-        if budget['period'] == 'monthly':
-            start_date = datetime.now().replace(day=1).strftime('%Y-%m-%d')
-        elif budget['period'] == 'weekly':
-            start_date = (datetime.now() - timedelta(days=datetime.now().weekday())).strftime('%Y-%m-%d')
-        else: # yearly
-            start_date = datetime.now().replace(month=1, day=1).strftime('%Y-%m-%d')
-        
-        end_date = datetime.now().strftime('%Y-%m-%d')
+        budget_amount = ctx.display(float(budget['amount']), budget['currency'], float(budget['amount_usd']))
+        total_budget += budget_amount
 
-        actual_spending_usd = conn.execute(
-            '''SELECT COALESCE(SUM(amount_usd), 0) FROM expenses 
-               WHERE user_id = ? AND category = ? AND date BETWEEN ? AND ?''',
-            (user_id, budget['category'], start_date, end_date)
-        ).fetchone()[0]
+        # Spending for the budget's current period (unknown periods count as yearly)
+        period_spending = budget_spending.get(budget['period'], budget_spending['yearly'])
+        actual_spending = period_spending.get(budget['category'], 0)
 
-        total_budget_spent_usd += actual_spending_usd
+        total_budget_spent += actual_spending
         
-        percentage = (actual_spending_usd / budget_amount_usd * 100) if budget_amount_usd > 0 else 0
-        remaining_usd = budget_amount_usd - actual_spending_usd
+        percentage = (actual_spending / budget_amount * 100) if budget_amount > 0 else 0
 
         if percentage >= 80:
             budget_alerts.append({
                 'category': budget['category'],
                 'status': 'exceeded' if percentage >= 100 else 'warning',
                 'percentage': round(percentage, 1),
-                'remaining': convert_from_usd(remaining_usd, display_currency)
+                'remaining': round(budget_amount - actual_spending, 2)
             })
 
     conn.close()
-    
-    total_budget = convert_from_usd(total_budget_usd, display_currency)
-    total_budget_spent = convert_from_usd(total_budget_spent_usd, display_currency)
 
     return render_template('dashboard.html',
         total_expenses=total_expenses,
         monthly_expenses=monthly_expenses,
-        total_budget=total_budget,
-        total_budget_spent=total_budget_spent,
+        total_budget=round(total_budget, 2),
+        total_budget_spent=round(total_budget_spent, 2),
         recent_expenses=recent_expenses,
         budget_alerts=budget_alerts,
-        currency=display_currency
+        currency=ctx.currency
     )
 
 @app.route('/expenses')
@@ -1291,23 +4474,35 @@ def expenses():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
+    limit = get_page_size(request.args.get('limit'))
     conn = get_db_connection()
-    # 1. Fetch into 'raw_expenses'
-    raw_expenses = conn.execute(
-        'SELECT * FROM expenses WHERE user_id = ? ORDER BY date DESC', 
-        (session['user_id'],)
-    ).fetchall()
-    conn.close()
+    # 1. Fetch one keyset page into 'raw_expenses'
+    try:
+        raw_expenses, next_cursor, _ = fetch_expense_page(
+            conn, session['user_id'], limit, after=request.args.get('after')
+        )
+    except ValueError:
+        return "Invalid cursor", 400
+    finally:
+        conn.close()
 
-    # 2. Decrypt into 'expenses_list'
-    expenses_list = []
-    for row in raw_expenses:
-        r = dict(row)
-        r['description'] = decrypt_data(r['description'])
-        expenses_list.append(r)
+    # 2. Decrypt only this page into 'expenses_list'
+    expenses_list = [dict(row) for row in raw_expenses]
+    for r, plaintext in zip(expenses_list, decrypt_many(r['description'] for r in expenses_list)):
+        r['description'] = plaintext
     
     user_categories = get_user_categories(session['user_id'])
-    return render_template('expenses.html', expenses=expenses_list, categories=user_categories)
+
+    # Infinite scroll requests only need the next rows
+    if request.args.get('partial'):
+        response = app.make_response(render_template(
+            'partials/expense_rows.html', expenses=expenses_list, categories=user_categories
+        ))
+        response.headers['X-Next-Cursor'] = next_cursor or ''
+        return response
+
+    return render_template('expenses.html', expenses=expenses_list, categories=user_categories,
+                           next_cursor=next_cursor, load_more_url=url_for('expenses', partial=1, limit=limit))
 
 @app.route('/search_expenses')
 def search_expenses():
@@ -1350,6 +4545,8 @@ def search_expenses():
             min_usd = convert_to_usd(float(amount_min), session.get('currency', 'USD'))
             query += ' AND amount_usd >= ?'
             params.append(min_usd)
+        except ExchangeRateUnavailable:
+            raise  # Reported by the app-wide handler rather than silently dropping the filter
         except ValueError:
             pass
             
@@ -1358,6 +4555,8 @@ def search_expenses():
             max_usd = convert_to_usd(float(amount_max), session.get('currency', 'USD'))
             query += ' AND amount_usd <= ?'
             params.append(max_usd)
+        except ExchangeRateUnavailable:
+            raise  # Reported by the app-wide handler rather than silently dropping the filter
         except ValueError:
             pass
     
@@ -1365,25 +4564,33 @@ def search_expenses():
     valid_sort_columns = {'date': 'date', 'amount': 'amount_usd', 'category': 'category'}
     sort_column = valid_sort_columns.get(sort_by, 'date')
     sort_direction = 'ASC' if sort_order.lower() == 'asc' else 'DESC'
-    query += f' ORDER BY {sort_column} {sort_direction}'
     
+    # Keyword: narrow candidates in SQL through the blind index (keywords under 3 chars can't use it)
+    if keyword:
+        keyword_clause = keyword_filter_clause(session['user_id'], keyword)
+        if keyword_clause:
+            query += keyword_clause[0]
+            params.extend(keyword_clause[1])
+    
+    query += f' ORDER BY {sort_column} {sort_direction}, id {sort_direction}'
+    
+    # Decrypt only the rows needed for this page, re-checking the keyword on the plaintext
+    limit = get_page_size(request.args.get('limit'))
+    try:
+        offset = max(0, int(request.args.get('after', 0)))
+    except ValueError:
+        offset = 0
     conn = get_db_connection()
-    raw_expenses = conn.execute(query, params).fetchall()
+    expenses_list, next_offset = search_expense_page(conn, query, params, keyword, limit, offset)
     conn.close()
+    next_cursor = str(next_offset) if next_offset is not None else None
     
-    # Decrypt and Filter in Python
-    expenses_list = []
-    search_term = keyword.lower() if keyword else None
-    
-    for row in raw_expenses:
-        exp = dict(row)
-        exp['description'] = decrypt_data(exp['description'])
-        
-        if search_term:
-            if search_term in exp['description'].lower():
-                expenses_list.append(exp)
-        else:
-            expenses_list.append(exp)
+    if request.args.get('partial'):
+        response = app.make_response(render_template(
+            'partials/expense_rows.html', expenses=expenses_list, categories=user_categories
+        ))
+        response.headers['X-Next-Cursor'] = next_cursor or ''
+        return response
     
     filters = {
         'date_from': date_from,
@@ -1396,7 +4603,9 @@ def search_expenses():
         'sort_order': sort_order
     }
     
-    return render_template('expenses.html', expenses=expenses_list, categories=user_categories, filters=filters, is_filtered=True)
+    load_more_url = url_for('search_expenses', partial=1, limit=limit, **filters)
+    return render_template('expenses.html', expenses=expenses_list, categories=user_categories, filters=filters, is_filtered=True,
+                           next_cursor=next_cursor, load_more_url=load_more_url)
 
 @app.route('/add_expense', methods=['GET', 'POST'])
 def add_expense():
@@ -1417,39 +4626,30 @@ def add_expense():
         # If recurring, the "next due date" starts 1 cycle from the entered date
         # OR we can set it to the entered date if we want the *next* one to be tracked.
         # Usually, if I add a bill today, I want the system to remind me *next* month.
+        recurrence_interval = max(request.form.get('recurrence_interval', 1, type=int) or 1, 1)
+        recurrence_end_date = request.form.get('recurrence_end_date') or None
         next_due_date = None
         if is_recurring:
-            # Simple logic: If I pay today, next due is next month
-            dt = datetime.strptime(date, '%Y-%m-%d')
-            if frequency == 'monthly':
-                 # (Add month logic same as above helper)
-                month = dt.month + 1
-                year = dt.year
-                if month > 12:
-                    month = 1
-                    year += 1
-                try:
-                    next_due_date = dt.replace(year=year, month=month).strftime('%Y-%m-%d')
-                except ValueError:
-                    import calendar
-                    last_day = calendar.monthrange(year, month)[1]
-                    next_due_date = dt.replace(year=year, month=month, day=last_day).strftime('%Y-%m-%d')
-            elif frequency == 'weekly':
-                next_due_date = (dt + timedelta(days=7)).strftime('%Y-%m-%d')
-            elif frequency == 'yearly':
-                next_due_date = dt.replace(year=dt.year + 1).strftime('%Y-%m-%d')
+            # Simple logic: If I pay today, next due is one cycle later
+            dt = datetime.strptime(date, '%Y-%m-%d').date()
+            next_due = next_recurrence(dt, frequency, recurrence_interval)
+            if not recurrence_end_date or next_due.strftime('%Y-%m-%d') <= recurrence_end_date:
+                next_due_date = next_due.strftime('%Y-%m-%d')
 
-        amount_usd = convert_to_usd(amount, currency)
+        amount_usd = convert_to_usd(amount, currency, date)
 
         raw_description = request.form['description']
         description = encrypt_data(raw_description)
 
         conn = get_db_connection()
-        conn.execute(
-            '''INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date, is_recurring, frequency, next_due_date) 
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (session['user_id'], amount, currency, amount_usd, category, description, date, is_recurring, frequency, next_due_date)
+        cursor = conn.execute(
+            '''INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date, is_recurring, frequency,
+                                     next_due_date, recurrence_interval, recurrence_end_date) 
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (session['user_id'], amount, currency, amount_usd, category, description, date, is_recurring, frequency,
+             next_due_date, recurrence_interval, recurrence_end_date)
         )
+        index_expense_description(conn, session['user_id'], cursor.lastrowid, raw_description)
         conn.commit()
         conn.close()
         
@@ -1472,16 +4672,18 @@ def edit_expense(expense_id):
         category = request.form['category']
         description = request.form['description']
         date = request.form['date'] or datetime.now().strftime('%Y-%m-%d')
-        amount_usd = convert_to_usd(amount, currency)
+        amount_usd = convert_to_usd(amount, currency, date)
 
         raw_description = request.form['description']
         description = encrypt_data(raw_description)
 
-        conn.execute(
+        cursor = conn.execute(
             '''UPDATE expenses SET amount=?, currency=?, amount_usd=?, category=?, description=?, date=? 
                WHERE id=? AND user_id=?''',
             (amount, currency, amount_usd, category, description, date, expense_id, session['user_id'])
         )
+        if cursor.rowcount:
+            index_expense_description(conn, session['user_id'], expense_id, raw_description)
         conn.commit()
         conn.close()
         flash('Expense updated successfully!')
@@ -1500,7 +4702,7 @@ def edit_expense(expense_id):
     expense_dict['description'] = decrypt_data(expense['description'])
 
     user_categories = get_user_categories(session['user_id'])
-    return render_template('edit_expense.html', expense=expense, categories=user_categories, selected_currency=expense['currency'])
+    return render_template('edit_expense.html', expense=expense_dict, categories=user_categories, selected_currency=expense['currency'])
 
 @app.route('/delete_expense/<int:expense_id>')
 def delete_expense(expense_id):
@@ -1524,7 +4726,8 @@ def analytics():
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    display_currency = session.get('currency', 'INR')
+    ctx = get_currency_context()
+    display_currency = ctx.currency
     user_id = session['user_id']
     
     # Get time range parameters
@@ -1543,166 +4746,70 @@ def analytics():
         start_date = end_date - timedelta(days=days-1)
         days_count = days
     
+    # One grouped scan feeds the daily trend, category, heat map and pattern sections;
+    # every series is converted to the display currency with the same dated rates
+    aggregates = aggregate_analytics(conn, user_id, start_date, end_date, days_count, ctx)
+
     # --- DAILY SPENDING TREND ---
-    daily_labels = []
-    daily_data = []
-    
-    for i in range(days_count):
-        current_date = (start_date + timedelta(days=i)).strftime('%Y-%m-%d')
-        daily_labels.append((start_date + timedelta(days=i)).strftime('%b %d'))
-        
-        total_usd = conn.execute(
-            'SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id=? AND date=?',
-            (user_id, current_date)
-        ).fetchone()[0]
-        daily_data.append(round(convert_from_usd(total_usd, display_currency), 2))
+    daily_labels = [day.strftime('%b %d') for day in aggregates['days']]
+    daily_data = [round(total, 2) for total in aggregates['daily_totals']]
     
     # --- CATEGORY BREAKDOWN ---
-    categories_data = conn.execute(
-        '''SELECT category, COALESCE(SUM(amount_usd), 0) as total_usd 
-           FROM expenses WHERE user_id=? AND date BETWEEN ? AND ?
-           GROUP BY category''',
-        (user_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-    ).fetchall()
-    
-    category_labels = [row['category'] for row in categories_data]
-    category_totals = [round(convert_from_usd(row['total_usd'], display_currency), 2) for row in categories_data]
+    categories_data = aggregates['category_totals']
+    category_labels = [category for category, _ in categories_data]
+    category_totals = [round(total, 2) for _, total in categories_data]
     
     # --- BUDGET PERFORMANCE ---
     budgets = conn.execute('SELECT * FROM budgets WHERE user_id = ?', (user_id,)).fetchall()
+    budget_spending = get_display_spending(conn, user_id, ctx)
     budget_labels = []
     budget_allocated = []
     budget_spent = []
     
-    for budget in budgets:
-        budget_labels.append(budget['category'])
-        budget_allocated.append(round(convert_from_usd(budget['amount_usd'], display_currency), 2))
-        
-        # Calculate period
-        if budget['period'] == 'monthly':
-            period_start = datetime.now().replace(day=1).strftime('%Y-%m-%d')
-        elif budget['period'] == 'weekly':
-            period_start = (datetime.now() - timedelta(days=datetime.now().weekday())).strftime('%Y-%m-%d')
-        else:  # yearly
-            period_start = datetime.now().replace(month=1, day=1).strftime('%Y-%m-%d')
-        
-        actual_usd = conn.execute(
-            '''SELECT COALESCE(SUM(amount_usd), 0) FROM expenses 
-               WHERE user_id = ? AND category = ? AND date >= ?''',
-            (user_id, budget['category'], period_start)
-        ).fetchone()[0]
-        budget_spent.append(round(convert_from_usd(actual_usd, display_currency), 2))
-    
-    # --- COMPARATIVE ANALYTICS (Month-over-Month) ---
-    current_month_start = datetime.now().replace(day=1)
-    current_month_end = datetime.now()
-    last_month_end = current_month_start - timedelta(days=1)
-    last_month_start = last_month_end.replace(day=1)
-    
-    current_month_total_usd = conn.execute(
-        'SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id=? AND date BETWEEN ? AND ?',
-        (user_id, current_month_start.strftime('%Y-%m-%d'), current_month_end.strftime('%Y-%m-%d'))
-    ).fetchone()[0]
-    
-    last_month_total_usd = conn.execute(
-        'SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id=? AND date BETWEEN ? AND ?',
-        (user_id, last_month_start.strftime('%Y-%m-%d'), last_month_end.strftime('%Y-%m-%d'))
-    ).fetchone()[0]
-    
-    mom_current = round(convert_from_usd(current_month_total_usd, display_currency), 2)
-    mom_last = round(convert_from_usd(last_month_total_usd, display_currency), 2)
-    mom_change = round(((current_month_total_usd - last_month_total_usd) / last_month_total_usd * 100) if last_month_total_usd > 0 else 0, 1)
-    
-    # --- YEAR-OVER-YEAR COMPARISON ---
-    current_year = datetime.now().year
-    last_year = current_year - 1
-    
-    current_year_total_usd = conn.execute(
-        'SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id=? AND strftime("%Y", date) = ?',
-        (user_id, str(current_year))
-    ).fetchone()[0]
+    for budget in budgets:
+        budget_labels.append(budget['category'])
+        budget_allocated.append(ctx.display(budget['amount'], budget['currency'], budget['amount_usd']))
+        
+        period_spending = budget_spending.get(budget['period'], budget_spending['yearly'])
+        budget_spent.append(period_spending.get(budget['category'], 0))
     
-    last_year_total_usd = conn.execute(
-        'SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id=? AND strftime("%Y", date) = ?',
-        (user_id, str(last_year))
-    ).fetchone()[0]
+    # --- COMPARATIVE ANALYTICS (Month-over-Month) ---
+    comparison = get_period_comparison(conn, user_id, ctx=ctx)
+    mom_current = round(comparison['current_month'], 2)
+    mom_last = round(comparison['last_month'], 2)
+    mom_change = round(((mom_current - mom_last) / mom_last * 100) if mom_last > 0 else 0, 1)
     
-    yoy_current = round(convert_from_usd(current_year_total_usd, display_currency), 2)
-    yoy_last = round(convert_from_usd(last_year_total_usd, display_currency), 2)
-    yoy_change = round(((current_year_total_usd - last_year_total_usd) / last_year_total_usd * 100) if last_year_total_usd > 0 else 0, 1)
+    # --- YEAR-OVER-YEAR COMPARISON ---
+    yoy_current = round(comparison['current_year'], 2)
+    yoy_last = round(comparison['last_year'], 2)
+    yoy_change = round(((yoy_current - yoy_last) / yoy_last * 100) if yoy_last > 0 else 0, 1)
     
     # --- SPENDING FORECAST (Next 30 Days) ---
-    last_30_days = end_date - timedelta(days=29)
-    recent_expenses = conn.execute(
-        'SELECT date, COALESCE(SUM(amount_usd), 0) as daily_total FROM expenses WHERE user_id=? AND date BETWEEN ? AND ? GROUP BY date',
-        (user_id, last_30_days.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-    ).fetchall()
-    
-    if len(recent_expenses) >= 7:
+    recent_totals = aggregates['forecast_daily_totals']
+    if len(recent_totals) >= 7:
         # Simple moving average forecast
-        recent_totals = [row['daily_total'] for row in recent_expenses]
         avg_daily_spend = sum(recent_totals) / len(recent_totals)
-        forecast_next_month = round(convert_from_usd(avg_daily_spend * 30, display_currency), 2)
+        forecast_next_month = round(avg_daily_spend * 30, 2)
     else:
         forecast_next_month = 0
     
     # --- TRANSACTION ANALYTICS ---
-    total_transactions = conn.execute(
-        'SELECT COUNT(*) FROM expenses WHERE user_id=? AND date BETWEEN ? AND ?',
-        (user_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-    ).fetchone()[0]
-    
-    avg_expense_usd = conn.execute(
-        'SELECT AVG(amount_usd) FROM expenses WHERE user_id=? AND date BETWEEN ? AND ?',
-        (user_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-    ).fetchone()[0] or 0
-    
-    avg_expense = round(convert_from_usd(avg_expense_usd, display_currency), 2)
+    total_transactions = aggregates['total_transactions']
+    avg_expense = round(aggregates['avg_expense'], 2)
     
     # --- SPENDING PATTERNS (Weekend vs Weekday) ---
-    weekend_usd = conn.execute(
-        '''SELECT COALESCE(SUM(amount_usd), 0) FROM expenses 
-           WHERE user_id=? AND date BETWEEN ? AND ? 
-           AND CAST(strftime('%w', date) AS INTEGER) IN (0, 6)''',
-        (user_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-    ).fetchone()[0]
-    
-    weekday_usd = conn.execute(
-        '''SELECT COALESCE(SUM(amount_usd), 0) FROM expenses 
-           WHERE user_id=? AND date BETWEEN ? AND ? 
-           AND CAST(strftime('%w', date) AS INTEGER) NOT IN (0, 6)''',
-        (user_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-    ).fetchone()[0]
-    
-    weekend_spending = round(convert_from_usd(weekend_usd, display_currency), 2)
-    weekday_spending = round(convert_from_usd(weekday_usd, display_currency), 2)
+    weekend_spending = round(aggregates['weekend'], 2)
+    weekday_spending = round(aggregates['weekday'], 2)
     
     # --- HEAT MAP DATA (Day of Week) ---
-    heatmap_data = [0] * 7  # Sun-Sat
-    for day in range(7):
-        day_total_usd = conn.execute(
-            '''SELECT COALESCE(SUM(amount_usd), 0) FROM expenses 
-               WHERE user_id=? AND date BETWEEN ? AND ? 
-               AND CAST(strftime('%w', date) AS INTEGER) = ?''',
-            (user_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), day)
-        ).fetchone()[0]
-        heatmap_data[day] = round(convert_from_usd(day_total_usd, display_currency), 2)
+    heatmap_data = [round(total, 2) for total in aggregates['heatmap']]
     
     # --- CATEGORY TRENDS (Growth/Decline) ---
+    # Compare current period to previous period
     category_trends = []
-    for cat_row in categories_data:
-        cat = cat_row['category']
-        # Compare current period to previous period
-        prev_start = start_date - timedelta(days=days_count)
-        prev_end = start_date - timedelta(days=1)
-        
-        prev_total_usd = conn.execute(
-            'SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id=? AND category=? AND date BETWEEN ? AND ?',
-            (user_id, cat, prev_start.strftime('%Y-%m-%d'), prev_end.strftime('%Y-%m-%d'))
-        ).fetchone()[0]
-        
-        current_total_usd = cat_row['total_usd']
-        change_pct = round(((current_total_usd - prev_total_usd) / prev_total_usd * 100) if prev_total_usd > 0 else 0, 1)
+    for cat, current_total in categories_data:
+        prev_total = aggregates['prev_category_totals'].get(cat, 0)
+        change_pct = round(((current_total - prev_total) / prev_total * 100) if prev_total > 0 else 0, 1)
         
         category_trends.append({
             'category': cat,
@@ -1790,59 +4897,28 @@ def budgets():
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    display_currency = session.get('currency', 'INR')
+    ctx = get_currency_context()
     budgets_list = conn.execute('SELECT * FROM budgets WHERE user_id=? ORDER BY category', (session['user_id'],)).fetchall()
     
+    budget_spending = get_display_spending(conn, session['user_id'], ctx, end_date=datetime.now().strftime('%Y-%m-%d'))
+    
     budgets_with_spending = []
     for budget in budgets_list:
         b_dict = dict(budget)
-        amount_usd = float(budget['amount_usd'])
+        amount = ctx.display(float(budget['amount']), budget['currency'], float(budget['amount_usd']))
         
-        # Period start date
-        if budget['period'] == 'monthly':
-            start_date = datetime.now().replace(day=1).strftime('%Y-%m-%d')
-        elif budget['period'] == 'weekly':
-            start_date = (datetime.now() - timedelta(days=datetime.now().weekday())).strftime('%Y-%m-%d')
-        else:
-            start_date = datetime.now().replace(month=1, day=1).strftime('%Y-%m-%d')
-        end_date = datetime.now().strftime('%Y-%m-%d')
-
-        actual_usd = conn.execute(
-            '''SELECT COALESCE(SUM(amount_usd), 0) FROM expenses 
-               WHERE user_id=? AND category=? AND date BETWEEN ? AND ?''',
-            (session['user_id'], budget['category'], start_date, end_date)
-        ).fetchone()[0]
-
-        b_dict['actual_spending'] = convert_from_usd(actual_usd, display_currency)
-        b_dict['remaining'] = convert_from_usd(amount_usd - actual_usd, display_currency)
-        b_dict['amount'] = convert_from_usd(amount_usd, display_currency)
-        b_dict['percentage_used'] = round((actual_usd / amount_usd * 100) if amount_usd > 0 else 0, 1)
+        # Spending for the budget's current period
+        period_spending = budget_spending.get(budget['period'], budget_spending['yearly'])
+        actual = period_spending.get(budget['category'], 0)
+
+        b_dict['actual_spending'] = actual
+        b_dict['remaining'] = round(amount - actual, 2)
+        b_dict['amount'] = amount
+        b_dict['percentage_used'] = round((actual / amount * 100) if amount > 0 else 0, 1)
         budgets_with_spending.append(b_dict)
 
     conn.close()
-    return render_template('budgets.html', budgets=budgets_with_spending, currency=display_currency)
-
-@app.route('/activity_log')
-def activity_log():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    conn = get_db_connection()
-    user_id = session['user_id']
-    
-    # We will fetch recent expenses and combine them with budget creations for a timeline
-    activities = conn.execute('''
-        SELECT 'Expense' as type, description, amount, currency, date, category 
-        FROM expenses WHERE user_id = ?
-        UNION ALL
-        SELECT 'Budget' as type, category as description, amount, currency, start_date as date, category
-        FROM budgets WHERE user_id = ?
-        ORDER BY date DESC LIMIT 50
-    ''', (user_id, user_id)).fetchall()
-    
-    conn.close()
-    
-    return render_template('activity_log.html', activities=activities)
+    return render_template('budgets.html', budgets=budgets_with_spending, currency=ctx.currency)
 
 @app.route('/add_budget', methods=['GET', 'POST'])
 def add_budget():
@@ -1930,83 +5006,38 @@ def export_data(data_type, format):
         return redirect(url_for('login'))
     
     user_id = session['user_id']
-    conn = get_db_connection()
-    
-    if data_type == 'expenses':
-        query = 'SELECT date, category, description, amount, currency, amount_usd FROM expenses WHERE user_id = ? ORDER BY date DESC'
-        filename = f"expenses_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    elif data_type == 'budgets':
-        query = 'SELECT category, amount, currency, amount_usd, period, start_date FROM budgets WHERE user_id = ? ORDER BY category'
-        filename = f"budgets_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    else:
+    if data_type not in EXPORT_QUERIES:
         return "Invalid data type", 400
-
-    df = pd.read_sql_query(query, conn, params=(user_id,))
-    conn.close()
+    filename = f"{data_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    conn = get_db_connection()
+    columns, chunks = iter_export_rows(conn, data_type, user_id)
 
     if format == 'csv':
-        output = io.StringIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
-        return send_file(
-            io.BytesIO(output.getvalue().encode()),
+        # The connection stays bound to the app context until the stream finishes
+        return Response(
+            stream_with_context(part.encode() for part in csv_chunks(columns, chunks)),
             mimetype='text/csv',
-            as_attachment=True,
-            download_name=f"{filename}.csv"
+            headers={'Content-Disposition': f'attachment; filename={filename}.csv'}
         )
     
     elif format == 'xlsx':
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name=data_type.capitalize())
+        # Spools to a temp file (deleted on close) rather than an in-memory buffer
+        output = tempfile.TemporaryFile()
+        write_xlsx(output, data_type.capitalize(), columns, chunks)
         output.seek(0)
         return send_file(
             output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=XLSX_MIMETYPE,
             as_attachment=True,
             download_name=f"{filename}.xlsx"
         )
     
     elif format == 'pdf':
-        # xhtml2pdf implementation
+        # Large PDFs should go through the export job queue (see submit_export_job)
         output = io.BytesIO()
-        
-        # Simple HTML Template for PDF
-        html_content = f"""
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Helvetica, sans-serif; }}
-                table {{ width: 100%; border-collapse: collapse; }}
-                th, td {{ padding: 8px; text-align: left; border-bottom: 1px solid #ddd; }}
-                th {{ background-color: #f2f2f2; }}
-                h2 {{ color: #333; }}
-            </style>
-        </head>
-        <body>
-            <h2>{data_type.capitalize()} Report</h2>
-            <p>Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-            <table>
-                <thead>
-                    <tr>
-                        {''.join([f'<th>{col}</th>' for col in df.columns])}
-                    </tr>
-                </thead>
-                <tbody>
-                    {''.join(['<tr>' + ''.join([f'<td>{val}</td>' for val in row]) + '</tr>' for row in df.values])}
-                </tbody>
-            </table>
-        </body>
-        </html>
-        """
-        
-        pisa_status = pisa.CreatePDF(
-            src=html_content,
-            dest=output
-        )
-        
-        if pisa_status.err:
-            return f"PDF generation error: {pisa_status.err}", 500
+        err = write_pdf(output, f"{data_type.capitalize()} Report", columns, chunks)
+        if err:
+            return f"PDF generation error: {err}", 500
             
         output.seek(0)
         return send_file(
@@ -2018,6 +5049,54 @@ def export_data(data_type, format):
     
     return "Invalid format", 400
 
+@app.route('/export_jobs/<string:data_type>/<string:format>', methods=['POST'])
+def create_export_job(data_type, format):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    conn = get_db_connection()
+    try:
+        job_id = submit_export_job(conn, session['user_id'], data_type, format)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        conn.close()
+    return jsonify({
+        'id': job_id,
+        'status': 'queued',
+        'status_url': url_for('export_job_status', job_id=job_id),
+        'download_url': url_for('download_export', job_id=job_id)
+    }), 202
+
+@app.route('/export_jobs/<string:job_id>')
+def export_job_status(job_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    conn = get_db_connection()
+    job = conn.execute('SELECT * FROM export_jobs WHERE id = ? AND user_id = ?', (job_id, session['user_id'])).fetchone()
+    conn.close()
+    if not job:
+        return jsonify({'error': 'Export not found'}), 404
+    return jsonify(export_job_dict(job))
+
+@app.route('/export_jobs/<string:job_id>/download')
+def download_export(job_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    job = conn.execute('SELECT * FROM export_jobs WHERE id = ? AND user_id = ?', (job_id, session['user_id'])).fetchone()
+    conn.close()
+    if not job or job['status'] != 'completed' or not os.path.exists(job['file_path']):
+        return "Export not found or not ready", 404
+    return send_file(
+        os.path.abspath(job['file_path']),
+        mimetype=EXPORT_FORMATS[job['format']],
+        as_attachment=True,
+        download_name=f"{job['data_type']}_{job['created_at'][:19].replace('-', '').replace(':', '').replace('T', '_')}.{job['format']}"
+    )
+
 @app.route('/import_expenses', methods=['GET', 'POST'])
 def import_expenses():
     if 'user_id' not in session:
@@ -2033,50 +5112,163 @@ def import_expenses():
             return redirect(request.url)
         
         if file and file.filename.endswith('.csv'):
-            stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
-            df = pd.read_csv(stream)
-            
-            # Save DF to session temporarily (not ideal for large files, but works for this demo)
-            # Better to save to a temp file or use a more robust state management
-            session['import_df'] = df.to_json()
-            return render_template('import_mapping.html', columns=df.columns.tolist())
+            conn = get_db_connection()
+            token = stage_upload(conn, session['user_id'], file)
+            conn.close()
+            return redirect(url_for('import_mapping', token=token))
             
-    return render_template('import_expenses.html')
+    conn = get_db_connection()
+    jobs = conn.execute(
+        'SELECT * FROM import_jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT 5', (session['user_id'],)
+    ).fetchall()
+    conn.close()
+    return render_template('import_expenses.html', import_jobs=[import_job_dict(job) for job in jobs])
+
+@app.route('/import_expenses/<string:token>')
+def import_mapping(token):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    staged = get_staged_upload(conn, token, session['user_id'])
+    conn.close()
+    if not staged:
+        flash('Upload expired or not found. Please upload the file again.')
+        return redirect(url_for('import_expenses'))
+
+    try:
+        columns, preview_rows = preview_staged_upload(staged['path'])
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        flash(f'Could not read CSV: {str(e)}')
+        return redirect(url_for('import_expenses'))
+    return render_template('import_mapping.html', columns=columns, preview_rows=preview_rows,
+                           token=token, filename=staged['filename'])
 
 @app.route('/process_import', methods=['POST'])
 def process_import():
-    if 'user_id' not in session or 'import_df' not in session:
+    if 'user_id' not in session:
         return redirect(url_for('login'))
     
     mapping = request.form.to_dict()
-    df_json = session.pop('import_df')
-    df = pd.read_json(io.StringIO(df_json))
+    token = mapping.pop('import_token', '')
+    duplicate_policy = mapping.pop('duplicate_policy', 'skip')
+    if duplicate_policy not in DUPLICATE_ACTIONS:
+        duplicate_policy = 'skip'
     
     conn = get_db_connection()
-    try:
-        for _, row in df.iterrows():
-            amount = float(row[mapping['amount']])
-            currency = row[mapping['currency']] if 'currency' in mapping and mapping['currency'] in row else 'USD'
-            category = row[mapping['category']] if 'category' in mapping and mapping['category'] in row else 'Miscellaneous'
-            description = row[mapping['description']] if 'description' in mapping and mapping['description'] in row else ''
-            date = row[mapping['date']] if 'date' in mapping and mapping['date'] in row else datetime.now().strftime('%Y-%m-%d')
-            
-            amount_usd = convert_to_usd(amount, currency)
-            
-            conn.execute(
-                '''INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date) 
-                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                (session['user_id'], amount, currency, amount_usd, category, description, str(date))
-            )
-        conn.commit()
-        flash('Expenses imported successfully!')
-    except Exception as e:
-        conn.rollback()
-        flash(f'Error importing expenses: {str(e)}')
-    finally:
+    staged = get_staged_upload(conn, token, session['user_id'])
+    if not staged:
         conn.close()
-        
-    return redirect(url_for('expenses'))
+        flash('Upload expired or not found. Please upload the file again.')
+        return redirect(url_for('import_expenses'))
+    submit_import_job(conn, session['user_id'], staged, mapping, duplicate_policy)
+    conn.close()
+    flash('Import started. You can follow its progress below.')
+    return redirect(url_for('import_expenses'))
+
+@app.route('/import_jobs/<string:job_id>')
+def import_job_status(job_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    conn = get_db_connection()
+    job = conn.execute('SELECT * FROM import_jobs WHERE id = ? AND user_id = ?', (job_id, session['user_id'])).fetchone()
+    conn.close()
+    if not job:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify(import_job_dict(job))
+
+@app.route('/import_jobs/<string:job_id>/resume', methods=['POST'])
+def resume_import_job(job_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    job = conn.execute('SELECT status, heartbeat_at FROM import_jobs WHERE id = ? AND user_id = ?',
+                       (job_id, session['user_id'])).fetchone()
+    conn.close()
+    if job and import_job_resumable(job):
+        enqueue_import_job(job_id)
+        flash('Import resumed from its last checkpoint.')
+    return redirect(url_for('import_expenses'))
+
+@app.route('/import_jobs/<string:job_id>/duplicates.csv')
+def import_duplicates_report(job_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    job = conn.execute('SELECT id FROM import_jobs WHERE id = ? AND user_id = ?', (job_id, session['user_id'])).fetchone()
+    if not job:
+        conn.close()
+        return "Import not found", 404
+    cursor = conn.execute('''
+        SELECT d.line, d.action, d.expense_id, e.date, e.amount, e.currency, e.category, d.previous_category,
+               e.description, d.previous_description
+        FROM import_duplicates d LEFT JOIN expenses e ON e.id = d.expense_id
+        WHERE d.job_id = ? ORDER BY d.line
+    ''', (job_id,))
+    columns = [col[0] for col in cursor.description]
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        while True:
+            rows = cursor.fetchmany(app.config['EXPORT_CHUNK_SIZE'])
+            if not rows:
+                break
+            # Merged rows show what the import changed; previous values are empty otherwise
+            descriptions = decrypt_many(value for row in rows for value in (row['description'], row['previous_description']))
+            writer.writerows(tuple(row)[:-2] + (descriptions[2 * i], descriptions[2 * i + 1]) for i, row in enumerate(rows))
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue().encode()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename=import_duplicates_{job_id[:8]}.csv'}
+    )
+
+@app.route('/import_jobs/<string:job_id>/rejections.csv')
+def import_rejections_report(job_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    job = conn.execute('SELECT * FROM import_jobs WHERE id = ? AND user_id = ?', (job_id, session['user_id'])).fetchone()
+    if not job:
+        conn.close()
+        return "Import not found", 404
+    cursor = conn.execute('SELECT line, reason, raw FROM import_rejections WHERE job_id = ? ORDER BY line', (job_id,))
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        columns = None
+        while True:
+            rows = cursor.fetchmany(app.config['EXPORT_CHUNK_SIZE'])
+            if not rows:
+                break
+            for row in rows:
+                raw = json.loads(row['raw'] or '{}')
+                if columns is None:
+                    columns = list(raw)
+                    writer.writerow(['line', 'reason', *columns])
+                writer.writerow([row['line'], row['reason'], *(raw.get(col) for col in columns)])
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if columns is None:
+            yield b'line,reason\r\n'
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename=import_rejections_{job_id[:8]}.csv'}
+    )
 
 @app.route('/bulk_delete_expenses', methods=['POST'])
 def bulk_delete_expenses():
@@ -2120,70 +5312,357 @@ def bulk_update_category():
     return jsonify({'success': True})
 
 # --- CHATBOT LOGIC ---
-def get_user_financial_context(user_id):
-    conn = get_db_connection()
-    
-    total_usd = conn.execute(
-        "SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id = ?", (user_id,)
-    ).fetchone()[0]
-    
-    month_start = datetime.now().replace(day=1).strftime('%Y-%m-%d')
-    monthly_usd = conn.execute(
-        "SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id = ? AND date >= ?",
-        (user_id, month_start)
-    ).fetchone()[0]
+app.config['CHAT_CONTEXT_CACHE_SIZE'] = 1024  # Users whose context and prompt are kept in memory
+app.config['CHAT_TREND_MONTHS'] = 6
+app.config['CHAT_MERCHANT_DAYS'] = 90  # Window for top merchants (descriptions are decrypted to group them)
+app.config['CHAT_TOP_MERCHANTS'] = 5
+
+def user_data_version(conn, user_id):
+    row = conn.execute('SELECT version FROM user_data_versions WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+def build_financial_context(conn, user_id, today=None):
+    """Aggregates the chatbot's view of a user: totals, categories, budgets, monthly trend and top merchants."""
+    today = today or datetime.now().date()
+    month_start = today.replace(day=1).strftime('%Y-%m-%d')
+    first_month = today.year * 12 + today.month - app.config['CHAT_TREND_MONTHS']
+    trend_start = f"{first_month // 12:04d}-{first_month % 12 + 1:02d}-01"
 
     categories = conn.execute(
-        "SELECT category, SUM(amount_usd) as total FROM expenses WHERE user_id = ? GROUP BY category",
-        (user_id,)
+        '''SELECT category, SUM(total_usd) AS total,
+                  COALESCE(SUM(CASE WHEN date >= ? THEN total_usd END), 0) AS monthly
+           FROM daily_spend_native WHERE user_id = ? GROUP BY category ORDER BY total DESC''',
+        (month_start, user_id)
+    ).fetchall()
+    months = conn.execute(
+        '''SELECT substr(date, 1, 7) AS month, SUM(total_usd) AS total
+           FROM daily_spend_native WHERE user_id = ? AND date >= ? GROUP BY month ORDER BY month''',
+        (user_id, trend_start)
     ).fetchall()
-    
     budgets = conn.execute("SELECT category, amount_usd FROM budgets WHERE user_id = ?", (user_id,)).fetchall()
-    conn.close()
+
+    recent = conn.execute(
+        'SELECT description, amount_usd FROM expenses WHERE user_id = ? AND date >= ?',
+        (user_id, (today - timedelta(days=app.config['CHAT_MERCHANT_DAYS'])).strftime('%Y-%m-%d'))
+    ).fetchall()
+    merchants = {}
+    for row, plaintext in zip(recent, decrypt_many(row['description'] for row in recent)):
+        name = normalize_description(plaintext)
+        if name:
+            total, count = merchants.get(name, (0.0, 0))
+            merchants[name] = (total + row['amount_usd'], count + 1)
+    top_merchants = sorted(merchants.items(), key=lambda item: -item[1][0])[:app.config['CHAT_TOP_MERCHANTS']]
 
     return {
-        "total_expenses_usd": round(total_usd, 2),
-        "monthly_expenses_usd": round(monthly_usd, 2),
+        "total_expenses_usd": round(sum(row["total"] for row in categories), 2),
+        "monthly_expenses_usd": round(sum(row["monthly"] for row in categories), 2),
         "categories": {row["category"]: round(row["total"], 2) for row in categories},
         "budgets": {row["category"]: round(row["amount_usd"], 2) for row in budgets},
+        "monthly_trend": {row["month"]: round(row["total"], 2) for row in months},
+        "top_merchants": [
+            {"name": name, "total_usd": round(total, 2), "count": count}
+            for name, (total, count) in top_merchants
+        ],
     }
 
-@app.route('/chatbot', methods=['POST'])
-def chatbot():
-    if 'user_id' not in session:
-        return {"reply": "Unauthorized"}, 401
-
-    data = request.get_json()
-    user_message = data.get("message", "").strip()
-
-    if not user_message:
-        return {"reply": "Please enter a message."}
-
-    context = get_user_financial_context(session['user_id'])
-    system_prompt = f"""
+def build_chat_prompt(context):
+    merchants = ', '.join(
+        f"{m['name']} ({m['total_usd']} over {m['count']} purchases)" for m in context['top_merchants']
+    ) or 'none'
+    return f"""
     You are a personal finance assistant.
     User data (USD):
     - Total expenses: {context['total_expenses_usd']}
     - Monthly expenses: {context['monthly_expenses_usd']}
     - Category totals: {context['categories']}
     - Budgets: {context['budgets']}
+    - Monthly totals (last {app.config['CHAT_TREND_MONTHS']} months): {context['monthly_trend']}
+    - Top merchants (last {app.config['CHAT_MERCHANT_DAYS']} days): {merchants}
     Rules: Do not invent data. Answer clearly.
     """
 
+
+class ChatContextCache:
+    """
+    Per-user LRU of (context, system prompt), keyed by the user's data version and the date.
+    A hit costs one primary-key lookup; the aggregates and prompt are rebuilt only after an
+    expense or budget write (or at midnight, since the monthly and merchant windows move).
+    """
+
+    def __init__(self, database, max_size):
+        self.database = database
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, conn, user_id):
+        today = datetime.now().date()
+        key = (user_data_version(conn, user_id), today)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] == key:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1], entry[2]
+        context = build_financial_context(conn, user_id, today)
+        prompt = build_chat_prompt(context)
+        with self._lock:
+            self.misses += 1
+            self._entries[user_id] = (key, context, prompt)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return context, prompt
+
+
+_chat_context_cache = None
+_chat_context_cache_lock = threading.Lock()
+
+def get_chat_context_cache():
+    global _chat_context_cache
+    with _chat_context_cache_lock:
+        if _chat_context_cache is None or _chat_context_cache.database != app.config['DATABASE']:
+            _chat_context_cache = ChatContextCache(app.config['DATABASE'], app.config['CHAT_CONTEXT_CACHE_SIZE'])
+        return _chat_context_cache
+
+def get_chat_context(user_id):
+    """Returns (context, system_prompt) for user_id, rebuilt only when their data changed."""
+    conn = get_db_connection()
     try:
+        return get_chat_context_cache().get(conn, user_id)
+    finally:
+        conn.close()
+
+def get_user_financial_context(user_id):
+    return get_chat_context(user_id)[0]
+
+# --- CHAT PROVIDERS ---
+app.config['CHAT_PROVIDER'] = 'groq'  # 'groq', or 'stub' for the deterministic offline backend
+app.config['CHAT_MODEL'] = 'llama-3.1-8b-instant'
+app.config['CHAT_MAX_TOKENS'] = 300
+app.config['CHAT_TEMPERATURE'] = 0.4
+app.config['CHAT_MAX_CONCURRENT'] = 8  # Replies generated at once per process; others get 429
+app.config['CHAT_SLOT_WAIT'] = 0.5  # Seconds a request waits for a free slot
+app.config['CHAT_FIRST_TOKEN_TIMEOUT'] = 15
+app.config['CHAT_TIMEOUT'] = 60  # Seconds for a whole reply
+app.config['CHAT_STUB_TOKEN_DELAY'] = 0.0  # Seconds between stub tokens, to simulate a slow model
+
+class ChatProvider(ABC):
+    """A chat backend: stream() yields reply text chunks for [{'role', 'content'}] messages."""
+
+    @abstractmethod
+    def stream(self, messages, cancel):
+        """Yields text chunks; should stop early once the `cancel` event is set."""
+
+
+class GroqChatProvider(ChatProvider):
+    def stream(self, messages, cancel):
         response = groq_client.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=0.4,
-            max_tokens=300
+            model=app.config['CHAT_MODEL'],
+            messages=messages,
+            temperature=app.config['CHAT_TEMPERATURE'],
+            max_tokens=app.config['CHAT_MAX_TOKENS'],
+            stream=True,
+            timeout=app.config['CHAT_TIMEOUT']
         )
-        return {"reply": response.choices[0].message.content}
+        try:
+            for chunk in response:
+                if cancel.is_set():
+                    break
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                if text:
+                    yield text
+        finally:
+            response.close()
+
+
+class StubChatProvider(ChatProvider):
+    """Offline provider for tests and load tests: echoes the question and the prompt's data lines."""
+
+    def stream(self, messages, cancel):
+        facts = [line.strip()[2:] for line in messages[0]['content'].splitlines() if line.strip().startswith('- ')]
+        reply = f"You asked: {messages[-1]['content']}. " + ' '.join(fact + '.' for fact in facts)
+        delay = app.config['CHAT_STUB_TOKEN_DELAY']
+        for i, word in enumerate(reply.split(' ')):
+            if cancel.is_set():
+                return
+            if delay:
+                time.sleep(delay)
+            yield word if i == 0 else ' ' + word
+
+
+CHAT_PROVIDERS = {
+    'groq': GroqChatProvider(),
+    'stub': StubChatProvider(),
+}
+
+def get_chat_provider():
+    return CHAT_PROVIDERS[app.config['CHAT_PROVIDER']]
+
+class ChatTimeout(Exception):
+    pass
+
+_chat_executor = None
+_chat_slots = None
+_chat_lock = threading.Lock()
+
+def _get_chat_executor():
+    """
+    Returns (executor, slots). Generation runs on the executor so a request thread never
+    blocks past its deadline on a stalled provider; `slots` caps concurrent replies.
+    """
+    global _chat_executor, _chat_slots
+    with _chat_lock:
+        if _chat_executor is None:
+            _chat_slots = threading.BoundedSemaphore(app.config['CHAT_MAX_CONCURRENT'])
+            _chat_executor = ThreadPoolExecutor(
+                max_workers=app.config['CHAT_MAX_CONCURRENT'], thread_name_prefix='chat'
+            )
+        return _chat_executor, _chat_slots
+
+class ChatSlot:
+    """
+    A reserved generation slot. The request frees it with release() until a reply starts;
+    from then on it belongs to the producer and is freed only when the producer thread exits,
+    so a provider still blocked after a timeout keeps its executor worker counted as busy.
+    """
+
+    def __init__(self, slots):
+        self._slots = slots
+        self._lock = threading.Lock()
+        self._released = False
+        self._producer = None
+
+    def hand_off(self, future):
+        with self._lock:
+            self._producer = future
+        future.add_done_callback(lambda _: self._free(producer=True))
+
+    def release(self):
+        self._free(producer=False)
+
+    def _free(self, producer):
+        with self._lock:
+            if self._released or (self._producer is not None and not producer):
+                return
+            self._released = True
+        self._slots.release()
+
+def acquire_chat_slot():
+    """Reserves a generation slot; returns a ChatSlot, or None when the chatbot is saturated."""
+    _, slots = _get_chat_executor()
+    if not slots.acquire(timeout=app.config['CHAT_SLOT_WAIT']):
+        return None
+    return ChatSlot(slots)
+
+def stream_chat_reply(messages, slot, provider=None):
+    """
+    Yields reply chunks from the provider, which runs on the chat executor and takes over `slot`.
+    Raises ChatTimeout when the first chunk or the whole reply misses its deadline; the provider
+    is then cancelled, and the slot is freed once it actually stops.
+    """
+    provider = provider or get_chat_provider()
+    executor, _ = _get_chat_executor()
+    chunks = queue.Queue()
+    cancel = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for text in provider.stream(messages, cancel):
+                chunks.put(text)
+            chunks.put(done)
+        except Exception as e:
+            chunks.put(e)
+
+    slot.hand_off(executor.submit(produce))
+    started = time.monotonic()
+    deadline = started + app.config['CHAT_TIMEOUT']
+    first_deadline = min(deadline, started + app.config['CHAT_FIRST_TOKEN_TIMEOUT'])
+    received = False
+    try:
+        while True:
+            remaining = (deadline if received else first_deadline) - time.monotonic()
+            try:
+                item = chunks.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                raise ChatTimeout('AI service timed out.')
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            received = True
+            yield item
+    finally:
+        cancel.set()
+
+def chat_messages(user_id, user_message):
+    _, system_prompt = get_chat_context(user_id)
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/chatbot', methods=['POST'])
+def chatbot():
+    if 'user_id' not in session:
+        return {"reply": "Unauthorized"}, 401
+
+    data = request.get_json()
+    user_message = data.get("message", "").strip()
+
+    if not user_message:
+        return {"reply": "Please enter a message."}
+
+    messages = chat_messages(session['user_id'], user_message)
+    slot = acquire_chat_slot()
+    if slot is None:
+        return {"reply": "The assistant is busy. Try again in a moment."}, 429
+    try:
+        return {"reply": ''.join(stream_chat_reply(messages, slot))}
     except Exception as e:
         print(e)
         return {"reply": "AI service error. Try again later."}
+    finally:
+        slot.release()
+
+@app.route('/chatbot/stream', methods=['POST'])
+def chatbot_stream():
+    """Streams the reply as server-sent events: `token` events, then `done` or `error`."""
+    if 'user_id' not in session:
+        return {"error": "Unauthorized"}, 401
+
+    data = request.get_json(silent=True) or {}
+    user_message = data.get("message", "").strip()
+    if not user_message:
+        return {"error": "Please enter a message."}, 400
+
+    messages = chat_messages(session['user_id'], user_message)
+    slot = acquire_chat_slot()
+    if slot is None:
+        return {"error": "The assistant is busy. Try again in a moment."}, 429
+
+    def generate():
+        try:
+            for text in stream_chat_reply(messages, slot):
+                yield sse_event('token', text)
+            yield sse_event('done', {})
+        except ChatTimeout as e:
+            yield sse_event('error', str(e))
+        except Exception as e:
+            print(e)
+            yield sse_event('error', 'AI service error. Try again later.')
+        finally:
+            slot.release()
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(slot.release)  # Frees the slot if the client leaves before the reply starts
+    return response
 
 # ================= NEW: SPLITWISE FEATURES =================
 
@@ -2308,27 +5787,27 @@ def add_group_expense(group_id):
     if 'user_id' not in session: 
         return redirect(url_for('login'))
     
-    amount = float(request.form['amount'])
     desc = request.form['description']
     payer_id = int(request.form['payer_id']) # Now we use the ID from the dropdown
+    split_mode = request.form.get('split_mode', 'equal')
     
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Insert Expense
-    cursor.execute('INSERT INTO group_expenses (group_id, payer_id, amount, description, date) VALUES (?, ?, ?, ?, ?)',
-                    (group_id, payer_id, amount, desc, datetime.now()))
-    expense_id = cursor.lastrowid
+    members = group_member_ids(conn, group_id)
     
-    # Split equally among ALL members
-    members = conn.execute('SELECT user_id FROM group_members WHERE group_id = ?', (group_id,)).fetchall()
-    if members:
-        split = amount / len(members)
-        for m in members:
-            conn.execute('INSERT INTO expense_splits (expense_id, user_id, amount_owed) VALUES (?, ?, ?)',
-                         (expense_id, m['user_id'], split))
-        conn.commit()
+    # Per-member values for unequal splits come in as split_<user_id> fields
+    values = {
+        user_id: request.form[f'split_{user_id}']
+        for user_id in members if request.form.get(f'split_{user_id}', '').strip()
+    }
+    try:
+        splits = compute_splits(to_cents(request.form['amount']), members, split_mode, values)
+    except ValueError as e:
+        conn.close()
+        flash(f'Could not add expense: {e}')
+        return redirect(url_for('group_detail', group_id=group_id))
     
+    insert_group_expenses(conn, group_id, [(payer_id, sum(cents for _, cents in splits), desc, datetime.now(), splits)])
+    conn.commit()
     conn.close()
     return redirect(url_for('group_detail', group_id=group_id))
 
@@ -2342,17 +5821,11 @@ def settle_up(group_id):
     amount = float(request.form['amount']) # Partial or Full amount
     
     conn = get_db_connection()
-    c = conn.cursor()
     
-    # Record Settlement as an Expense (Payer = Debtor)
-    c.execute('INSERT INTO group_expenses (group_id, payer_id, amount, description, date) VALUES (?, ?, ?, ?, ?)',
-              (group_id, payer_id, amount, "Settlement", datetime.now()))
-    exp_id = c.lastrowid
-    
-    # Assign the split fully to the Receiver (Creditor)
+    # Record Settlement as an Expense (Payer = Debtor), split fully to the Receiver (Creditor)
     # Math: Debtor Paid (+balance), Creditor Received (-balance)
-    c.execute('INSERT INTO expense_splits (expense_id, user_id, amount_owed) VALUES (?, ?, ?)',
-              (exp_id, receiver_id, amount))
+    cents = to_cents(amount)
+    insert_group_expenses(conn, group_id, [(payer_id, cents, "Settlement", datetime.now(), [(receiver_id, cents)])])
     
     conn.commit()
     conn.close()
@@ -2379,6 +5852,7 @@ def delete_group(group_id):
     conn.execute('DELETE FROM expense_splits WHERE expense_id IN (SELECT id FROM group_expenses WHERE group_id = ?)', (group_id,))
     conn.execute('DELETE FROM group_expenses WHERE group_id = ?', (group_id,))
     conn.execute('DELETE FROM group_members WHERE group_id = ?', (group_id,))
+    conn.execute('DELETE FROM group_balances WHERE group_id = ?', (group_id,))
     conn.execute('DELETE FROM groups WHERE id = ?', (group_id,))
     conn.commit()
     conn.close()
@@ -2408,7 +5882,8 @@ def delete_group_expense(group_id, expense_id):
             conn.close()
             return redirect(url_for('group_detail', group_id=group_id))
     
-    # Delete expense and splits
+    # Delete expense and splits, taking them out of the balances ledger
+    revert_group_expense(conn, group_id, expense_id)
     conn.execute('DELETE FROM expense_splits WHERE expense_id = ?', (expense_id,))
     conn.execute('DELETE FROM group_expenses WHERE id = ?', (expense_id,))
     conn.commit()
@@ -2438,22 +5913,132 @@ def activity_log():
     
     conn.close()
     
-    # Decrypt descriptions for the view
-    activity_list = []
-    for row in activities:
-        act = dict(row)
-        if act['type'] == 'Expense':
-            act['description'] = decrypt_data(act['description'])
-        activity_list.append(act)
+    # Decrypt descriptions for the view in one batch
+    activity_list = [dict(row) for row in activities]
+    expense_activities = [act for act in activity_list if act['type'] == 'Expense']
+    for act, plaintext in zip(expense_activities, decrypt_many(act['description'] for act in expense_activities)):
+        act['description'] = plaintext
     
     return render_template('activity_log.html', activities=activity_list)
 
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuilds the blind keyword index for all expense descriptions."""
+    conn = get_db_connection()
+    rebuild_search_index(conn)
+    conn.commit()
+    conn.close()
+    print("Search index rebuilt.")
+
+@app.cli.command('verify-group-balances')
+@click.option('--group-id', type=int, default=None, help='Only check this group.')
+@click.option('--rebuild', is_flag=True, help='Rebuild the ledger for groups that have drifted.')
+def verify_group_balances_command(group_id, rebuild):
+    """Reconciles the group_balances ledger against group_expenses and expense_splits."""
+    conn = get_db_connection()
+    mismatches = verify_group_balances(conn, group_id)
+    for gid, user_id, ledger, expected in mismatches:
+        print(f"  group {gid} user {user_id}: ledger {ledger:.2f}, expected {expected:.2f}")
+    if mismatches and rebuild:
+        for gid in sorted({gid for gid, *_ in mismatches}):
+            rebuild_group_balances(conn, gid)
+        conn.commit()
+        print(f"Rebuilt balances for {len({gid for gid, *_ in mismatches})} group(s).")
+    elif mismatches:
+        print(f"{len(mismatches)} balance(s) out of sync. Re-run with --rebuild to fix.")
+    else:
+        print("Group balances are in sync.")
+    conn.close()
+
+@app.cli.command('refresh-rates')
+def refresh_rates_command():
+    """Fetches the latest exchange rates into the shared cache now."""
+    if get_rate_cache().refresh(force=True):
+        print(f"Stored {len(get_rate_cache().rates())} exchange rate(s).")
+    else:
+        print("Rates not refreshed (fetch failed or another worker is refreshing).")
+
+@app.cli.command('load-fx-rates')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def load_fx_rates_command(path):
+    """Bulk-loads historical exchange rates (units per USD) from a CSV file."""
+    conn = get_db_connection()
+    stored = load_fx_rates(conn, path)
+    conn.close()
+    print(f"Stored {stored} historical rate(s).")
+
+@app.cli.command('cleanup-exports')
+def cleanup_exports_command():
+    """Removes expired export artifacts."""
+    conn = get_db_connection()
+    removed = cleanup_expired_exports(conn)
+    conn.close()
+    print(f"Removed {removed} expired export(s).")
+
+@app.cli.command('cleanup-imports')
+def cleanup_imports_command():
+    """Removes expired staged import uploads."""
+    conn = get_db_connection()
+    removed = cleanup_expired_uploads(conn)
+    conn.close()
+    print(f"Removed {removed} expired upload(s).")
+
+@app.cli.command('resume-imports')
+@click.option('--include-failed', is_flag=True, help='Also retry jobs that failed.')
+def resume_imports_command(include_failed):
+    """Resumes interrupted import jobs from their last checkpoint and waits for them."""
+    job_ids = resume_import_jobs(include_failed)
+    print(f"Resuming {len(job_ids)} import job(s).")
+    _get_import_executor().shutdown(wait=True)
+
+@app.cli.command('run-recurring')
+def run_recurring_command():
+    """Runs one recurring-expense sweep (for cron when the in-process scheduler is not used)."""
+    stats = run_recurring_sweep()
+    if stats is None:
+        print("Another worker is running the recurring sweep.")
+    else:
+        print(f"Created {stats['created']} expense(s) from {stats['masters']} due recurring master(s).")
+
+@app.cli.command('rotate-key')
+def rotate_key_command():
+    """Adds a new primary encryption key and schedules re-encryption of all descriptions."""
+    rotate_encryption_key()
+    conn = get_db_connection()
+    reset_reencryption_job(conn)
+    conn.commit()
+    conn.close()
+    print(f"New primary key added to {KEY_FILE}. Run 'flask reencrypt-descriptions' to re-encrypt existing data.")
+
+@app.cli.command('reencrypt-descriptions')
+@click.option('--chunk-size', type=int, default=None, help='Rows per transaction.')
+@click.option('--pause', type=float, default=None, help='Minimum seconds to sleep between chunks.')
+def reencrypt_descriptions_command(chunk_size, pause):
+    """Re-encrypts descriptions with the primary key (resumes an interrupted run)."""
+    def report(job):
+        done = job['last_id'] / job['target_id'] * 100 if job['target_id'] else 100
+        print(f"  {done:5.1f}% - {job['processed']} rows checked, {job['updated']} re-encrypted (last id {job['last_id']})")
+
+    job = run_reencryption_job(chunk_size=chunk_size, pause=pause, progress=report)
+    print(f"Re-encryption {job['status']}: {job['processed']} rows checked, {job['updated']} re-encrypted.")
+
+@app.cli.command('retire-old-keys')
+def retire_old_keys_command():
+    """Removes all but the primary key once re-encryption has completed."""
+    conn = get_db_connection()
+    job = get_maintenance_job(conn, REENCRYPT_JOB)
+    remaining = count_rows_on_old_keys(conn) if job and job['status'] == 'completed' else None
+    conn.close()
+    if not job or job['status'] != 'completed':
+        print("Re-encryption has not completed; keeping old keys.")
+        return
+    if remaining:
+        print(f"{remaining} description(s) are still encrypted with an old key; "
+              "run 'flask reencrypt-descriptions' again. Keeping old keys.")
+        return
+    retire_old_keys()
+    print("Old keys removed.")
+
 if __name__ == '__main__':
     init_db()
-    # Pre-fetch rates
-    try:
-        _RATES_CACHE["rates"] = _fetch_usd_rates()
-        _RATES_CACHE["timestamp"] = time.time()
-    except Exception:
-        pass
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,846 @@
+"""
+Performance benchmarks for the expense tracker.
+
+Each benchmark runs against throwaway databases/data and prints a small report.
+
+Usage:
+    python benchmarks.py sqlite-contention [--seconds 5] [--readers 4] [--writers 2] [--rows 20000]
+    python benchmarks.py decrypt [--rows 20000]
+    python benchmarks.py export [--rows 20000]
+    python benchmarks.py import [--rows 20000] [--skip-legacy]
+    python benchmarks.py recurrence [--rows 20000]
+    python benchmarks.py group-balances [--rows 20000]
+    python benchmarks.py settlement
+    python benchmarks.py group-splits [--rows 20000]
+    python benchmarks.py fx [--rows 20000]
+    python benchmarks.py display-currency [--rows 20000]
+    python benchmarks.py chat-context [--rows 20000]
+    python benchmarks.py chat-stream [--clients 32]
+"""
+import argparse
+import io
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from app import (EXPORT_QUERIES, compute_splits, convert_series, get_db_pool, get_fx_index, load_fx_rates, insert_group_expenses, recurrence_dates, ConnectionPool, _cached_decrypt_token, app, cipher_suite, compute_group_balances,
+                 convert_to_usd, read_group_balances, rebuild_group_balances, settle_balances, csv_chunks,
+                 decrypt_many, encrypt_data, get_db_connection, import_csv, index_expense_description,
+                 init_daily_spend_rollup, init_db, iter_export_rows, write_xlsx)
+
+# --- SQLITE CONTENTION ---
+# Rollback journal with the defaults the app used before the storage configuration layer
+LEGACY_STORAGE = {
+    'pragmas': {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'busy_timeout': 5000},
+    'isolation_level': '',
+}
+
+
+def _seed_expenses(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT NOT NULL DEFAULT 'USD',
+            amount_usd REAL NOT NULL,
+            category TEXT NOT NULL,
+            description TEXT,
+            date TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_expenses_user_date ON expenses(user_id, date)')
+    init_daily_spend_rollup(conn)
+    today = datetime.now()
+    categories = ['Food', 'Bills', 'Shopping', 'Transportation']
+    conn.executemany(
+        'INSERT INTO expenses (user_id, amount, amount_usd, category, description, date) VALUES (?, ?, ?, ?, ?, ?)',
+        [
+            (i % 10, 12.5, 12.5, categories[i % 4], 'seed', (today - timedelta(days=i % 365)).strftime('%Y-%m-%d'))
+            for i in range(rows)
+        ]
+    )
+    conn.commit()
+    conn.close()
+
+
+def _run_contention(path, storage, seconds, readers, writers):
+    pool = ConnectionPool(
+        path,
+        size=readers + writers,
+        pragmas=storage['pragmas'],
+        isolation_level=storage['isolation_level']
+    )
+    counts = {'reads': 0, 'writes': 0, 'read_errors': 0, 'write_errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def record(key):
+        with lock:
+            counts[key] += 1
+
+    def reader():
+        conn = pool.acquire()
+        while time.perf_counter() < deadline:
+            try:
+                user_id = random.randrange(10)
+                conn.execute('SELECT COALESCE(SUM(total_usd), 0) FROM daily_spend_native WHERE user_id = ?', (user_id,)).fetchone()
+                conn.execute(
+                    'SELECT * FROM expenses WHERE user_id = ? ORDER BY date DESC LIMIT 5', (user_id,)
+                ).fetchall()
+                record('reads')
+            except sqlite3.OperationalError:
+                record('read_errors')
+        pool.release(conn)
+
+    def writer():
+        conn = pool.acquire()
+        while time.perf_counter() < deadline:
+            try:
+                conn.executemany(
+                    'INSERT INTO expenses (user_id, amount, amount_usd, category, description, date) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(random.randrange(10), 9.99, 9.99, 'Food', 'bench', datetime.now().strftime('%Y-%m-%d'))] * 10
+                )
+                conn.commit()
+                record('writes')
+            except sqlite3.OperationalError:
+                conn.rollback()
+                record('write_errors')
+        pool.release(conn)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    pool.close_all()
+    return counts
+
+
+def bench_sqlite_contention(seconds=5, readers=4, writers=2, rows=20000):
+    """Compares read/write throughput of the legacy rollback journal against the configured storage layer."""
+    configs = {
+        'legacy (DELETE journal)': LEGACY_STORAGE,
+        'configured (WAL)': {
+            'pragmas': app.config['SQLITE_PRAGMAS'],
+            'isolation_level': app.config['SQLITE_ISOLATION_LEVEL'],
+        },
+    }
+    print(f"SQLite contention: {readers} readers, {writers} writers (10-row txns), {seconds}s, {rows} seeded rows")
+    print(f"{'storage':<26}{'reads/s':>10}{'writes/s':>10}{'read err':>10}{'write err':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, storage in configs.items():
+            path = os.path.join(tmp, f"{name.split()[0]}.db")
+            _seed_expenses(path, rows)
+            counts = _run_contention(path, storage, seconds, readers, writers)
+            print(f"{name:<26}{counts['reads'] / seconds:>10.0f}{counts['writes'] / seconds:>10.0f}"
+                  f"{counts['read_errors']:>10}{counts['write_errors']:>10}")
+
+
+# --- DECRYPTION ---
+def _legacy_decrypt(data):
+    """Row-by-row decrypt as it was before decrypt_many: try, and fall back on exception."""
+    if not data:
+        return ""
+    try:
+        return cipher_suite.decrypt(data.encode()).decode()
+    except Exception:
+        return data
+
+
+def bench_decrypt(rows=20000):
+    """Compares row-by-row decryption with decrypt_many (cold, cached and threaded)."""
+    # A realistic history: mostly encrypted, some legacy plaintext and repeated merchants
+    merchants = [f'Merchant {i}' for i in range(rows // 4)]
+    values = []
+    for i in range(rows):
+        if i % 5 == 0:
+            values.append(f'legacy note {i}')
+        else:
+            values.append(encrypt_data(merchants[i % len(merchants)]))
+
+    def timed(label, fn):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        print(f"{label:<32}{elapsed * 1000:>10.1f} ms{rows / elapsed:>14,.0f} rows/s")
+        return result
+
+    print(f"Decrypt {rows} descriptions ({rows // 5} legacy plaintext)")
+    expected = timed('row-by-row (exceptions)', lambda: [_legacy_decrypt(v) for v in values])
+    _cached_decrypt_token.cache_clear()
+    assert timed('decrypt_many (no cache)', lambda: decrypt_many(values, use_cache=False, parallel=False)) == expected
+    workers = app.config['DECRYPT_WORKERS']
+    app.config['DECRYPT_WORKERS'] = workers or 4
+    assert timed('decrypt_many (threads)', lambda: decrypt_many(values, use_cache=False, parallel=True)) == expected
+    app.config['DECRYPT_WORKERS'] = workers
+    timed('decrypt_many (cold cache)', lambda: decrypt_many(values, parallel=False))
+    assert timed('decrypt_many (warm cache)', lambda: decrypt_many(values, parallel=False)) == expected
+
+
+# --- EXPORT ---
+def _legacy_export_csv(conn, user_id):
+    """CSV export as it was before streaming: DataFrame, then StringIO, then BytesIO."""
+    df = pd.read_sql_query(EXPORT_QUERIES['expenses'], conn, params=(user_id,))
+    output = io.StringIO()
+    df.to_csv(output, index=False)
+    return io.BytesIO(output.getvalue().encode())
+
+
+def _streaming_export_csv(conn, user_id):
+    columns, chunks = iter_export_rows(conn, 'expenses', user_id)
+    for part in csv_chunks(columns, chunks):
+        part.encode()  # Handed to the WSGI server and dropped
+
+
+def _streaming_export_xlsx(conn, user_id):
+    columns, chunks = iter_export_rows(conn, 'expenses', user_id)
+    with tempfile.TemporaryFile() as output:
+        write_xlsx(output, 'Expenses', columns, chunks)
+
+
+def bench_export(rows=20000):
+    """Compares peak Python memory of the buffered CSV export with the streaming CSV/XLSX exports."""
+    print(f"Export {rows} expenses (one user)")
+    print(f"{'export':<26}{'time':>10}{'peak MB':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'export.db')
+        _seed_expenses(path, rows)
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        conn.execute('UPDATE expenses SET user_id = 1')
+        conn.commit()
+        for name, fn in [('buffered csv (legacy)', _legacy_export_csv),
+                         ('streaming csv', _streaming_export_csv),
+                         ('streaming xlsx', _streaming_export_xlsx)]:
+            tracemalloc.start()
+            started = time.perf_counter()
+            fn(conn, 1)
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{name:<26}{elapsed * 1000:>8.0f}ms{peak / 1e6:>10.1f}")
+        conn.close()
+
+
+# --- IMPORT ---
+IMPORT_MAPPING = {'amount': 'Amount', 'date': 'Date', 'currency': 'Currency', 'category': 'Category',
+                  'description': 'Description'}
+
+
+def _write_statement(path, rows):
+    """A bank-statement style CSV with repeated merchants."""
+    today = datetime.now()
+    categories = ['Food', 'Bills', 'Shopping', 'Transportation']
+    pd.DataFrame({
+        'Date': [(today - timedelta(days=i % 365)).strftime('%Y-%m-%d') for i in range(rows)],
+        'Amount': [round(1 + (i * 7919) % 20000 / 100, 2) for i in range(rows)],
+        'Currency': 'USD',
+        'Category': [categories[i % 4] for i in range(rows)],
+        'Description': [f'Card payment merchant {i % 500}' for i in range(rows)],
+    }).to_csv(path, index=False)
+
+
+def _legacy_import(conn, path, mapping, user_id):
+    """The import loop as it was: whole DataFrame, iterrows and one INSERT per row."""
+    df = pd.read_csv(path)
+    for _, row in df.iterrows():
+        amount = float(row[mapping['amount']])
+        currency = row[mapping['currency']]
+        description = str(row[mapping['description']])
+        cursor = conn.execute(
+            '''INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (user_id, amount, currency, convert_to_usd(amount, currency), row[mapping['category']],
+             encrypt_data(description), str(row[mapping['date']]))
+        )
+        index_expense_description(conn, user_id, cursor.lastrowid, description)
+    conn.commit()
+
+
+def bench_import(rows=20000, skip_legacy=False):
+    """Compares the per-row iterrows import with the chunked import pipeline."""
+    print(f"Import a {rows}-row statement")
+    print(f"{'import':<26}{'time':>10}{'rows/s':>12}")
+    original_db = app.config['DATABASE']
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'statement.csv')
+        _write_statement(csv_path, rows)
+        runs = [('chunked pipeline', lambda conn: import_csv(conn, csv_path, IMPORT_MAPPING, 1))]
+        if not skip_legacy:
+            runs.insert(0, ('iterrows (legacy)', lambda conn: _legacy_import(conn, csv_path, IMPORT_MAPPING, 1)))
+        try:
+            for name, fn in runs:
+                app.config['DATABASE'] = os.path.join(tmp, f"{name.split()[0]}.db")
+                with app.app_context():
+                    init_db()
+                    conn = get_db_connection()
+                    conn.execute("INSERT INTO users (username, email, password) VALUES ('bench', 'bench@example.com', 'x')")
+                    conn.commit()
+                    started = time.perf_counter()
+                    fn(conn)
+                    elapsed = time.perf_counter() - started
+                print(f"{name:<26}{elapsed:>9.2f}s{rows / elapsed:>12,.0f}")
+        finally:
+            app.config['DATABASE'] = original_db
+
+
+# --- RECURRENCE ---
+def _legacy_backfill(next_due, frequency, today):
+    """The month-add loop as it was in process_recurring_expenses, run until caught up."""
+    dates = []
+    while next_due <= today:
+        dates.append(next_due)
+        if frequency == 'monthly':
+            month = next_due.month + 1
+            year = next_due.year
+            if month > 12:
+                month = 1
+                year += 1
+            try:
+                next_due = next_due.replace(year=year, month=month)
+            except ValueError:
+                import calendar
+                last_day = calendar.monthrange(year, month)[1]
+                next_due = next_due.replace(year=year, month=month, day=last_day)
+        elif frequency == 'yearly':
+            try:
+                next_due = next_due.replace(year=next_due.year + 1)
+            except ValueError:  # Feb 29; the original raised here
+                next_due = next_due.replace(year=next_due.year + 1, day=28)
+        else:
+            next_due = next_due + timedelta(days=7)
+    return dates
+
+
+def bench_recurrence(rows=20000):
+    """Backfills `rows` recurring masters up to today: per-master loop vs one vectorized call."""
+    today = datetime.now().date()
+    frequencies = ['monthly', 'weekly', 'yearly']
+    masters = [
+        (today - timedelta(days=30 + (i * 37) % 1800), frequencies[i % 3])
+        for i in range(rows)
+    ]
+    print(f"Backfill {rows} recurring masters (anchors up to 5 years old)")
+    print(f"{'calculator':<26}{'time':>10}{'occurrences':>14}")
+
+    started = time.perf_counter()
+    legacy = 0
+    for anchor, frequency in masters:
+        legacy += len(_legacy_backfill(anchor, frequency, today)) - 1  # Minus the anchor itself
+    elapsed = time.perf_counter() - started
+    print(f"{'per-master loop':<26}{elapsed * 1000:>8.0f}ms{legacy:>14,}")
+
+    started = time.perf_counter()
+    series, dates = recurrence_dates(
+        [anchor for anchor, _ in masters], [frequency for _, frequency in masters], [1] * rows,
+        [anchor + timedelta(days=1) for anchor, _ in masters], today
+    )
+    elapsed = time.perf_counter() - started
+    print(f"{'vectorized':<26}{elapsed * 1000:>8.0f}ms{len(dates):>14,}")
+
+
+
+# --- GROUP BALANCES ---
+def _legacy_group_balances(conn, group_id):
+    """The per-expense split lookups calculate_group_debts used to run; returns (balances, queries)."""
+    members = conn.execute('SELECT user_id FROM group_members WHERE group_id = ?', (group_id,)).fetchall()
+    balances = {row['user_id']: 0.0 for row in members}
+    queries = 2
+    for exp in conn.execute('SELECT * FROM group_expenses WHERE group_id = ?', (group_id,)).fetchall():
+        splits = conn.execute('SELECT user_id, amount_owed FROM expense_splits WHERE expense_id = ?', (exp['id'],)).fetchall()
+        queries += 1
+        if exp['description'] == 'Settlement':
+            if splits:
+                balances[exp['payer_id']] += exp['amount']
+                balances[splits[0]['user_id']] -= exp['amount']
+        else:
+            balances[exp['payer_id']] += exp['amount']
+            for split in splits:
+                balances[split['user_id']] -= split['amount_owed']
+    return balances, queries
+
+
+def bench_group_balances(rows=20000, members=8):
+    """Balances for one group with `rows` expenses: per-expense queries vs one grouped query vs the ledger."""
+    original_db = app.config['DATABASE']
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['DATABASE'] = os.path.join(tmp, 'groups.db')
+        try:
+            with app.app_context():
+                init_db()
+                conn = get_db_connection()
+                conn.executemany(
+                    'INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                    [(f'user{i}', f'user{i}@example.com', 'x') for i in range(members)]
+                )
+                conn.execute("INSERT INTO groups (name, created_by, created_at) VALUES ('bench', 1, '2024-01-01')")
+                conn.executemany(
+                    "INSERT INTO group_members (group_id, user_id, joined_at) VALUES (1, ?, '2024-01-01')",
+                    [(uid,) for uid in range(1, members + 1)]
+                )
+                rng = random.Random(17)
+                expenses, splits = [], []
+                for expense_id in range(1, rows + 1):
+                    amount = round(rng.uniform(5, 200), 2)
+                    payer = rng.randint(1, members)
+                    if expense_id % 20 == 0:
+                        expenses.append((expense_id, payer, amount, 'Settlement'))
+                        splits.append((expense_id, payer % members + 1, amount))
+                    else:
+                        expenses.append((expense_id, payer, amount, 'Dinner'))
+                        splits.extend((expense_id, uid, amount / members) for uid in range(1, members + 1))
+                conn.executemany(
+                    "INSERT INTO group_expenses (id, group_id, payer_id, amount, description, date) VALUES (?, 1, ?, ?, ?, '2024-01-01')",
+                    expenses
+                )
+                conn.executemany('INSERT INTO expense_splits (expense_id, user_id, amount_owed) VALUES (?, ?, ?)', splits)
+                conn.commit()
+
+                print(f"Balances for one group: {members} members, {rows} expenses, {len(splits)} splits")
+                print(f"{'strategy':<26}{'time':>10}{'queries':>10}")
+
+                conn.execute('DROP INDEX idx_expense_splits_expense')
+                conn.execute('DROP INDEX idx_group_expenses_group')
+                started = time.perf_counter()
+                legacy, queries = _legacy_group_balances(conn, 1)
+                elapsed = time.perf_counter() - started
+                print(f"{'per-expense, no index':<26}{elapsed * 1000:>8.0f}ms{queries:>10,}")
+
+                init_db()
+                started = time.perf_counter()
+                legacy, queries = _legacy_group_balances(conn, 1)
+                elapsed = time.perf_counter() - started
+                print(f"{'per-expense, indexed':<26}{elapsed * 1000:>8.0f}ms{queries:>10,}")
+
+                started = time.perf_counter()
+                balances = compute_group_balances(conn, 1)
+                elapsed = time.perf_counter() - started
+                print(f"{'grouped query':<26}{elapsed * 1000:>8.0f}ms{1:>10,}")
+                assert all(abs(balances[uid][1] - legacy[uid]) < 1e-6 for uid in legacy)
+
+                rebuild_group_balances(conn, 1)
+                conn.commit()
+                started = time.perf_counter()
+                ledger = read_group_balances(conn, 1)
+                elapsed = time.perf_counter() - started
+                print(f"{'group_balances ledger':<26}{elapsed * 1000:>8.2f}ms{1:>10,}")
+                assert all(abs(ledger[uid][1] - legacy[uid]) < 1e-6 for uid in legacy)
+                conn.close()
+        finally:
+            app.config['DATABASE'] = original_db
+
+
+
+# --- SETTLEMENT ---
+def _legacy_settle(balances):
+    """The float greedy matching calculate_group_debts used before the settlement solver."""
+    debtors = [{'id': uid, 'amount': amount} for uid, amount in balances.items() if amount < -0.01]
+    creditors = [{'id': uid, 'amount': amount} for uid, amount in balances.items() if amount > 0.01]
+    debtors.sort(key=lambda x: x['amount'])
+    creditors.sort(key=lambda x: x['amount'], reverse=True)
+    transactions = []
+    d_idx = c_idx = 0
+    while d_idx < len(debtors) and c_idx < len(creditors):
+        debtor, creditor = debtors[d_idx], creditors[c_idx]
+        amount = min(abs(debtor['amount']), creditor['amount'])
+        transactions.append((debtor['id'], creditor['id'], round(amount, 2)))
+        debtor['amount'] += amount
+        creditor['amount'] -= amount
+        if abs(debtor['amount']) < 0.01:
+            d_idx += 1
+        if creditor['amount'] < 0.01:
+            c_idx += 1
+    return transactions
+
+
+def _synthetic_group_cents(members, rng):
+    """Balances in cents from households that mostly split among themselves, plus some group-wide bills."""
+    cents = dict.fromkeys(range(1, members + 1), 0)
+    uids = list(cents)
+    rng.shuffle(uids)
+    households = []
+    while uids:
+        size = min(rng.randint(2, 4), len(uids))
+        households.append(uids[:size])
+        uids = uids[size:]
+    for household in households:
+        for _ in range(5):
+            amount = rng.randint(500, 20000)
+            payer = rng.choice(household)
+            share, remainder = divmod(amount, len(household))
+            cents[payer] += amount
+            for i, uid in enumerate(household):
+                cents[uid] -= share + (1 if i < remainder else 0)
+    for _ in range(max(1, members // 10)):
+        household = rng.choice(households) + rng.choice(households)
+        household = list(dict.fromkeys(household))
+        amount = rng.randint(500, 20000)
+        share, remainder = divmod(amount, len(household))
+        cents[rng.choice(household)] += amount
+        for i, uid in enumerate(household):
+            cents[uid] -= share + (1 if i < remainder else 0)
+    return cents
+
+
+def bench_settlement(sizes=(5, 10, 15, 20, 50, 100, 500), groups=20):
+    """Transfers and solve time per group: legacy float greedy vs the cents solver (exact when small)."""
+    rng = random.Random(19)
+    print(f"Settle {groups} synthetic groups per size (avg transfers / avg time per group)")
+    print(f"{'members':>8}{'legacy':>10}{'solver':>10}{'heuristic':>11}{'legacy ms':>12}{'solver ms':>12}")
+    for members in sizes:
+        totals = {'legacy': [0, 0.0], 'solver': [0, 0.0], 'heuristic': [0, 0.0]}
+        for _ in range(groups):
+            cents = _synthetic_group_cents(members, rng)
+            runs = {
+                'legacy': lambda: _legacy_settle({uid: amount / 100 for uid, amount in cents.items()}),
+                'solver': lambda: settle_balances(cents),
+                'heuristic': lambda: settle_balances(cents, exact_max_members=0),
+            }
+            for name, run in runs.items():
+                started = time.perf_counter()
+                transfers = run()
+                totals[name][1] += time.perf_counter() - started
+                totals[name][0] += len(transfers)
+        print(f"{members:>8}{totals['legacy'][0] / groups:>10.1f}{totals['solver'][0] / groups:>10.1f}"
+              f"{totals['heuristic'][0] / groups:>11.1f}{totals['legacy'][1] / groups * 1000:>12.2f}"
+              f"{totals['solver'][1] / groups * 1000:>12.2f}")
+
+
+
+# --- GROUP SPLITS ---
+def _legacy_add_group_expense(conn, group_id, payer_id, amount, description):
+    """add_group_expense before split modes: one INSERT per member and float shares."""
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO group_expenses (group_id, payer_id, amount, description, date) VALUES (?, ?, ?, ?, ?)',
+                   (group_id, payer_id, amount, description, datetime.now()))
+    expense_id = cursor.lastrowid
+    members = conn.execute('SELECT user_id FROM group_members WHERE group_id = ?', (group_id,)).fetchall()
+    split = amount / len(members)
+    for m in members:
+        conn.execute('INSERT INTO expense_splits (expense_id, user_id, amount_owed) VALUES (?, ?, ?)',
+                     (expense_id, m['user_id'], split))
+
+
+def bench_group_splits(rows=20000, members=50):
+    """
+    Adds `rows` equal-split expenses to a `members`-member group: one add_group_expense-style
+    request per expense vs one bulk batch.
+    'cents lost' counts expenses whose shares, rounded to cents, no longer add up to the total.
+    """
+    original_db = app.config['DATABASE']
+    rng = random.Random(20)
+    amounts = [round(rng.uniform(1, 500), 2) for _ in range(rows)]
+    print(f"Add {rows} expenses split equally across {members} members")
+    print(f"{'strategy':<26}{'time':>10}{'rows/s':>12}{'cents lost':>14}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ('per-expense commits', 'executemany batch'):
+            app.config['DATABASE'] = os.path.join(tmp, f'{name.split()[0]}.db')
+            try:
+                with app.app_context():
+                    init_db()
+                    conn = get_db_connection()
+                    conn.executemany('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                                     [(f'user{i}', f'user{i}@example.com', 'x') for i in range(members)])
+                    conn.execute("INSERT INTO groups (name, created_by, created_at) VALUES ('bench', 1, '2024-01-01')")
+                    conn.executemany("INSERT INTO group_members (group_id, user_id, joined_at) VALUES (1, ?, '2024-01-01')",
+                                     [(uid,) for uid in range(1, members + 1)])
+                    conn.commit()
+                    member_ids = list(range(1, members + 1))
+
+                    started = time.perf_counter()
+                    if name == 'per-expense commits':
+                        for amount in amounts:  # One request, one commit per expense
+                            _legacy_add_group_expense(conn, 1, 1, amount, 'Dinner')
+                            conn.commit()
+                    else:
+                        insert_group_expenses(conn, 1, [
+                            (1, round(amount * 100), 'Dinner', '2024-01-01',
+                             compute_splits(round(amount * 100), member_ids))
+                            for amount in amounts
+                        ])
+                    conn.commit()
+                    elapsed = time.perf_counter() - started
+                    off = conn.execute('''
+                        SELECT COUNT(*) FROM (
+                            SELECT e.amount, SUM(ROUND(s.amount_owed * 100)) AS owed_cents FROM group_expenses e
+                            JOIN expense_splits s ON s.expense_id = e.id GROUP BY e.id
+                        ) WHERE owed_cents != ROUND(amount * 100)
+                    ''').fetchone()[0]
+                    conn.close()
+                print(f"{name:<26}{elapsed:>9.2f}s{rows / elapsed:>12,.0f}{off:>14,}")
+            finally:
+                app.config['DATABASE'] = original_db
+
+
+
+# --- HISTORICAL FX ---
+def bench_fx(rows=20000, currencies=30, years=6):
+    """Converts `rows` dated amounts at historical rates: per-row convert_to_usd vs convert_series."""
+    original_db = app.config['DATABASE']
+    rng = random.Random(22)
+    days = pd.date_range(end=datetime.now().date(), periods=365 * years).strftime('%Y-%m-%d').tolist()
+    codes = ['EUR', 'GBP', 'INR', 'JPY'] + [f'X{i:02d}' for i in range(currencies - 4)]
+    history = io.StringIO()
+    history.write('date,currency,rate\n')
+    for day in days:
+        for code in codes:
+            history.write(f'{day},{code},{rng.uniform(0.5, 150):.6f}\n')
+    history.seek(0)
+    sample = [(rng.uniform(1, 500), rng.choice(codes + ['USD']), rng.choice(days)) for _ in range(rows)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['DATABASE'] = os.path.join(tmp, 'fx.db')
+        try:
+            with app.app_context():
+                init_db()
+            conn = get_db_pool().acquire()
+            started = time.perf_counter()
+            stored = load_fx_rates(conn, history)
+            conn.close()
+            print(f"Loaded {stored:,} historical rates in {time.perf_counter() - started:.2f}s")
+            started = time.perf_counter()
+            get_fx_index()
+            print(f"Built the in-memory index in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+            print(f"{'strategy':<26}{'time':>10}{'rows/s':>12}")
+            started = time.perf_counter()
+            per_row = [convert_to_usd(amount, code, day) for amount, code, day in sample]
+            elapsed = time.perf_counter() - started
+            print(f"{'per-row convert_to_usd':<26}{elapsed:>9.2f}s{rows / elapsed:>12,.0f}")
+
+            amounts, currency_codes, dates = zip(*sample)
+            started = time.perf_counter()
+            vectorized = convert_series(amounts, currency_codes, dates)
+            elapsed = time.perf_counter() - started
+            print(f"{'convert_series':<26}{elapsed:>9.2f}s{rows / elapsed:>12,.0f}")
+            assert vectorized.tolist() == per_row
+        finally:
+            app.config['DATABASE'] = original_db
+
+
+def bench_display_currency(rows=20000, categories=40, requests=20):
+    """Renders dashboard, budgets and a 365-day analytics page, counting display-rate lookups per request."""
+    import app as app_module
+
+    original_db = app.config['DATABASE']
+    rng = random.Random(23)
+    today = datetime.now()
+    names = [f'Category {i:02d}' for i in range(categories)]
+    rates = {'USD': 1.0, 'INR': 83.37, 'EUR': 0.92}
+    expenses = []
+    for _ in range(rows):
+        code = rng.choice(list(rates))
+        amount = round(rng.uniform(1, 5000), 2)
+        day = (today - timedelta(days=rng.randrange(730))).strftime('%Y-%m-%d')
+        expenses.append((amount, code, round(amount / rates[code], 2), rng.choice(names), day))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['DATABASE'] = os.path.join(tmp, 'display.db')
+        app.config['FX_RATE_SOURCE'] = lambda: rates
+        lookups = []
+        real_rate = app_module.get_usd_rate
+        app_module.get_usd_rate = lambda *args: lookups.append(args) or real_rate(*args)
+        try:
+            with app.app_context():
+                init_db()
+                conn = get_db_connection()
+                conn.execute("INSERT INTO users (username, email, password) VALUES ('bench', 'bench@example.com', 'x')")
+                conn.executemany(
+                    'INSERT INTO expenses (user_id, amount, currency, amount_usd, category, date) VALUES (1, ?, ?, ?, ?, ?)',
+                    expenses
+                )
+                conn.executemany(
+                    "INSERT INTO budgets (user_id, category, amount, currency, amount_usd, period, start_date) "
+                    "VALUES (1, ?, 50000, 'INR', ?, 'monthly', ?)",
+                    [(name, 50000 / rates['INR'], today.strftime('%Y-%m-%d')) for name in names]
+                )
+                conn.commit()
+                conn.close()
+            app_module.get_rate_cache().refresh(force=True)
+
+            print(f"{'page':<24}{'ms/request':>12}{'rate lookups':>14}")
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess['user_id'] = 1
+                    sess['currency'] = 'INR'
+                for page in ('/dashboard', '/budgets', '/analytics?range=365'):
+                    client.get(page)
+                    lookups.clear()
+                    started = time.perf_counter()
+                    for _ in range(requests):
+                        assert client.get(page).status_code == 200
+                    elapsed = (time.perf_counter() - started) / requests
+                    print(f"{page:<24}{elapsed * 1000:>12.1f}{len(lookups) / requests:>14.0f}")
+
+            inr = [(amount, amount_usd) for amount, code, amount_usd, _, _ in expenses if code == 'INR']
+            native = round(sum(amount for amount, _ in inr), 2)
+            via_usd = round(sum(amount_usd for _, amount_usd in inr) * rates['INR'], 2)
+            print(f"INR expenses summed natively: {native:,.2f}; via USD: {via_usd:,.2f} (drift {via_usd - native:+.2f})")
+        finally:
+            app_module.get_usd_rate = real_rate
+            app.config['DATABASE'] = original_db
+            app.config['FX_RATE_SOURCE'] = None
+
+
+def _legacy_financial_context(conn, user_id):
+    """The chatbot context before caching: four aggregates plus the prompt on every message."""
+    total_usd = conn.execute("SELECT COALESCE(SUM(total_usd), 0) FROM daily_spend_native WHERE user_id = ?", (user_id,)).fetchone()[0]
+    month_start = datetime.now().replace(day=1).strftime('%Y-%m-%d')
+    monthly_usd = conn.execute("SELECT COALESCE(SUM(total_usd), 0) FROM daily_spend_native WHERE user_id = ? AND date >= ?",
+                               (user_id, month_start)).fetchone()[0]
+    categories = conn.execute("SELECT category, SUM(total_usd) as total FROM daily_spend_native WHERE user_id = ? GROUP BY category",
+                              (user_id,)).fetchall()
+    budgets = conn.execute("SELECT category, amount_usd FROM budgets WHERE user_id = ?", (user_id,)).fetchall()
+    return f"""
+    Total expenses: {round(total_usd, 2)}
+    Monthly expenses: {round(monthly_usd, 2)}
+    Category totals: {({row["category"]: round(row["total"], 2) for row in categories})}
+    Budgets: {({row["category"]: round(row["amount_usd"], 2) for row in budgets})}
+    """
+
+
+def bench_chat_context(rows=20000, turns=200):
+    """Per-message cost of the chatbot context: legacy aggregates vs cold build vs cached hit."""
+    import app as app_module
+
+    original_db = app.config['DATABASE']
+    rng = random.Random(24)
+    today = datetime.now()
+    merchants = [f'Merchant {i}' for i in range(300)]
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['DATABASE'] = os.path.join(tmp, 'chat.db')
+        try:
+            with app.app_context():
+                init_db()
+                conn = get_db_connection()
+                conn.execute("INSERT INTO users (username, email, password) VALUES ('bench', 'bench@example.com', 'x')")
+                conn.executemany(
+                    'INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date) VALUES (1, ?, ?, ?, ?, ?, ?)',
+                    [(amount, 'USD', amount, f'Category {rng.randrange(20)}', encrypt_data(rng.choice(merchants)),
+                      (today - timedelta(days=rng.randrange(1095))).strftime('%Y-%m-%d'))
+                     for amount in (round(rng.uniform(1, 300), 2) for _ in range(rows))]
+                )
+                conn.commit()
+
+                print(f"{'strategy':<26}{'ms/message':>12}")
+                started = time.perf_counter()
+                for _ in range(turns):
+                    _legacy_financial_context(conn, 1)
+                print(f"{'legacy (4 aggregates)':<26}{(time.perf_counter() - started) / turns * 1000:>12.2f}")
+
+                _cached_decrypt_token.cache_clear()
+                started = time.perf_counter()
+                app_module.get_chat_context(1)
+                print(f"{'cold build':<26}{(time.perf_counter() - started) * 1000:>12.2f}")
+
+                started = time.perf_counter()
+                for _ in range(turns):
+                    app_module.get_chat_context(1)
+                print(f"{'cached':<26}{(time.perf_counter() - started) / turns * 1000:>12.3f}")
+                conn.close()
+        finally:
+            app.config['DATABASE'] = original_db
+
+
+def bench_chat_stream(clients=32, token_delay=0.02):
+    """Concurrent chat requests against the stub provider: first-token vs full-reply latency and 429s."""
+    original = {key: app.config[key] for key in ('DATABASE', 'CHAT_PROVIDER', 'CHAT_STUB_TOKEN_DELAY')}
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config.update(DATABASE=os.path.join(tmp, 'chat.db'), CHAT_PROVIDER='stub', CHAT_STUB_TOKEN_DELAY=token_delay)
+        try:
+            with app.app_context():
+                init_db()
+                conn = get_db_connection()
+                conn.execute("INSERT INTO users (username, email, password) VALUES ('bench', 'bench@example.com', 'x')")
+                conn.commit()
+                conn.close()
+
+            def run(path, results):
+                with app.test_client() as client:
+                    with client.session_transaction() as sess:
+                        sess['user_id'] = 1
+                    started = time.perf_counter()
+                    response = client.post(path, json={'message': 'How am I doing?'}, buffered=False)
+                    first = None
+                    for _ in response.response:
+                        first = first or time.perf_counter() - started
+                    response.close()
+                    results.append((response.status_code, first, time.perf_counter() - started))
+
+            print(f"{'endpoint':<18}{'ok':>5}{'429':>6}{'first token':>14}{'full reply':>13}")
+            for path in ('/chatbot', '/chatbot/stream'):
+                results = []
+                threads = [threading.Thread(target=run, args=(path, results)) for _ in range(clients)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                ok = [result for result in results if result[0] == 200]
+                first = sum(result[1] for result in ok) / len(ok)
+                full = sum(result[2] for result in ok) / len(ok)
+                print(f"{path:<18}{len(ok):>5}{len(results) - len(ok):>6}{first * 1000:>12.0f}ms{full * 1000:>11.0f}ms")
+        finally:
+            app.config.update(original)
+
+
+BENCHMARKS = {
+    'sqlite-contention': bench_sqlite_contention,
+    'decrypt': bench_decrypt,
+    'export': bench_export,
+    'import': bench_import,
+    'recurrence': bench_recurrence,
+    'group-balances': bench_group_balances,
+    'settlement': bench_settlement,
+    'group-splits': bench_group_splits,
+    'fx': bench_fx,
+    'display-currency': bench_display_currency,
+    'chat-context': bench_chat_context,
+    'chat-stream': bench_chat_stream,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--skip-legacy', action='store_true', help='Only run the new code path (import).')
+    args = parser.parse_args()
+
+    if args.benchmark == 'sqlite-contention':
+        bench_sqlite_contention(args.seconds, args.readers, args.writers, args.rows)
+    elif args.benchmark == 'decrypt':
+        bench_decrypt(args.rows)
+    elif args.benchmark == 'export':
+        bench_export(args.rows)
+    elif args.benchmark == 'import':
+        bench_import(args.rows, args.skip_legacy)
+    elif args.benchmark == 'recurrence':
+        bench_recurrence(args.rows)
+    elif args.benchmark == 'group-balances':
+        bench_group_balances(args.rows)
+    elif args.benchmark == 'settlement':
+        bench_settlement()
+    elif args.benchmark == 'group-splits':
+        bench_group_splits(args.rows)
+    elif args.benchmark == 'fx':
+        bench_fx(args.rows)
+    elif args.benchmark == 'display-currency':
+        bench_display_currency(args.rows)
+    elif args.benchmark == 'chat-context':
+        bench_chat_context(args.rows)
+    elif args.benchmark == 'chat-stream':
+        bench_chat_stream(args.clients)
@@ -1,2 +1,36 @@
 // Basic JavaScript file for Expense Tracker
-console.log("Expense Tracker loaded successfully!");
\ No newline at end of file
+console.log("Expense Tracker loaded successfully!");
+
+// Export jobs: links with data-export-job are rendered in the background and
+// downloaded once ready, instead of holding the request open. The plain href
+// stays as a fallback when JavaScript is unavailable.
+document.addEventListener('click', async (event) => {
+    const link = event.target.closest('[data-export-job]');
+    if (!link) return;
+    event.preventDefault();
+    if (link.dataset.running) return;
+    link.dataset.running = '1';
+    const label = link.textContent;
+
+    try {
+        const response = await fetch(link.dataset.exportJob, { method: 'POST' });
+        const job = await response.json();
+        if (!response.ok) throw new Error(job.error || 'Export failed');
+
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const status = await (await fetch(job.status_url)).json();
+            if (status.status === 'completed') {
+                window.location = job.download_url;
+                break;
+            }
+            if (status.status === 'failed') throw new Error(status.error || 'Export failed');
+            link.textContent = `${label} (${status.progress}%)`;
+        }
+    } catch (err) {
+        alert(err.message);
+    } finally {
+        link.textContent = label;
+        delete link.dataset.running;
+    }
+});
@@ -3,6 +3,9 @@ import sqlite3
 import os
 from app import app, get_db_connection, init_db
 
+# Tests switch DATABASE per test; background threads are started explicitly where needed
+app.config['BACKGROUND_WORKERS'] = False
+
 # --- TEST 1: Check Imports ---
 def test_imports():
     """Ensures all required modules are installed."""
@@ -51,4 +54,1185 @@ def test_routes():
         for route, valid_codes in routes.items():
             response = client.get(route)
             assert response.status_code in valid_codes, \
-                f"Route {route} failed. Got {response.status_code}"
\ No newline at end of file
+                f"Route {route} failed. Got {response.status_code}"
+
+# --- TEST 4: Analytics Aggregation ---
+def test_aggregate_analytics_matches_per_day_queries():
+    """The single-scan analytics aggregates must match the per-day SUM queries."""
+    from datetime import datetime, timedelta
+    from app import aggregate_analytics, init_daily_spend_rollup
+
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE expenses (id INTEGER PRIMARY KEY, user_id INTEGER, amount REAL, currency TEXT, amount_usd REAL, category TEXT, date TEXT)')
+    init_daily_spend_rollup(conn)
+    end_date = datetime(2024, 3, 31)
+    rows = []
+    for i in range(60):
+        day = (end_date - timedelta(days=i)).strftime('%Y-%m-%d')
+        rows.append((1, 10.0 + i, 10.0 + i, 'Food' if i % 2 else 'Bills', day))
+        rows.append((2, 99.0, 99.0, 'Food', day))
+    conn.executemany("INSERT INTO expenses (user_id, amount, currency, amount_usd, category, date) VALUES (?, ?, 'USD', ?, ?, ?)", rows)
+
+    start_date = end_date - timedelta(days=29)
+    result = aggregate_analytics(conn, 1, start_date, end_date, 30)
+
+    for day, total in zip(result['days'], result['daily_totals']):
+        expected = conn.execute(
+            'SELECT COALESCE(SUM(amount_usd), 0) FROM expenses WHERE user_id=1 AND date=?',
+            (day.strftime('%Y-%m-%d'),)
+        ).fetchone()[0]
+        assert total == pytest.approx(expected)
+
+    assert result['total_transactions'] == 30
+    assert sum(result['heatmap']) == pytest.approx(sum(result['daily_totals']))
+    assert result['weekend'] + result['weekday'] == pytest.approx(sum(result['daily_totals']))
+    prev_food = conn.execute(
+        "SELECT SUM(amount_usd) FROM expenses WHERE user_id=1 AND category='Food' AND date BETWEEN '2024-01-31' AND '2024-03-01'"
+    ).fetchone()[0]
+    assert result['prev_category_totals']['Food'] == pytest.approx(prev_food)
+    conn.close()
+
+
+# --- TEST 5: Daily Spend Rollup ---
+def test_daily_spend_rollup_tracks_writes():
+    """Trigger-maintained rollup must equal a full rebuild after inserts, updates and deletes."""
+    from app import init_daily_spend_rollup, rebuild_daily_spend
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE expenses (id INTEGER PRIMARY KEY, user_id INTEGER, amount REAL, currency TEXT, amount_usd REAL, category TEXT, date TEXT)')
+    init_daily_spend_rollup(conn)
+    conn.executemany(
+        'INSERT INTO expenses (user_id, amount, currency, amount_usd, category, date) VALUES (?, ?, ?, ?, ?, ?)',
+        [(1, 5.0, 'USD', 5.0, 'Food', '2024-01-01'), (1, 7.5, 'USD', 7.5, 'Food', '2024-01-01'),
+         (1, 270.0, 'INR', 3.0, 'Bills', '2024-01-02')]
+    )
+    conn.execute("UPDATE expenses SET category = 'Bills' WHERE id = 1")
+    conn.execute("UPDATE expenses SET amount = 8.1, currency = 'EUR', amount_usd = 9.0, date = '2024-01-03' WHERE id = 2")
+    conn.execute('DELETE FROM expenses WHERE id = 3')
+
+    query = ('SELECT user_id, date, category, currency, ROUND(total_native, 6), ROUND(total_usd, 6), txn_count '
+             'FROM daily_spend_native ORDER BY 1, 2, 3, 4')
+    incremental = conn.execute(query).fetchall()
+    rebuild_daily_spend(conn)
+    assert incremental == conn.execute(query).fetchall()
+    assert incremental == [(1, '2024-01-01', 'Bills', 'USD', 5.0, 5.0, 1), (1, '2024-01-03', 'Food', 'EUR', 8.1, 9.0, 1)]
+    conn.close()
+
+
+# --- TEST 6: Connection Pool ---
+def test_connection_pool_shares_one_connection_per_context(tmp_path):
+    """Helpers in one app context share a pooled connection that is reused afterwards."""
+    from app import get_db_pool
+
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'pool.db')
+    try:
+        with app.app_context():
+            first = get_db_connection()
+            first.close()  # No-op while bound to the context
+            assert get_db_connection() is first
+            assert first.execute('SELECT 1').fetchone()[0] == 1
+
+        metrics = get_db_pool().metrics()
+        assert metrics['checkouts'] == 1
+        assert metrics['in_use'] == 0 and metrics['idle'] == 1
+
+        with app.app_context():
+            assert get_db_connection() is first
+        assert get_db_pool().metrics()['reused'] == 1
+    finally:
+        app.config['DATABASE'] = original_db
+
+
+# --- TEST 7: Keyset Pagination ---
+def test_fetch_expense_page_walks_forward_and_back():
+    """Keyset pages must cover every row exactly once, in (date, id) DESC order."""
+    from app import fetch_expense_page
+
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE expenses (id INTEGER PRIMARY KEY, user_id INTEGER, date TEXT)')
+    conn.executemany('INSERT INTO expenses (user_id, date) VALUES (?, ?)',
+                     [(1, f'2024-01-{day:02d}') for day in (1, 1, 2, 3, 3, 3, 4)] + [(2, '2024-01-05')])
+    expected = [row['id'] for row in conn.execute(
+        'SELECT id FROM expenses WHERE user_id = 1 ORDER BY date DESC, id DESC')]
+
+    seen, pages, cursor = [], [], None
+    while True:
+        rows, cursor, prev_cursor = fetch_expense_page(conn, 1, 3, after=cursor)
+        pages.append((rows, prev_cursor))
+        seen += [row['id'] for row in rows]
+        if not cursor:
+            break
+    assert seen == expected
+    assert pages[0][1] is None
+
+    # Going back from the last page returns the page before it
+    back, _, _ = fetch_expense_page(conn, 1, 3, before=pages[-1][1])
+    assert [row['id'] for row in back] == [row['id'] for row in pages[-2][0]]
+
+    with pytest.raises(ValueError):
+        fetch_expense_page(conn, 1, 3, after='not-a-cursor')
+    conn.close()
+
+
+# --- TEST 8: Blind Search Index ---
+def test_blind_index_filters_encrypted_descriptions():
+    """Keyword search must find substrings of encrypted descriptions without scanning other rows."""
+    from app import (encrypt_data, index_expense_descriptions, init_search_index,
+                     keyword_filter_clause, search_expense_page)
+
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute(
+        "CREATE TABLE expenses (id INTEGER PRIMARY KEY, user_id INTEGER, description TEXT, "
+        "date TEXT DEFAULT '2024-01-01', amount REAL DEFAULT 1, currency TEXT DEFAULT 'USD')"
+    )
+    init_search_index(conn)
+    descriptions = ['Coffee at Blue Bottle', 'Monthly rent', 'coffee beans', 'Team lunch']
+    for i, text in enumerate(descriptions, start=1):
+        conn.execute('INSERT INTO expenses (id, user_id, description) VALUES (?, 1, ?)', (i, encrypt_data(text)))
+    conn.execute("INSERT INTO expenses (id, user_id, description) VALUES (5, 2, ?)", (encrypt_data('coffee'),))
+    index_expense_descriptions(conn, [(1, i, text) for i, text in enumerate(descriptions, start=1)] + [(2, 5, 'coffee')])
+
+    def search(keyword):
+        clause, params = keyword_filter_clause(1, keyword)
+        query = 'SELECT * FROM expenses WHERE user_id = ?' + clause + ' ORDER BY id'
+        matches, _ = search_expense_page(conn, query, [1, *params], keyword, 10)
+        return [row['description'] for row in matches]
+
+    assert search('coffee') == ['Coffee at Blue Bottle', 'coffee beans']
+    assert search('e bot') == ['Coffee at Blue Bottle']
+    assert search('rental') == []
+    assert keyword_filter_clause(1, 'ab') is None
+
+    # Deleting an expense drops its tokens
+    conn.execute('DELETE FROM expenses WHERE id = 3')
+    assert conn.execute('SELECT COUNT(*) FROM expense_search_tokens WHERE expense_id = 3').fetchone()[0] == 0
+    conn.close()
+
+
+# --- TEST 9: Batch Decryption ---
+def test_decrypt_many_handles_legacy_and_duplicates():
+    """Batch decryption keeps order, passes legacy plaintext through and counts throughput."""
+    from app import decrypt_many, encrypt_data, get_decrypt_stats, looks_encrypted
+
+    token = encrypt_data('Groceries')
+    values = [token, 'legacy text', '', None, token, encrypt_data('Rent')]
+    assert looks_encrypted(token) and not looks_encrypted('legacy text')
+
+    before = get_decrypt_stats()
+    assert decrypt_many(values) == ['Groceries', 'legacy text', '', '', 'Groceries', 'Rent']
+    after = get_decrypt_stats()
+    assert after['rows'] - before['rows'] == len(values)
+    assert after['legacy'] - before['legacy'] == 1
+    assert after['decrypted'] - before['decrypted'] == 2  # Duplicate token decrypted once
+    assert after['rows_per_sec'] > 0
+
+
+# --- TEST 10: Key Rotation ---
+def test_reencryption_job_moves_rows_to_new_key_and_resumes(tmp_path, monkeypatch):
+    """After a rotation the job re-encrypts old tokens and legacy text, resuming from its checkpoint."""
+    import shutil
+    import app as app_module
+    from cryptography.fernet import Fernet
+
+    key_file = tmp_path / 'secret.key'
+    shutil.copy(app_module.KEY_FILE, key_file)
+    monkeypatch.setattr(app_module, 'KEY_FILE', str(key_file))
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'rotate.db')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('u', 'u@example.com', 'x')")
+            descriptions = [app_module.encrypt_data(f'Old {i}') for i in range(5)] + ['legacy note']
+            conn.executemany(
+                "INSERT INTO expenses (user_id, amount, amount_usd, category, description, date) VALUES (1, 1, 1, 'Food', ?, '2024-01-01')",
+                [(d,) for d in descriptions]
+            )
+            conn.commit()
+
+        old_key = Fernet(app_module.load_keys()[0])
+        app_module.rotate_encryption_key()
+        job = app_module.run_reencryption_job(chunk_size=2, pause=0, max_chunks=1)
+        assert job['status'] == 'running' and job['last_id'] == 2
+
+        # A worker that has not reloaded the ring yet inserts a row with the old key mid-job
+        with app.app_context():
+            conn = get_db_connection()
+            conn.execute(
+                "INSERT INTO expenses (user_id, amount, amount_usd, category, description, date) VALUES (1, 1, 1, 'Food', ?, '2024-01-02')",
+                (old_key.encrypt(b'Late').decode(),)
+            )
+            conn.commit()
+            assert app_module.count_rows_on_old_keys(conn) == 4
+            conn.close()
+
+        job = app_module.run_reencryption_job(chunk_size=2, pause=0)
+        assert job['status'] == 'completed' and job['target_id'] == 7
+        assert job['processed'] == 7 and job['updated'] == 7
+
+        primary = Fernet(app_module.load_keys()[0])
+        with app.app_context():
+            conn = get_db_connection()
+            rows = conn.execute('SELECT description FROM expenses ORDER BY id').fetchall()
+            assert app_module.count_rows_on_old_keys(conn) == 0
+            conn.close()
+        plain = [primary.decrypt(r['description'].encode()).decode() for r in rows]
+        assert plain == [f'Old {i}' for i in range(5)] + ['legacy note', 'Late']
+
+        # A rotation written by another process is picked up by the next encrypt
+        newer = Fernet.generate_key()
+        app_module._write_keys([newer] + app_module.load_keys())
+        assert Fernet(newer).decrypt(app_module.encrypt_data('fresh').encode()) == b'fresh'
+    finally:
+        app.config['DATABASE'] = original_db
+        monkeypatch.undo()
+        app_module.reload_keyring_if_changed()
+
+
+# --- TEST 11: Streaming Export ---
+def test_csv_export_streams_decrypted_chunks():
+    """Export rows come out in chunks with descriptions decrypted."""
+    from app import csv_chunks, encrypt_data, iter_export_rows
+
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE expenses (id INTEGER PRIMARY KEY, user_id INTEGER, amount REAL, currency TEXT, amount_usd REAL, category TEXT, description TEXT, date TEXT)')
+    conn.executemany(
+        "INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date) VALUES (1, 5, 'USD', 5, 'Food', ?, ?)",
+        [(encrypt_data(f'Lunch {i}'), f'2024-01-{i + 1:02d}') for i in range(5)]
+    )
+
+    columns, chunks = iter_export_rows(conn, 'expenses', 1, chunk_size=2)
+    parts = list(csv_chunks(columns, chunks))
+    assert len(parts) == 4  # Header + three chunks
+    lines = ''.join(parts).splitlines()
+    assert lines[0] == 'date,category,description,amount,currency,amount_usd'
+    assert lines[1] == '2024-01-05,Food,Lunch 4,5.0,USD,5.0'
+    assert len(lines) == 6
+
+
+# --- TEST 12: Export Jobs ---
+def test_export_job_writes_artifact_and_expires(tmp_path):
+    """A queued export finishes on the worker pool and its artifact is removed after the TTL."""
+    import time
+    import app as app_module
+    from app import cleanup_expired_exports, recover_export_jobs, renew_export_heartbeats, submit_export_job
+
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'export.db')
+    app.config['EXPORT_DIR'] = str(tmp_path / 'exports')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('u', 'u@example.com', 'x')")
+            conn.execute("INSERT INTO expenses (user_id, amount, amount_usd, category, description, date) VALUES (1, 3, 3, 'Food', 'Tea', '2024-01-01')")
+            conn.commit()
+            job_id = submit_export_job(conn, 1, 'expenses', 'csv')
+            for _ in range(100):
+                job = conn.execute('SELECT * FROM export_jobs WHERE id = ?', (job_id,)).fetchone()
+                if job['status'] in ('completed', 'failed'):
+                    break
+                time.sleep(0.05)
+            assert job['status'] == 'completed' and job['rows_done'] == 1
+            with open(job['file_path']) as f:
+                assert 'Tea' in f.read()
+
+            conn.execute("UPDATE export_jobs SET expires_at = '2000-01-01' WHERE id = ?", (job_id,))
+            assert cleanup_expired_exports(conn) == 1
+            assert not os.path.exists(job['file_path'])
+
+            # Only jobs of a process that stopped heartbeating are orphaned; this process's own jobs
+            # and a live process's long render are kept, and submitting never fails anything
+            partial = tmp_path / 'exports' / 'orphan.csv'
+            partial.write_text('date,category')
+            stale, owner = time.time() - 3600, app_module._lease_owner
+            conn.executemany(
+                """INSERT INTO export_jobs (id, user_id, data_type, format, status, file_path, created_at, claimed_by, heartbeat_at)
+                   VALUES (?, 1, 'expenses', 'csv', ?, ?, '2024-01-01', ?, ?)""",
+                [('orphan', 'running', str(partial), 'gone-1', stale), ('queued', 'queued', None, 'gone-1', stale),
+                 ('legacy', 'queued', None, None, None), ('live', 'running', None, 'other-2', time.time()),
+                 ('mine', 'queued', None, owner, stale)]
+            )
+            conn.commit()
+            assert cleanup_expired_exports(conn) == 0 and partial.exists()
+            recover_export_jobs()
+            statuses = dict(conn.execute('SELECT id, status FROM export_jobs').fetchall())
+            assert statuses == {'orphan': 'failed', 'queued': 'failed', 'legacy': 'failed', 'live': 'running', 'mine': 'queued'}
+            assert not partial.exists()
+            assert 'restart' in conn.execute("SELECT error FROM export_jobs WHERE id = 'orphan'").fetchone()[0]
+            assert renew_export_heartbeats(conn) == 1
+            assert conn.execute("SELECT heartbeat_at FROM export_jobs WHERE id = 'mine'").fetchone()[0] > stale
+            assert cleanup_expired_exports(conn) == 0  # Failed jobs stay readable for one TTL
+    finally:
+        app.config['DATABASE'] = original_db
+        app.config['EXPORT_DIR'] = 'exports'
+
+
+# --- TEST 13: Chunked Import ---
+def test_import_csv_maps_chunks_and_rejects_bad_amounts(tmp_path):
+    """The chunked import normalizes dates, rejects unparseable ones, defaults missing fields and indexes descriptions."""
+    from datetime import date
+    import pandas as pd
+    from app import decrypt_data, import_csv, keyword_filter_clause, prepare_import_chunk, rejected_import_rows
+
+    csv_path = tmp_path / 'statement.csv'
+    csv_path.write_text(
+        "When,Amt,Note\n"
+        "2024-03-01,10.5,Bagel place\n"
+        "03/02/2024,abc,Broken row\n"
+        "not a date,7,\n"
+        ",7,\n"
+        "2024-03-04,2,Bagel again\n"
+    )
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'import.db')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('u', 'u@example.com', 'x')")
+            conn.commit()
+            stats = import_csv(conn, str(csv_path), {'amount': 'Amt', 'date': 'When', 'description': 'Note'}, 1, chunk_size=2)
+            assert stats['imported'] == 3 and stats['rejected'] == 2 and stats['chunks'] == 3
+            assert stats['rows_per_sec'] > 0
+
+            rows = conn.execute('SELECT * FROM expenses ORDER BY id').fetchall()
+            assert [r['date'] for r in rows][::2] == ['2024-03-01', '2024-03-04']
+            assert rows[1]['date'] == date.today().isoformat()
+            assert {r['currency'] for r in rows} == {'USD'} and rows[1]['category'] == 'Miscellaneous'
+            assert decrypt_data(rows[0]['description']) == 'Bagel place'
+
+            clause, params = keyword_filter_clause(1, 'bagel')
+            matched = conn.execute(f'SELECT id FROM expenses WHERE 1 = 1 {clause}', params).fetchall()
+            assert len(matched) == 2
+
+            mapping = {'amount': 'Amt', 'date': 'When'}
+            _, rejected = prepare_import_chunk(pd.read_csv(csv_path, dtype=str), mapping)
+            reasons = [record[2] for record in rejected_import_rows(1, rejected, mapping)]
+            assert reasons == ["Invalid amount: 'abc'", "Invalid date: 'not a date'"]
+    finally:
+        app.config['DATABASE'] = original_db
+
+
+# --- TEST 14: Import Staging ---
+def test_staged_upload_preview_and_expiry(tmp_path):
+    """Uploads are staged under a token, previewed from the first rows and cleaned up after the TTL."""
+    import io
+    from werkzeug.datastructures import FileStorage
+    from app import cleanup_expired_uploads, get_staged_upload, preview_staged_upload, stage_upload
+
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'staging.db')
+    app.config['IMPORT_DIR'] = str(tmp_path / 'imports')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            body = "Date,Amount\n" + "".join(f"2024-01-{i % 28 + 1:02d},{i}\n" for i in range(100))
+            token = stage_upload(conn, 1, FileStorage(io.BytesIO(body.encode()), filename='bank.csv'))
+
+            staged = get_staged_upload(conn, token, 1)
+            assert staged['filename'] == 'bank.csv'
+            assert get_staged_upload(conn, token, 2) is None  # Tokens are per user
+            columns, rows = preview_staged_upload(staged['path'], rows=5)
+            assert columns == ['Date', 'Amount'] and len(rows) == 5
+
+            conn.execute("UPDATE import_staging SET expires_at = '2000-01-01'")
+            assert cleanup_expired_uploads(conn) == 1
+            assert not os.path.exists(staged['path'])
+    finally:
+        app.config['DATABASE'] = original_db
+        app.config['IMPORT_DIR'] = 'imports'
+
+
+# --- TEST 15: Resumable Import Jobs ---
+def test_import_job_resumes_from_checkpoint_and_reports_rejections(tmp_path):
+    """A job restarted after a crash skips committed rows and records rejected lines."""
+    import json
+    import time
+    from app import resume_import_jobs, run_import_job
+
+    csv_path = tmp_path / 'statement.csv'
+    csv_path.write_text("Amt,Note\n1,a\n2,b\nx,c\n4,d\n5,e\n")
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'jobs.db')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('u', 'u@example.com', 'x')")
+            # As if a previous run committed the first two rows and then died
+            conn.execute(
+                '''INSERT INTO import_jobs (id, user_id, path, filename, mapping, status, rows_done, total_rows, imported, created_at, updated_at)
+                   VALUES ('job1', 1, ?, 'statement.csv', ?, 'running', 2, 5, 2, '2024-01-01', '2024-01-01')''',
+                (str(csv_path), json.dumps({'amount': 'Amt', 'description': 'Note'}))
+            )
+            conn.commit()
+
+        run_import_job('job1')
+
+        with app.app_context():
+            conn = get_db_connection()
+            job = conn.execute("SELECT * FROM import_jobs WHERE id = 'job1'").fetchone()
+            assert job['status'] == 'completed'
+            assert (job['rows_done'], job['imported'], job['rejected']) == (5, 4, 1)
+            assert [r['amount'] for r in conn.execute('SELECT amount FROM expenses ORDER BY id')] == [4, 5]
+            rejection = conn.execute("SELECT * FROM import_rejections WHERE job_id = 'job1'").fetchone()
+            assert rejection['line'] == 4 and "'x'" in rejection['reason']
+            assert not csv_path.exists()
+
+            # Quoted notes spanning lines: the offset counts records, not physical lines
+            multiline = tmp_path / 'multiline.csv'
+            multiline.write_text('Amt,Note\n1,"two\nlines"\n2,"three\nmore\nlines"\n3,c\n4,d\n')
+            conn.execute(
+                '''INSERT INTO import_jobs (id, user_id, path, filename, mapping, status, rows_done, total_rows, created_at, updated_at,
+                                            claimed_by, heartbeat_at)
+                   VALUES ('job2', 1, ?, 'multiline.csv', ?, 'running', 2, 4, '2024-01-01', '2024-01-01', 'other-worker', ?)''',
+                (str(multiline), json.dumps({'amount': 'Amt', 'description': 'Note'}), time.time())
+            )
+            conn.commit()
+            # A live worker holds the job: neither the recovery sweep nor a direct run touches it
+            assert resume_import_jobs() == []
+            run_import_job('job2')
+            assert conn.execute("SELECT status FROM import_jobs WHERE id = 'job2'").fetchone()[0] == 'running'
+
+            # Its heartbeat goes stale (the worker crashed), so the job is resumed exactly once
+            conn.execute("UPDATE import_jobs SET heartbeat_at = ? WHERE id = 'job2'", (time.time() - 3600,))
+            conn.commit()
+            run_import_job('job2')
+            job = conn.execute("SELECT * FROM import_jobs WHERE id = 'job2'").fetchone()
+            assert (job['status'], job['rows_done'], job['imported'], job['claimed_by']) == ('completed', 4, 2, None)
+            assert [r['amount'] for r in conn.execute('SELECT amount FROM expenses ORDER BY id')] == [4, 5, 3, 4]
+
+            # A freshly queued job has its rows counted by the worker, not by the submitting request
+            fresh = tmp_path / 'fresh.csv'
+            fresh.write_text("Amt\n7\n8\n9\n")
+            conn.execute(
+                '''INSERT INTO import_jobs (id, user_id, path, filename, mapping, status, created_at, updated_at)
+                   VALUES ('job3', 1, ?, 'fresh.csv', ?, 'queued', '2024-01-01', '2024-01-01')''',
+                (str(fresh), json.dumps({'amount': 'Amt'}))
+            )
+            conn.commit()
+            run_import_job('job3')
+            job = conn.execute("SELECT * FROM import_jobs WHERE id = 'job3'").fetchone()
+            assert (job['status'], job['total_rows'], job['imported']) == ('completed', 3, 3)
+    finally:
+        app.config['DATABASE'] = original_db
+
+
+# --- TEST 16: Duplicate Detection ---
+def test_reimport_skips_rows_matching_existing_expenses(tmp_path):
+    """Re-importing an overlapping statement skips matches; identical rows pair up one-to-one across chunks and runs."""
+    import json
+    from app import decrypt_data, import_csv, run_import_job
+
+    first = tmp_path / 'january.csv'
+    first.write_text("Date,Amt,Note\n2024-01-05,4.5,Coffee\n2024-01-05,4.5,Coffee\n2024-01-06,20,Books\n")
+    overlap = tmp_path / 'january_again.csv'
+    overlap.write_text("Date,Amt,Note\n2024-01-05,4.50,  coffee \n2024-01-05,4.5,Coffee\n2024-01-05,4.5,Coffee\n2024-01-07,8,Lunch\n")
+    mapping = {'amount': 'Amt', 'date': 'Date', 'description': 'Note'}
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'dedup.db')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('u', 'u@example.com', 'x')")
+            conn.commit()
+            assert import_csv(conn, str(first), mapping, 1)['imported'] == 3
+
+            stats = import_csv(conn, str(overlap), mapping, 1, chunk_size=1)
+            # Two coffees already existed; the third one and the lunch are new, even one row per chunk
+            assert (stats['duplicates'], stats['imported']) == (2, 2)
+
+            # A merge job resumed after its first coffee merged into expense 1 pairs the next one with 2
+            treats = tmp_path / 'treats.csv'
+            treats.write_text("Date,Amt,Note,Cat\n2024-01-05,4.5,Coffee,Treats\n2024-01-05,4.5,coffee,Treats\n")
+            conn.execute(
+                '''INSERT INTO import_jobs (id, user_id, path, filename, mapping, status, rows_done, duplicate_policy,
+                                          baseline_id, created_at, updated_at)
+                   VALUES ('merge', 1, ?, 'treats.csv', ?, 'running', 1, 'merge', 3, '2024-01-01', '2024-01-01')''',
+                (str(treats), json.dumps(dict(mapping, category='Cat')))
+            )
+            conn.execute("UPDATE expenses SET category = 'Treats' WHERE id = 1")
+            conn.execute("INSERT INTO import_duplicates (job_id, line, expense_id, action) VALUES ('merge', 2, 1, 'merged')")
+            conn.commit()
+            run_import_job('merge')
+            merged = conn.execute("SELECT * FROM import_duplicates WHERE job_id = 'merge' AND line = 3").fetchone()
+            assert merged['expense_id'] == 2 and merged['previous_category'] == 'Miscellaneous'
+            assert decrypt_data(merged['previous_description']) == 'Coffee'
+            assert conn.execute('SELECT category FROM expenses WHERE id = 2').fetchone()[0] == 'Treats'
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess['user_id'] = 1
+                report = client.get('/import_jobs/merge/duplicates.csv').get_data(as_text=True).splitlines()
+            assert report[0] == 'line,action,expense_id,date,amount,currency,category,previous_category,description,previous_description'
+            assert report[2].endswith(',Treats,Miscellaneous,coffee,Coffee')
+
+            flagged = import_csv(conn, str(overlap), mapping, 1, duplicate_policy='flag')
+            assert flagged['imported'] == 4
+            marked = conn.execute('SELECT COUNT(*) FROM expenses WHERE duplicate_of IS NOT NULL').fetchone()[0]
+            assert marked == 4
+    finally:
+        app.config['DATABASE'] = original_db
+
+
+# --- TEST 17: Recurring Scheduler ---
+def test_recurring_sweep_backfills_every_missed_occurrence_once(tmp_path):
+    """A master six months overdue gets six entries; a second sweep or a foreign lease adds nothing."""
+    import time
+    from datetime import date
+    from app import decrypt_data, encrypt_data, run_recurring_sweep
+
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'recurring.db')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('u', 'u@example.com', 'x')")
+            conn.execute(
+                '''INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date, is_recurring, frequency, next_due_date)
+                   VALUES (1, 9.99, 'USD', 9.99, 'Bills', ?, '2024-01-15', 1, 'monthly', '2024-02-15')''',
+                (encrypt_data('Streaming'),)
+            )
+            conn.commit()
+
+        stats = run_recurring_sweep(today=date(2024, 7, 15))
+        assert stats['created'] == 6
+        assert run_recurring_sweep(today=date(2024, 7, 15))['created'] == 0
+
+        with app.app_context():
+            conn = get_db_connection()
+            rows = conn.execute('SELECT * FROM expenses WHERE recurring_parent_id = 1 ORDER BY date').fetchall()
+            assert [r['date'] for r in rows] == [f'2024-{m:02d}-15' for m in range(2, 8)]
+            assert decrypt_data(rows[0]['description']) == 'Streaming (Auto-generated)'
+            assert conn.execute('SELECT next_due_date FROM expenses WHERE id = 1').fetchone()[0] == '2024-08-15'
+
+            conn.execute("INSERT INTO scheduler_leases (name, owner, expires_at) VALUES ('recurring_sweep', 'other', ?)", (time.time() + 60,))
+            conn.commit()
+        assert run_recurring_sweep(today=date(2025, 1, 1)) is None
+    finally:
+        app.config['DATABASE'] = original_db
+
+
+# --- TEST 18: Recurrence Calculator ---
+def test_recurrence_dates_keep_anchor_day_and_honour_limits():
+    """Month steps clamp to month ends without drifting; intervals, windows and limits apply per series."""
+    from app import next_recurrence, recurrence_dates
+    from datetime import date
+
+    series, dates = recurrence_dates(
+        ['2024-01-31', '2024-02-29', '2024-01-01', '2024-01-10'],
+        ['monthly', 'yearly', 'weekly', 'monthly'],
+        [1, 1, 2, 1],
+        '2024-01-01',
+        ['2024-05-31', '2028-12-31', '2024-02-15', '2030-01-01'],
+        limit=3,
+    )
+    by_series = {}
+    for i, d in zip(series.tolist(), dates.astype(str)):
+        by_series.setdefault(i, []).append(d)
+    assert by_series[0] == ['2024-02-29', '2024-03-31', '2024-04-30']  # Limit 3 of 4
+    assert by_series[1] == ['2025-02-28', '2026-02-28', '2027-02-28']
+    assert by_series[2] == ['2024-01-15', '2024-01-29', '2024-02-12']
+    assert len(by_series[3]) == 3
+
+    assert next_recurrence(date(2024, 1, 31), 'monthly', after=date(2024, 2, 29)) == date(2024, 3, 31)
+    assert next_recurrence(date(2024, 2, 29), 'yearly', interval=4) == date(2028, 2, 29)
+
+
+# --- TEST 19: Group Balances ---
+def test_group_balances_use_one_query_and_net_settlements(tmp_path):
+    """Paid minus owed per member comes from a single statement; settlements reduce the debt."""
+    from app import calculate_group_debts, compute_group_balances, rebuild_group_balances
+
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'groups.db')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.executemany('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                             [(name, f'{name}@example.com', 'x') for name in ('ann', 'bob', 'cat')])
+            conn.execute("INSERT INTO groups (name, created_by, created_at) VALUES ('trip', 1, '2024-01-01')")
+            conn.executemany("INSERT INTO group_members (group_id, user_id, joined_at) VALUES (1, ?, '2024-01-01')",
+                             [(1,), (2,), (3,)])
+            # ann pays 90 split three ways; bob settles 10 of his 30 with ann
+            conn.execute("INSERT INTO group_expenses (group_id, payer_id, amount, description, date) VALUES (1, 1, 90, 'Hotel', '2024-01-02')")
+            conn.executemany('INSERT INTO expense_splits (expense_id, user_id, amount_owed) VALUES (1, ?, 30)', [(1,), (2,), (3,)])
+            conn.execute("INSERT INTO group_expenses (group_id, payer_id, amount, description, date) VALUES (1, 2, 10, 'Settlement', '2024-01-03')")
+            conn.execute('INSERT INTO expense_splits (expense_id, user_id, amount_owed) VALUES (2, 1, 10)')
+            conn.commit()
+
+            statements = []
+            conn.set_trace_callback(statements.append)
+            balances = compute_group_balances(conn, 1)
+            conn.set_trace_callback(None)
+            assert len(statements) == 1
+            assert {uid: round(balance, 2) for uid, (_, balance) in balances.items()} == {1: 50.0, 2: -20.0, 3: -30.0}
+
+            rebuild_group_balances(conn, 1)
+            conn.commit()
+            debts = calculate_group_debts(1)
+            assert sorted((d['from'], d['to'], d['amount']) for d in debts) == [('bob', 'ann', 20.0), ('cat', 'ann', 30.0)]
+    finally:
+        app.config['DATABASE'] = original_db
+
+
+# --- TEST 20: Group Balances Ledger ---
+def test_group_ledger_tracks_expenses_settlements_and_deletes(tmp_path):
+    """Every group write path keeps group_balances equal to a full recompute."""
+    from app import read_group_balances, rebuild_group_balances, verify_group_balances
+
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'ledger.db')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.executemany('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                             [(name, f'{name}@example.com', 'x') for name in ('ann', 'bob', 'cat')])
+            conn.commit()
+            conn.close()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['user_id'] = 1
+            client.post('/create_group', data={'name': 'trip'})
+            client.post('/group/1/add_member', data={'username': 'bob'})
+            client.post('/group/1/add_member', data={'username': 'cat'})
+            client.post('/group/1/add_expense', data={'amount': '90', 'description': 'Hotel', 'payer_id': '1'})
+            client.post('/group/1/add_expense', data={'amount': '30', 'description': 'Taxi', 'payer_id': '2'})
+            client.post('/group/1/settle_up', data={'from_id': '3', 'to_id': '1', 'amount': '15'})
+            client.post('/group/1/expense/2/delete')
+
+        with app.app_context():
+            conn = get_db_connection()
+            balances = {uid: round(net, 2) for uid, (_, net) in read_group_balances(conn, 1).items()}
+            assert balances == {1: 45.0, 2: -30.0, 3: -15.0}
+            assert verify_group_balances(conn) == []
+
+            conn.execute('UPDATE group_balances SET net = 0 WHERE user_id = 2')
+            assert verify_group_balances(conn) == [(1, 2, 0.0, -30.0)]
+            rebuild_group_balances(conn, 1)
+            assert verify_group_balances(conn) == []
+            conn.commit()
+            conn.close()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['user_id'] = 1
+            client.post('/group/1/delete')
+        with app.app_context():
+            conn = get_db_connection()
+            assert conn.execute('SELECT COUNT(*) FROM group_balances').fetchone()[0] == 0
+            conn.close()
+    finally:
+        app.config['DATABASE'] = original_db
+
+
+# --- TEST 21: Settlement Solver ---
+def test_settlement_solver_minimises_transfers_in_whole_cents():
+    """Zero-sum subsets settle separately (6 transfers, not the heuristic's 7); cents always add up."""
+    from app import balances_to_cents, settle_balances
+
+    # Two households of four that each cancel out, with no cancelling pairs or triples
+    cents = {1: 800, 2: 600, 3: 800, 4: -2200, 5: -500, 6: -200, 7: -200, 8: 900}
+    exact = settle_balances(cents)
+    greedy = settle_balances(cents, exact_max_members=0)
+    assert len(exact) == 6 and len(greedy) == 7
+    for transfers in (exact, greedy):
+        remaining = dict(cents)
+        for from_id, to_id, amount in transfers:
+            remaining[from_id] += amount
+            remaining[to_id] -= amount
+        assert set(remaining.values()) == {0}
+
+    # 100 split three ways leaves a cent of rounding that must not be lost
+    thirds = balances_to_cents({1: 100 - 100 / 3, 2: -100 / 3, 3: -100 / 3})
+    assert sum(thirds.values()) == 0
+    assert sorted(amount for _, _, amount in settle_balances(thirds)) == [3333, 3333]
+    with pytest.raises(ValueError):
+        settle_balances({1: 100, 2: -99})
+
+
+# --- TEST 22: Group Expense Splits ---
+def test_split_modes_are_exact_and_bulk_insert_is_all_or_nothing(tmp_path):
+    """Every split mode sums to the total in cents; one bad bulk row rejects the whole batch."""
+    import jwt
+    from app import compute_splits, read_group_balances, verify_group_balances
+
+    assert compute_splits(10000, [3, 1, 2]) == [(1, 3334), (2, 3333), (3, 3333)]
+    assert compute_splits(10000, [1, 2], 'percent', {'1': '62.5', '2': '37.5'}) == [(1, 6250), (2, 3750)]
+    assert compute_splits(1000, [1, 2, 3], 'shares', {1: 1, 2: 2}) == [(1, 333), (2, 667)]
+    assert compute_splits(1000, [1, 2], 'exact', {1: '2.50', 2: '7.50'}) == [(1, 250), (2, 750)]
+    for mode, values in (('exact', {1: '2.50'}), ('percent', {1: 50}), ('shares', {9: 1}), ('thirds', {1: 1})):
+        with pytest.raises(ValueError):
+            compute_splits(1000, [1, 2], mode, values)
+
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'splits.db')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.executemany('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                             [(name, f'{name}@example.com', 'x') for name in ('ann', 'bob', 'cat')])
+            conn.execute("INSERT INTO groups (name, created_by, created_at) VALUES ('flat', 1, '2024-01-01')")
+            conn.executemany("INSERT INTO group_members (group_id, user_id, joined_at) VALUES (1, ?, '2024-01-01')",
+                             [(1,), (2,), (3,)])
+            conn.commit()
+            conn.close()
+
+        token = jwt.encode({'user_id': 1}, app.config['JWT_SECRET'], algorithm=app.config['JWT_ALGORITHM'])
+        headers = {'Authorization': f'Bearer {token}'}
+        expenses = [
+            {'amount': 100, 'description': 'Groceries', 'payer_id': 1},
+            {'amount': '60.00', 'description': 'Internet', 'payer_id': 2, 'split_mode': 'shares', 'splits': {'1': 1, '2': 1, '3': 1}},
+            {'amount': 40, 'description': 'Cleaning', 'payer_id': 3, 'split_mode': 'exact', 'splits': {'1': 40}},
+        ]
+        with app.test_client() as client:
+            bad = client.post('/api/groups/1/expenses/bulk', headers=headers,
+                              json={'expenses': expenses + [{'amount': 10, 'description': 'x', 'payer_id': 9}]})
+            assert bad.status_code == 400 and 'Expense 3' in bad.get_json()['message']
+            bad = client.post('/api/groups/1/expenses/bulk', headers=headers,
+                              json={'expenses': expenses + [{'amount': 10, 'description': 'x', 'date': '2024-02-30'}]})
+            assert bad.status_code == 400 and 'Expense 3: Invalid date' in bad.get_json()['message']
+            response = client.post('/api/groups/1/expenses/bulk', headers=headers, json={'expenses': expenses})
+            assert response.status_code == 201
+            assert response.get_json()['data']['ids'] == [1, 2, 3]
+
+        with app.app_context():
+            conn = get_db_connection()
+            owed = conn.execute('SELECT expense_id, SUM(amount_owed) FROM expense_splits GROUP BY expense_id').fetchall()
+            assert [tuple(row) for row in owed] == [(1, 100.0), (2, 60.0), (3, 40.0)]
+            balances = {uid: round(net, 2) for uid, (_, net) in read_group_balances(conn, 1).items()}
+            assert balances == {1: 6.66, 2: 6.67, 3: -13.33}
+            assert verify_group_balances(conn) == []
+            conn.close()
+    finally:
+        app.config['DATABASE'] = original_db
+
+
+# --- TEST 23: Exchange Rate Cache ---
+def test_rate_cache_serves_stale_rates_while_refreshing_and_survives_failures(tmp_path):
+    """Readers never wait on the source; failed fetches keep the last good rates; workers share the table."""
+    import time
+    from app import ExchangeRateCache, convert_to_usd, get_rate_cache, get_usd_rate
+
+    calls = []
+    def stub(rate, delay=0):
+        def source():
+            calls.append(rate)
+            time.sleep(delay)
+            return {'USD': 1, 'EUR': rate}
+        return source
+    def failing():
+        raise ConnectionError('offline')
+
+    original = {key: app.config[key] for key in ('DATABASE', 'FX_RATE_SOURCE')}
+    app.config['DATABASE'] = str(tmp_path / 'rates.db')
+    try:
+        with app.app_context():
+            init_db()
+        cache = get_rate_cache()
+        app.config['FX_RATE_SOURCE'] = stub(0.5)
+        assert cache.refresh(force=True)
+        assert get_usd_rate('EUR') == 0.5 and convert_to_usd(10, 'EUR') == 20.0
+
+        app.config['FX_RATE_SOURCE'] = failing
+        assert not cache.refresh(force=True)
+        assert get_usd_rate('EUR') == 0.5
+
+        # Expired rates are served immediately while a slow fetch runs in the background
+        app.config['FX_RATE_SOURCE'] = stub(0.25, delay=0.3)
+        with app.app_context():
+            conn = get_db_connection()
+            conn.execute('UPDATE exchange_rates SET fetched_at = 0')
+            conn.execute('DELETE FROM scheduler_leases')
+            conn.commit()
+        cache._loaded_at = cache._fetched_at = cache._retry_at = 0
+        started = time.perf_counter()
+        assert cache.rates()['EUR'] == 0.5
+        assert time.perf_counter() - started < 0.2
+        deadline = time.time() + 5
+        while get_usd_rate('EUR') != 0.25 and time.time() < deadline:
+            time.sleep(0.05)
+        assert get_usd_rate('EUR') == 0.25 and calls.count(0.25) == 1
+
+        # Another worker reads the persisted rates without calling the source
+        fetches = len(calls)
+        other = ExchangeRateCache(app.config['DATABASE'])
+        assert other.rates()['EUR'] == 0.25 and len(calls) == fetches
+    finally:
+        app.config.update(original)
+
+
+# --- TEST 24: Historical Exchange Rates ---
+def test_historical_rates_convert_at_nearest_prior_date(tmp_path):
+    """Rates loaded from long or wide CSVs apply from their date on; earlier dates use the latest rate."""
+    import pandas as pd
+    from app import (convert_series, convert_to_usd, get_db_pool, get_fx_index, get_rate_cache, load_fx_rates,
+                     prepare_import_chunk)
+
+    (tmp_path / 'long.csv').write_text('date,currency,rate\n2024-01-01,EUR,0.5\n2024-02-01,EUR,0.8\nbad,EUR,1\n')
+    (tmp_path / 'wide.csv').write_text('Date,GBP,INR\n2024-01-01,0.25,80\n2024-03-01,0.2,\n')
+    original = {key: app.config[key] for key in ('DATABASE', 'FX_RATE_SOURCE')}
+    app.config['DATABASE'] = str(tmp_path / 'fx.db')
+    app.config['FX_RATE_SOURCE'] = lambda: {'USD': 1, 'EUR': 2.0, 'GBP': 4.0, 'INR': 100}
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            assert load_fx_rates(conn, str(tmp_path / 'long.csv')) == 2
+            assert load_fx_rates(conn, str(tmp_path / 'wide.csv')) == 3
+            assert conn.execute('SELECT version FROM fx_rates_version').fetchone()[0] == 2
+            # The index is checked and rebuilt on the request's connection, not a second pool slot
+            checkouts = get_db_pool().metrics()['checkouts']
+            get_fx_index()
+            assert get_db_pool().metrics()['checkouts'] == checkouts
+            conn.close()
+        get_rate_cache().refresh(force=True)  # Also records today's rates in the history
+
+        converted = convert_series(
+            [10, 10, 10, 10, 10, 10],
+            ['EUR', 'EUR', 'EUR', 'GBP', 'USD', 'INR'],
+            ['2024-01-15', '2024-02-01', '2023-12-31', '2024-06-30', '2024-01-01', '2024-03-02']
+        )
+        assert converted.tolist() == [20.0, 12.5, 5.0, 50.0, 10.0, 0.12]
+        assert convert_to_usd(10, 'EUR', '2024-01-20') == 20.0
+        assert convert_series([100], 'GBP', ['2024-01-02'], from_usd=True).tolist() == [25.0]
+        with pytest.raises(ValueError, match='Invalid date'):
+            convert_series([10, 10], 'EUR', ['2024-01-15', 'soon'])
+
+        chunk = pd.DataFrame({'Amount': ['10', '10'], 'Currency': ['eur', 'EUR'], 'Date': ['2024-01-10', '2024-02-10']})
+        prepared, _ = prepare_import_chunk(chunk, {'amount': 'Amount', 'currency': 'Currency', 'date': 'Date'})
+        assert prepared['amount_usd'].tolist() == [20.0, 12.5]
+    finally:
+        app.config.update(original)
+
+
+# --- TEST 25: Display Currency Context ---
+def test_currency_context_keeps_native_totals_and_resolves_rate_once(tmp_path, monkeypatch):
+    """Pages resolve the display rate once per request and sum same-currency expenses natively."""
+    from datetime import datetime, timedelta
+    import app as app_module
+    from app import (CurrencyContext, aggregate_analytics, get_display_spending, get_display_totals,
+                     get_period_comparison, get_rate_cache, rebuild_daily_spend)
+
+    original = {key: app.config[key] for key in ('DATABASE', 'FX_RATE_SOURCE')}
+    app.config['DATABASE'] = str(tmp_path / 'display.db')
+    app.config['FX_RATE_SOURCE'] = lambda: {'USD': 1, 'INR': 83.37, 'EUR': 0.9}
+    today = datetime.now().strftime('%Y-%m-%d')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('ann', 'ann@example.com', 'x')")
+            conn.executemany(
+                'INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date) VALUES (1, ?, ?, ?, ?, ?, ?)',
+                [(333.33, 'INR', 4.0, 'Food', 'a', today), (333.33, 'INR', 4.0, 'Food', 'b', today),
+                 (9.0, 'EUR', 10.0, 'Travel', 'c', today), (100.0, 'INR', 1.2, 'Food', 'd', today)]
+            )
+            conn.execute("INSERT INTO budgets (user_id, category, amount, currency, amount_usd, period, start_date) "
+                         "VALUES (1, 'Food', 700, 'INR', 8.4, 'monthly', ?)", (today,))
+            conn.execute("UPDATE expenses SET amount = 200.0, amount_usd = 2.4 WHERE description = 'd'")
+            conn.commit()
+            get_rate_cache().refresh(force=True)
+
+            ctx = CurrencyContext('INR')
+            month_start = datetime.now().replace(day=1).strftime('%Y-%m-%d')
+            assert get_display_totals(conn, 1, ctx, month_start) == (round(866.66 + 10.0 * 83.37, 2),) * 2
+            assert get_display_spending(conn, 1, ctx)['monthly']['Food'] == 866.66
+            assert ctx.display(333.33, 'INR', 4.0) == 333.33 and ctx.display(9.0, 'EUR', 10.0) == 833.7
+
+            # Every analytics series is converted with the same policy, so they all agree
+            end = datetime.now()
+            aggregates = aggregate_analytics(conn, 1, end - timedelta(days=6), end, 7, ctx)
+            total = round(866.66 + 10.0 * 83.37, 2)
+            assert round(sum(aggregates['daily_totals']), 2) == total
+            assert round(sum(amount for _, amount in aggregates['category_totals']), 2) == total
+            assert round(sum(aggregates['heatmap']), 2) == total
+            assert round(get_period_comparison(conn, 1, ctx=ctx)['current_year'], 2) == total
+
+            rollup_sql = 'SELECT currency, ROUND(total_native, 6), ROUND(total_usd, 6), txn_count FROM daily_spend_native ORDER BY currency'
+            rollup = [tuple(row) for row in conn.execute(rollup_sql)]
+            assert rollup == [('EUR', 9.0, 10.0, 1), ('INR', 866.66, 10.4, 3)]
+            rebuild_daily_spend(conn)
+            assert [tuple(row) for row in conn.execute(rollup_sql)] == rollup
+            conn.close()
+
+        lookups = []
+        real_rate = app_module.get_usd_rate
+        monkeypatch.setattr(app_module, 'get_usd_rate', lambda *args: lookups.append(args) or real_rate(*args))
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['user_id'] = 1
+                sess['currency'] = 'INR'
+            # Dated conversions go through the in-memory rate history, not one lookup per day
+            for page in ('/dashboard', '/budgets', '/analytics?range=365'):
+                lookups.clear()
+                response = client.get(page)
+                assert response.status_code == 200 and len(lookups) == 1, page
+            assert b'INR 1700.36' in client.get('/dashboard').data
+    finally:
+        app.config.update(original)
+
+
+# --- TEST 26: Chatbot Context Cache ---
+def test_chat_context_is_cached_until_expenses_or_budgets_change(tmp_path):
+    """The chatbot prompt is rebuilt only after an expense or budget write for that user."""
+    from datetime import datetime
+    from app import encrypt_data, get_chat_context, get_chat_context_cache
+
+    original_db = app.config['DATABASE']
+    app.config['DATABASE'] = str(tmp_path / 'chat.db')
+    today = datetime.now().strftime('%Y-%m-%d')
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.executemany('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                             [('ann', 'ann@example.com', 'x'), ('bob', 'bob@example.com', 'x')])
+            conn.executemany(
+                'INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(1, 12, 'USD', 12, 'Food', encrypt_data('Corner Cafe'), today),
+                 (1, 8, 'USD', 8, 'Food', encrypt_data('corner  cafe'), today),
+                 (1, 50, 'USD', 50, 'Travel', encrypt_data('Metro Card'), today),
+                 (2, 99, 'USD', 99, 'Food', encrypt_data('Other'), today)]
+            )
+            conn.commit()
+
+            cache = get_chat_context_cache()
+            context, prompt = get_chat_context(1)
+            assert context['total_expenses_usd'] == 70 and context['monthly_trend'] == {today[:7]: 70}
+            assert context['top_merchants'][0] == {'name': 'metro card', 'total_usd': 50, 'count': 1}
+            assert context['top_merchants'][1] == {'name': 'corner cafe', 'total_usd': 20, 'count': 2}
+            assert get_chat_context(1)[1] is prompt and (cache.hits, cache.misses) == (1, 1)
+
+            # Another user's writes leave the cached entry alone; this user's writes rebuild it
+            conn.execute("UPDATE expenses SET amount = 1, amount_usd = 1 WHERE user_id = 2")
+            conn.commit()
+            assert get_chat_context(1)[1] is prompt
+            conn.execute("INSERT INTO budgets (user_id, category, amount, currency, amount_usd, period, start_date) "
+                         "VALUES (1, 'Food', 100, 'USD', 100, 'monthly', ?)", (today,))
+            conn.commit()
+            context, prompt = get_chat_context(1)
+            assert context['budgets'] == {'Food': 100} and "'Food': 100" in prompt
+            conn.execute("DELETE FROM expenses WHERE user_id = 1 AND category = 'Travel'")
+            conn.commit()
+            assert get_chat_context(1)[0]['total_expenses_usd'] == 20
+            assert (cache.hits, cache.misses) == (2, 3)
+            conn.close()
+    finally:
+        app.config['DATABASE'] = original_db
+
+
+# --- TEST 27: Streaming Chatbot ---
+def test_chatbot_streams_tokens_with_limits_and_timeouts(tmp_path):
+    """The SSE endpoint streams the stub provider's reply, rejects requests past the slot limit and times out stalls."""
+    import json
+    import time
+    from app import ChatProvider, acquire_chat_slot
+
+    def events(response):
+        parsed = []
+        for block in response.get_data(as_text=True).strip().split('\n\n'):
+            event, data = block.split('\n')
+            parsed.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        return parsed
+
+    keys = ('DATABASE', 'CHAT_PROVIDER', 'CHAT_SLOT_WAIT', 'CHAT_STUB_TOKEN_DELAY', 'CHAT_FIRST_TOKEN_TIMEOUT')
+    original = {key: app.config[key] for key in keys}
+    app.config.update(DATABASE=str(tmp_path / 'chat.db'), CHAT_PROVIDER='stub', CHAT_SLOT_WAIT=0.01)
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('ann', 'ann@example.com', 'x')")
+            conn.commit()
+            conn.close()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['user_id'] = 1
+
+            response = client.post('/chatbot/stream', json={'message': 'How much did I spend?'})
+            assert response.mimetype == 'text/event-stream'
+            received = events(response)
+            assert received[-1] == ('done', {}) and len(received) > 5
+            streamed = ''.join(data for event, data in received if event == 'token')
+            assert streamed.startswith('You asked: How much did I spend?. Total expenses: 0')
+            assert client.post('/chatbot', json={'message': 'How much did I spend?'}).get_json() == {'reply': streamed}
+
+            # Every slot taken: new requests are turned away instead of queueing on a worker
+            held = []
+            while (slot := acquire_chat_slot()) is not None:
+                held.append(slot)
+            assert client.post('/chatbot/stream', json={'message': 'hi'}).status_code == 429
+            assert client.post('/chatbot', json={'message': 'hi'}).status_code == 429
+
+            # A timed-out reply keeps its slot until the provider thread actually stops
+            held.pop().release()
+            app.config.update(CHAT_STUB_TOKEN_DELAY=0.5, CHAT_FIRST_TOKEN_TIMEOUT=0.05)
+            assert events(client.post('/chatbot/stream', json={'message': 'hi'})) == [('error', 'AI service timed out.')]
+            assert acquire_chat_slot() is None
+            time.sleep(0.6)
+            slot = acquire_chat_slot()
+            assert slot is not None
+            slot.release()
+            for slot in held:
+                slot.release()
+
+            with pytest.raises(TypeError):
+                ChatProvider()
+    finally:
+        app.config.update(original)
+
+
+# --- TEST 28: Background Workers ---
+def test_background_workers_start_on_first_request_without_reloader(tmp_path, monkeypatch):
+    """Outside the dev reloader (flask run, gunicorn) the first request starts the recurring scheduler."""
+    import time
+    import app as app_module
+
+    monkeypatch.delenv('WERKZEUG_RUN_MAIN', raising=False)
+    keys = ('DATABASE', 'BACKGROUND_WORKERS', 'RECURRING_SWEEP_INTERVAL', 'FX_RATE_SOURCE')
+    original = {key: app.config[key] for key in keys}
+    app.config.update(DATABASE=str(tmp_path / 'workers.db'), RECURRING_SWEEP_INTERVAL=0.05,
+                      FX_RATE_SOURCE=lambda: {'USD': 1, 'EUR': 0.9})
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('u', 'u@example.com', 'x')")
+            conn.execute(
+                '''INSERT INTO expenses (user_id, amount, currency, amount_usd, category, description, date, is_recurring, frequency, next_due_date)
+                   VALUES (1, 5, 'USD', 5, 'Bills', '', '2024-01-01', 1, 'monthly', '2024-02-01')'''
+            )
+            conn.commit()
+            conn.close()
+
+        app.config['BACKGROUND_WORKERS'] = True
+        with app.test_client() as client:
+            client.get('/')
+            client.get('/')
+        assert list(app_module._background_workers) == ['export-heartbeat', 'recurring', 'import-recovery', 'fx-refresher']
+        assert app_module._background_workers['recurring'][0].is_alive()
+
+        deadline = time.time() + 5
+        with app.app_context():
+            conn = get_db_connection()
+            while time.time() < deadline:
+                generated = conn.execute('SELECT COUNT(*) FROM expenses WHERE recurring_parent_id = 1').fetchone()[0]
+                if generated:
+                    break
+                time.sleep(0.05)
+            conn.close()
+        assert generated > 0
+    finally:
+        app_module.stop_background_workers(timeout=5)
+        app.config.update(original)
+
+
+# --- TEST 29: Cold-Start Exchange Rates ---
+def test_writes_are_refused_rather_than_converted_without_rates(tmp_path, monkeypatch):
+    """With no rates ever fetched, requests refuse conversions and never fetch on their own thread."""
+    import threading
+    import jwt
+    import app as app_module
+    from app import ExchangeRateUnavailable, get_db_pool, get_rate_cache, get_usd_rate, import_csv
+
+    fetch_threads = []
+    def offline_get(*args, **kwargs):
+        fetch_threads.append(threading.current_thread())
+        raise ConnectionError('offline')
+    monkeypatch.setattr(app_module.requests, 'get', offline_get)
+
+    original = {key: app.config[key] for key in ('DATABASE', 'FX_RATE_SOURCE', 'FX_RETRY_AFTER')}
+    app.config.update(DATABASE=str(tmp_path / 'cold.db'), FX_RATE_SOURCE=None, FX_RETRY_AFTER=0)
+    try:
+        with app.app_context():
+            init_db()
+            conn = get_db_connection()
+            conn.execute("INSERT INTO users (username, email, password) VALUES ('u', 'u@example.com', 'x')")
+            conn.commit()
+
+            with pytest.raises(ExchangeRateUnavailable):
+                get_usd_rate('EUR')
+            assert get_usd_rate('USD') == 1.0
+
+            token = jwt.encode({'user_id': 1}, app.config['JWT_SECRET'], algorithm=app.config['JWT_ALGORITHM'])
+            response = app.test_client().post('/api/expenses', json={'amount': 10, 'currency': 'EUR'},
+                                              headers={'Authorization': f'Bearer {token}'})
+            assert response.status_code == 503 and 'EUR' in response.get_json()['message']
+
+            # An amount filter that cannot be converted is reported, not silently dropped
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session.update(user_id=1, currency='EUR')
+                response = client.get('/search_expenses?amount_min=5')
+                assert response.status_code == 302
+                with client.session_transaction() as session:
+                    assert any('EUR' in message for _, message in session['_flashes'])
+
+            statement = tmp_path / 'mixed.csv'
+            statement.write_text("Amt,Cur\n10,USD\n10,EUR\n")
+            stats = import_csv(conn, str(statement), {'amount': 'Amt', 'currency': 'Cur'}, 1)
+            assert (stats['imported'], stats['rejected']) == (1, 1)
+            assert conn.execute('SELECT COUNT(*) FROM expenses').fetchone()[0] == 1
+
+            # Fetches were only ever attempted from background threads
+            assert threading.main_thread() not in fetch_threads
+
+            # The source comes back: the background refresher stores rates and conversions resume
+            # Inside a request the cache shares its connection rather than taking a second pool slot
+            app.config['FX_RATE_SOURCE'] = lambda: {'USD': 1, 'EUR': 0.5}
+            checkouts = get_db_pool().metrics()['checkouts']
+            assert get_rate_cache().refresh(force=True)
+            assert get_db_pool().metrics()['checkouts'] == checkouts
+            assert get_usd_rate('EUR') == 0.5 and get_rate_cache().age() < 60
+            response = app.test_client().post('/api/expenses', json={'amount': 10, 'currency': 'EUR', 'date': 'soon'},
+                                              headers={'Authorization': f'Bearer {token}'})
+            assert response.status_code == 400 and 'soon' in response.get_json()['message']
+            conn.close()
+    finally:
+        app.config.update(original)
+
+
+# --- TEST 30: Inserted Row Ids ---
+def test_insert_rows_returns_each_rows_own_id():
+    """Batch inserts report every row's id, even when the ids are not contiguous."""
+    from app import insert_rows
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)')
+    ids = insert_rows(conn, 'INSERT INTO items (id, name) VALUES (?, ?)', [(7, 'a'), (3, 'b'), (None, 'c')])
+    assert ids == [7, 3, 8]
+    assert dict(conn.execute('SELECT name, id FROM items')) == {'a': 7, 'b': 3, 'c': 8}
+    conn.close()
+
+
+# --- TEST 31: Metrics Access ---
+def test_metrics_endpoints_are_limited_to_listed_users():
+    """Process metrics are hidden from ordinary API users and never expose the database path."""
+    import jwt
+
+    headers = {'Authorization': 'Bearer ' + jwt.encode({'user_id': 1}, app.config['JWT_SECRET'], algorithm=app.config['JWT_ALGORITHM'])}
+    with app.test_client() as client:
+        for endpoint in ('/api/metrics/db_pool', '/api/metrics/decrypt'):
+            assert client.get(endpoint, headers=headers).status_code == 404
+        app.config['METRICS_API_USERS'] = {1}
+        try:
+            response = client.get('/api/metrics/db_pool', headers=headers)
+            assert response.status_code == 200 and 'database' not in response.get_json()['data']
+            assert client.get('/api/metrics/decrypt', headers=headers).status_code == 200
+        finally:
+            app.config['METRICS_API_USERS'] = set()